@@ -17,29 +17,39 @@
 
 
 import argparse
+import hashlib
 import json
 import csv
 import os
+import shutil
 import socket
 import logging
 import datetime
-import threading
 import time
 import Queue
 
+import numpy
+
 from ssl import SSLError
 
 import telescope.external
 import telescope.filters
+import telescope.metricstore
 import telescope.metrics_math
 import telescope.mlab
+import telescope.outputformats
 import telescope.query
+import telescope.resultcache
+import telescope.runjournal
+import telescope.scheduler
 import telescope.selector
 import telescope.utils
 
 
-MAX_THREADS_NORMAL_MODE = 18
-MAX_THREADS_BATCH_MODE = 100
+MAX_JOBS_NORMAL_MODE = 18
+MAX_JOBS_BATCH_MODE = 100
+MAX_INLINE_CLIENT_RANGES = 1000
+MAX_TABLES_WITHOUT_BATCH = 2
 
 class NoClientNetworkBlocksFound(Exception):
   def __init__(self, provider_name):
@@ -58,15 +68,63 @@ class ExternalQueryHandler:
       resulting data when the job completes.
   """
 
-  def __init__(self):
+  def __init__(self, query_result_cache = None, bigquery_call_pool = None, parallel_page_fetches = 1,
+               result_export_backend = None, run_journal = None):
     self.result = False
     self.metadata = None
     self.fatal_error = None
+    self.query_string = None
+    self.query_result_cache = query_result_cache
+    self.bigquery_call_pool = bigquery_call_pool
+    self.parallel_page_fetches = parallel_page_fetches
+    self.result_export_backend = result_export_backend
+    self.run_journal = run_journal
+
+  def retrieve_data_from_cache(self):
+    """ Processes cached results of the query, if there are any, in place of
+        running it.
+
+        Returns:
+          (bool) True if cached results were found, processed, and written to
+          file, False otherwise.
+    """
+    logger = logging.getLogger('telescope')
+    self.result = False
+
+    if self.query_result_cache is None or self.query_string is None:
+      return self.result
+    cached_data_pages = self.query_result_cache.get_pages(self.query_string)
+    if cached_data_pages is None:
+      return self.result
+
+    logger.info('Found cached query results for ({site}, {client_provider}, {metric}).'.format(
+        **self.metadata))
+    try:
+      self._process_query_result_pages(cached_data_pages)
+      self.result = True
+    except (ValueError, IOError) as caught_error:
+      logger.error(("Caught {caught_error} processing cached results for ({site}, {client_provider}, " +
+                    "{metric}), discarding them.").format(caught_error = caught_error, **self.metadata))
+      self.query_result_cache.discard(self.query_string)
+    return self.result
+
+  def _record_retrieval_in_journal(self):
+    if self.run_journal is None:
+      return
+    if self.result:
+      self.run_journal.record_retrieval(self.query_string)
+    else:
+      self.run_journal.record_failure(self.query_string)
 
   def retrieve_data_upon_job_completion(self, job_id, query_object = None):
     """ Waits for a BigQuery job to complete, then retrieves the data, runs
         appropriate filtering on the data, and writes the result to an output
-        data file.
+        data file. Each page of results is processed as it arrives; when the
+        handler has a connection pool, pages are fetched in parallel and
+        processed in whatever order they arrive, since neither the filters,
+        the metric calculations, nor the output depend on the order of rows.
+        Results too large to page through are exported instead when the
+        handler has an export backend.
 
         Args:
           job_id (str): ID of job for which to retrieve data.
@@ -82,24 +140,15 @@ class ExternalQueryHandler:
     self.result = False
 
     if query_object is not None:
+      query_result_cache_writer = self._start_cache_entry()
       try:
-        bq_query_returned_data = query_object.retrieve_job_data(job_id)
-        logger.debug('Received data, processing according to {metric} metric.'.format(metric = self.metadata['metric']))
-
-        validation_results = telescope.filters.filter_measurements_list(
-            self.metadata['metric'], bq_query_returned_data)
-        number_kept = len(validation_results)
-        number_discarded = len(bq_query_returned_data) - len(validation_results)
-        logger.info(("Filtered measurements, kept {number_kept} and discarded " +
-                      "{number_discarded}.").format(number_kept = number_kept,
-                                                  number_discarded = number_discarded))
-
-        subset_metric_calculations = telescope.metrics_math.calculate_results_list(
-            self.metadata['metric'], validation_results)
-
-        write_metric_calculations_to_file(self.metadata['data_filepath'], subset_metric_calculations)
+        bq_query_returned_pages = query_object.iter_job_column_pages(
+            job_id, bigquery_call_pool = self.bigquery_call_pool,
+            parallel_page_fetches = self.parallel_page_fetches, ordered = False,
+            result_export_backend = self.result_export_backend)
+        self._process_query_result_pages(bq_query_returned_pages, query_result_cache_writer)
         self.result = True
-      except (ValueError, telescope.external.QueryFailure) as caught_error:
+      except (ValueError, IOError, telescope.external.QueryFailure) as caught_error:
         logger.error("Caught {caught_error} for ({site}, {client_provider}, {metric}).".format(
             caught_error = caught_error, site = self.metadata['site'],
             client_provider = self.metadata['client_provider'], metric = self.metadata['metric']))
@@ -108,8 +157,190 @@ class ExternalQueryHandler:
                       "{metric}) do not exist, moving on.").format( site = self.metadata['site'],
                           client_provider = self.metadata['client_provider'], metric = self.metadata['metric']))
         self.fatal_error = True
+      self._finish_cache_entry(query_result_cache_writer)
+      self._record_retrieval_in_journal()
     return self.result
 
+  def _start_cache_entry(self):
+    if self.query_result_cache is None or self.query_string is None:
+      return None
+    try:
+      return self.query_result_cache.writer(self.query_string)
+    except (IOError, OSError) as caught_error:
+      logging.getLogger('telescope').warn('Could not cache query results: {error}'.format(error = caught_error))
+      return None
+
+  def _finish_cache_entry(self, query_result_cache_writer):
+    if query_result_cache_writer is None:
+      return
+    try:
+      if self.result:
+        query_result_cache_writer.commit()
+      else:
+        query_result_cache_writer.abort()
+    except (IOError, OSError) as caught_error:
+      logging.getLogger('telescope').warn('Could not cache query results: {error}'.format(error = caught_error))
+
+  def _process_query_result_pages(self, result_pages, query_result_cache_writer = None):
+    """ Filters, calculates and writes out each page of rows returned by the
+        query as it arrives, for each selector the query serves.
+
+        Args:
+          result_pages (iterable): telescope.columns.MeasurementColumns
+            retrieved from BigQuery.
+
+          query_result_cache_writer (telescope.resultcache.QueryResultCacheWriter):
+            Writer to which to copy the rows, or None to not cache them.
+    """
+    logger = logging.getLogger('telescope')
+    is_fused = 'fused_metadata' in self.metadata
+    member_metadata = self.metadata['fused_metadata'] if is_fused else [self.metadata]
+
+    metric_outputs = []
+    try:
+      for metric_metadata in member_metadata:
+        metric_outputs.append(MetricOutput(metric_metadata))
+
+      for result_page in result_pages:
+        if query_result_cache_writer is not None:
+          query_result_cache_writer.write_columns(result_page)
+        if is_fused:
+          measurements_by_direction = split_measurements_by_data_direction(result_page)
+        for metric_output in metric_outputs:
+          if is_fused:
+            metric_data_direction = telescope.query.METRIC_DATA_DIRECTIONS[metric_output.metric]
+            if metric_data_direction in measurements_by_direction:
+              metric_output.process_measurements(measurements_by_direction[metric_data_direction])
+          else:
+            metric_output.process_measurements(result_page)
+    except:
+      for metric_output in metric_outputs:
+        metric_output.abort()
+      raise
+
+    for metric_output in metric_outputs:
+      metric_output.close()
+      logger.info(("Filtered {metric} measurements, kept {number_kept} and discarded " +
+                    "{number_discarded}.").format(metric = metric_output.metric,
+                                                  number_kept = metric_output.number_kept,
+                                                  number_discarded = metric_output.number_discarded))
+      logger.debug("Discarded {metric} measurements by rule: {discard_counts}.".format(
+          metric = metric_output.metric, discard_counts = metric_output.discard_counts))
+
+
+class MetricOutput:
+  """ Filters measurements for one metric, calculates the metric, and writes
+      the results to the metric's output data file, or to a slice of the
+      metric store in incremental mode, as measurements arrive.
+  """
+
+  def __init__(self, metric_metadata):
+    self.metric = metric_metadata['metric']
+    self.number_kept = 0
+    self.number_discarded = 0
+    self.discard_counts = {}
+    metric_store = metric_metadata.get('metric_store')
+    if metric_store is not None:
+      self._writer = metric_store.slice_writer(metric_store_key(metric_metadata),
+                                               *metric_metadata['store_window'])
+    else:
+      self._writer = create_metric_calculations_writer(metric_metadata['data_filepath'],
+                                                       metric_metadata.get('output_format', 'csv'),
+                                                       provenance = output_provenance(metric_metadata))
+
+  def process_measurements(self, measurements):
+    """ Processes a batch of measurements retrieved from BigQuery.
+
+        Args:
+          measurements (telescope.columns.MeasurementColumns): Measurements to
+            process.
+    """
+    keep_mask, discard_counts = telescope.filters.filter_measurement_columns(self.metric, measurements)
+    validation_results = measurements.select(keep_mask)
+    self.number_kept += len(validation_results)
+    self.number_discarded += len(measurements) - len(validation_results)
+    for rule_name, rule_discard_count in discard_counts.iteritems():
+      self.discard_counts[rule_name] = self.discard_counts.get(rule_name, 0) + rule_discard_count
+
+    if telescope.metrics_math.supports_results_array(self.metric):
+      subset_metric_calculations = telescope.metrics_math.calculate_results_array(
+          self.metric, validation_results)
+    else:
+      subset_metric_calculations = telescope.metrics_math.calculate_results_list(
+          self.metric, list(validation_results.iter_rows()))
+    self._writer.write(subset_metric_calculations)
+
+  def close(self):
+    self._writer.close()
+
+  def abort(self):
+    self._writer.abort()
+
+
+def split_measurements_by_data_direction(measurements):
+  """ Groups measurements by the direction of the test that produced them.
+
+      Args:
+        measurements (telescope.columns.MeasurementColumns): Measurements
+        retrieved from BigQuery, with a connection_spec_data_direction field.
+
+      Returns:
+        (dict): telescope.columns.MeasurementColumns keyed by integer data
+        direction.
+  """
+  measurements_by_direction = {}
+  if len(measurements) == 0:
+    return measurements_by_direction
+  data_directions = measurements['connection_spec_data_direction'].astype(numpy.int64)
+  for data_direction in numpy.unique(numpy.ma.compressed(data_directions)):
+    measurements_by_direction[int(data_direction)] = measurements.select(
+        numpy.ma.filled(data_directions == data_direction, False))
+  return measurements_by_direction
+
+
+def plan_fused_queries(pending_selectors):
+  """ Groups selectors that can be answered by a single query.
+
+      Selectors for NDT metrics that share a site, client provider, time window
+      and IP translation differ only in the fields they select and the
+      direction of the tests they select, so one query selecting the union of
+      their fields over both directions retrieves the data for all of them.
+
+      Args:
+        pending_selectors (list): 2-tuples of a Selector and its metadata dict.
+
+      Returns:
+        (list): Lists of (Selector, metadata) 2-tuples, one list per query to
+        run, in the order the first selector of each group was given.
+  """
+  selector_groups = []
+  selector_groups_by_key = {}
+  for selector, thread_metadata in pending_selectors:
+    if selector.metric not in telescope.query.METRIC_DATA_DIRECTIONS:
+      selector_groups.append([(selector, thread_metadata)])
+      continue
+    fusion_key = (selector.start_time, selector.duration, selector.site_name,
+                  selector.client_provider, selector.mlab_project,
+                  selector.ip_translation_spec.strategy_name,
+                  json.dumps(selector.ip_translation_spec.params, sort_keys = True))
+    if fusion_key not in selector_groups_by_key:
+      selector_groups_by_key[fusion_key] = []
+      selector_groups.append(selector_groups_by_key[fusion_key])
+    selector_groups_by_key[fusion_key].append((selector, thread_metadata))
+  return selector_groups
+
+
+def fuse_thread_metadata(member_metadata):
+  """ Builds the metadata of a query that retrieves the data for several
+      selectors. The metadata of each selector is kept under 'fused_metadata',
+      and 'metric' lists all of the selectors' metrics.
+  """
+  fused_metadata = dict(member_metadata[0])
+  fused_metadata['metric'] = ', '.join(metadata['metric'] for metadata in member_metadata)
+  fused_metadata['data_filepath'] = None
+  fused_metadata['fused_metadata'] = member_metadata
+  return fused_metadata
+
 
 def setup_logger(verbosity_level = 0):
   """ Create and configure application logging mechanism.
@@ -132,49 +363,140 @@ def setup_logger(verbosity_level = 0):
   return logger
 
 
-def write_metric_calculations_to_file(data_filepath, metric_calculations, should_write_header = False):
-  """ Writes metric data to a file in CSV format.
+class MetricCalculationsWriter:
+  """ Writes metric data to a file in CSV format, a batch at a time. The file
+      appears at its path, along with its manifest, only once the writer is
+      closed.
+  """
+
+  def __init__(self, data_filepath, should_write_header = False, provenance = None):
+    """ Opens the output file.
+
+        Args:
+          data_filepath (str): File path to which to write data.
+
+          should_write_header (bool): Indicates whether the output file should
+          contain a header line to identify each column of data.
+
+          provenance (dict): Queries whose results the file holds, recorded
+          in its manifest, as for telescope.outputformats.commit_output_file.
+    """
+    self.data_filepath = data_filepath
+    self.should_write_header = should_write_header
+    self.provenance = provenance
+    self._row_count = 0
+    self._data_file_csv = None
+    self._data_file_raw = telescope.outputformats.AtomicOutputFile(data_filepath)
+
+  def write(self, metric_calculations):
+    """ Appends metric data to the file.
+
+        Args:
+          metric_calculations (list or numpy.ndarray): A list of dictionaries
+          containing the values of retrieved metrics, or an array of
+          telescope.metrics_math.RESULT_DTYPE records.
+    """
+    if type(metric_calculations) is numpy.ndarray:
+      self._write_records(metric_calculations)
+      return
+    if type(metric_calculations) is not list or len(metric_calculations) == 0:
+      return
+    self._row_count += len(metric_calculations)
+    if self._data_file_csv is None:
+      self._data_file_csv = csv.DictWriter(self._data_file_raw,
+                                           fieldnames = metric_calculations[0].keys(),
+                                           delimiter=',',
+                                           quotechar='"', quoting=csv.QUOTE_MINIMAL)
+      if self.should_write_header == True:
+        self._data_file_csv.writeheader()
+    self._data_file_csv.writerows(metric_calculations)
+
+  def _write_records(self, metric_calculations):
+    if len(metric_calculations) == 0:
+      return
+    self._row_count += len(metric_calculations)
+    records_csv = csv.writer(self._data_file_raw, delimiter=',',
+                             quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    if self._data_file_csv is None:
+      self._data_file_csv = records_csv
+      if self.should_write_header == True:
+        records_csv.writerow(metric_calculations.dtype.names)
+    records_csv.writerows(metric_calculations.tolist())
+
+  def close(self):
+    telescope.outputformats.commit_output_file(self._data_file_raw, self._row_count, self.provenance)
+
+  def abort(self):
+    """ Discards the partially written file. """
+    self._data_file_raw.abort()
+
+
+def create_metric_calculations_writer(data_filepath, output_format = 'csv', should_write_header = False,
+                                      provenance = None):
+  """ Opens a writer of metric data in the given output format.
+
+      Args:
+        data_filepath (str): File path to which to write data.
+
+        output_format (str): One of telescope.outputformats.OUTPUT_FORMATS.
+        Formats other than CSV only accept arrays of
+        telescope.metrics_math.RESULT_DTYPE records.
+
+        should_write_header (bool): Indicates whether a CSV output file should
+        contain a header line to identify each column of data.
+
+        provenance (dict): Queries whose results the file holds, recorded in
+        its manifest.
+
+      Returns:
+        (object): Writer with write, close and abort methods.
+  """
+  if output_format == 'csv':
+    return MetricCalculationsWriter(data_filepath, should_write_header, provenance)
+  return telescope.outputformats.RESULTS_WRITERS[output_format](data_filepath, provenance)
+
+
+def write_metric_calculations_to_file(data_filepath, metric_calculations, should_write_header = False,
+                                      output_format = 'csv', provenance = None):
+  """ Writes metric data to a file.
 
       Args:
         data_filepath (str): File path to which to write data.
 
-        metric_calculations (list): A list of dictionaries containing the
-        values of retrieved metrics.
+        metric_calculations (list or numpy.ndarray): A list of dictionaries
+        containing the values of retrieved metrics, or an array of
+        telescope.metrics_math.RESULT_DTYPE records.
 
-        should_write_header (bool): Indicates whether the output file should
+        should_write_header (bool): Indicates whether a CSV output file should
         contain a header line to identify each column of data.
 
+        output_format (str): One of telescope.outputformats.OUTPUT_FORMATS.
+
+        provenance (dict): Queries whose results the file holds, recorded in
+        its manifest.
+
       Returns:
         (bool) True if the file was written successfully, False otherwise.
   """
   logger = logging.getLogger('telescope')
   try:
-    with open(data_filepath, 'w') as data_file_raw:
-      if type(metric_calculations) is list and len(metric_calculations) > 0:
-        data_file_csv = csv.DictWriter(data_file_raw,
-                                        fieldnames = metric_calculations[0].keys(),
-                                        delimiter=',',
-                                        quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        if should_write_header == True:
-          data_file_csv.writeheader()
-        data_file_csv.writerows(metric_calculations )
+    metric_calculations_writer = create_metric_calculations_writer(data_filepath, output_format,
+                                                                   should_write_header, provenance)
+    try:
+      metric_calculations_writer.write(metric_calculations)
+    except:
+      metric_calculations_writer.abort()
+      raise
+    metric_calculations_writer.close()
     return True
-  except IOError as caught_error:
-    if caught_error.errno == 24:
-      logger.error(("When writing raw output, caught {error}, " +
-                      "trying again shortly.").format(error = caught_error))
-      write_metric_calculations_to_file(data_filepath, metric_calculations, should_write_header)
-      time.sleep(20)
-    else:
-      logger.error(("When writing raw output, caught {error}, " +
-                      "cannot move on.").format(error = caught_error))
   except Exception as caught_error:
     logger.error(("When writing raw output, caught {error}, " +
                     "cannot move on.").format(error = caught_error))
   return False
 
 
-def build_filename(resource_type, outpath, date, duration, site, client_provider, metric):
+def build_filename(resource_type, outpath, date, duration, site, client_provider, metric,
+                   output_format = 'csv'):
   """ Builds an output filename that reflects the data being written to file.
 
       Args:
@@ -199,10 +521,13 @@ def build_filename(resource_type, outpath, date, duration, site, client_provider
         metric (str): The name of the metric this data represents (e.g.
         download_throughput).
 
+        output_format (str): Format of a data file, which determines its
+        extension.
+
      Returns:
        (str): The generated full pathname of the output file.
   """
-  extensions = { 'data': 'raw.csv', 'bigquery': 'bigquery.sql'}
+  extensions = { 'data': telescope.outputformats.FILE_EXTENSIONS[output_format], 'bigquery': 'bigquery.sql'}
   filename_format = "{date}+{duration}_{site}_{client_provider}_{metric}-{extension}"
 
   filename = filename_format.format(date = date,
@@ -265,7 +590,8 @@ def create_ip_translator(ip_translator_spec):
   factory = telescope.iptranslation.IPTranslationStrategyFactory()
   return factory.create(ip_translator_spec)
 
-def generate_query(selector, ip_translator, mlab_site_resolver):
+def generate_query(selector, ip_translator, mlab_site_resolver, client_filter = 'inline',
+                   client_ranges_dataset = None, metrics = None, time_window = None):
   """ Generates the query string necessary to retrieve the data specified in a
       selector object.
 
@@ -279,17 +605,38 @@ def generate_query(selector, ip_translator, mlab_site_resolver):
         mlab_site_resolver (telescope.mlab.MLabSiteResolver): Resolver to translate M-Lab
         site IDs to a set of IP addresses.
 
+        client_filter (str): How the query matches client IP blocks: 'inline'
+        lists every range in the WHERE clause, 'join' joins against an uploaded
+        table of ranges, and 'automatic' joins only when there are more than
+        MAX_INLINE_CLIENT_RANGES ranges.
+
+        client_ranges_dataset (str): BigQuery dataset that holds client ranges
+        tables, required unless client_filter is 'inline'.
+
+        metrics (list): Metrics to select data for, when the query should serve
+        several selectors that differ only in metric. Defaults to the metric of
+        the selector.
+
+        time_window (tuple): Start and end datetimes of the part of the
+        selector's window to query, when the selector is split into time
+        shards. Defaults to the whole window of the selector.
+
       Returns:
-        (str, int): A 2-tuple containing the query string and the number of tables
-        referenced in the query.
+        (str, int, telescope.query.ClientRangesTable, int): A 4-tuple
+        containing the query string, the number of tables referenced in the
+        query, the client ranges table that must exist before the query runs,
+        or None if the query does not use one, and the number of predicates in
+        the query.
   """
   logger = logging.getLogger('telescope')
 
   start_time_datetime = selector.start_time
   end_time_datetime = start_time_datetime + datetime.timedelta(seconds = selector.duration)
+  if time_window is not None:
+    start_time_datetime, end_time_datetime = time_window
 
   network_lookup_found_blocks = ip_translator.find_ip_blocks(
-      selector.client_provider)
+      selector.client_provider, start_time_datetime, end_time_datetime)
   if len(network_lookup_found_blocks) == 0:
     raise NoClientNetworkBlocksFound(selector.client_provider)
 
@@ -303,13 +650,279 @@ def generate_query(selector, ip_translator, mlab_site_resolver):
   except Exception as caught_error:
     raise MLabServerResolutionFailed(caught_error)
 
+  client_ranges_table = None
+  if client_filter != 'inline':
+    client_ranges_table = telescope.query.ClientRangesTable(client_ranges_dataset,
+                                                            network_lookup_found_blocks)
+    if (client_filter == 'automatic' and
+        len(client_ranges_table.ip_ranges) <= MAX_INLINE_CLIENT_RANGES):
+      client_ranges_table = None
+
   query_generator = telescope.query.BigQueryQueryGenerator(start_time_datetime,
                                                      end_time_datetime,
-                                                     selector.metric,
+                                                     metrics or selector.metric,
                                                      selector.mlab_project,
                                                      server_ips,
-                                                     network_lookup_found_blocks)
-  return (query_generator.query(), query_generator.table_span())
+                                                     network_lookup_found_blocks,
+                                                     client_ranges_table)
+  return (query_generator.query(), query_generator.table_span(), client_ranges_table,
+          query_generator.predicate_count())
+
+def plan_time_shards(start_time, end_time, shard_unit):
+  """ Decides how to split a selector's time window into shards, each queried
+      separately.
+
+      Queries spanning more than MAX_TABLES_WITHOUT_BATCH monthly tables are
+      run in batch mode, which can delay their results by hours. Splitting
+      such windows into shards of a month or a week keeps each shard's query
+      small enough to run interactively, and the shards run concurrently.
+
+      Args:
+        start_time (datetime): Start of the window, inclusive.
+
+        end_time (datetime): End of the window, exclusive.
+
+        shard_unit (str): 'month' or 'week' to split at those boundaries, or
+        'none' to never split.
+
+      Returns:
+        (list): (shard_start, shard_end) datetime tuples in time order, or
+        None if the selector should be queried whole.
+  """
+  if shard_unit == 'none':
+    return None
+  if len(telescope.query.split_time_window(start_time, end_time, 'month')) <= MAX_TABLES_WITHOUT_BATCH:
+    return None
+  return telescope.query.split_time_window(start_time, end_time, shard_unit)
+
+def shard_filepath(data_filepath, shard_index):
+  """ Path of the output of one time shard of a selector. """
+  return '{data_filepath}.shard{shard_index:03d}'.format(data_filepath = data_filepath,
+                                                         shard_index = shard_index)
+
+def shard_thread_metadata(thread_metadata, time_window, data_filepath):
+  """ Builds the metadata of one time shard of a selector, which describes
+      the shard's window and writes to the given output file.
+  """
+  shard_start, shard_end = time_window
+  shard_metadata = dict(thread_metadata)
+  shard_metadata['date'] = shard_start.strftime('%Y-%m-%d-%H%M%S')
+  shard_metadata['duration'] = duration_to_string((shard_end - shard_start).total_seconds())
+  shard_metadata['data_filepath'] = data_filepath
+  return shard_metadata
+
+def fingerprint_selector(selector, ip_translator_factory, client_filter = 'inline',
+                         client_ranges_dataset = None):
+  """ Identifies what a selector's output depends on, so that outputs written
+      for a different selector, or from different MaxMind snapshots, are not
+      reused.
+
+      The fingerprint is computed from the selector's fields and the size and
+      modification time of the MaxMind snapshots covering its window, without
+      reading the snapshots or resolving the selector's site, so that checking
+      for a cached output stays cheap and does not depend on the network. The
+      hash of the query itself is recorded once the query is generated.
+
+      Args:
+        selector (telescope.selector.Selector): Selector to identify.
+
+        ip_translator_factory (telescope.iptranslation.IPTranslationStrategyFactory):
+        Factory of the translator of the selector's client provider.
+
+        client_filter (str): How queries match client IP blocks, as for
+        generate_query.
+
+        client_ranges_dataset (str): Dataset of client ranges tables, as for
+        generate_query.
+
+      Returns:
+        (str, list): A 2-tuple of the cache key of the selector and the dates
+        of the MaxMind snapshots from which its client network blocks are
+        resolved.
+  """
+  start_time = selector.start_time
+  end_time = start_time + datetime.timedelta(seconds = selector.duration)
+  snapshot_identities = ip_translator_factory.snapshot_identities(selector.ip_translation_spec,
+                                                                  start_time, end_time)
+  selector_fields = {
+      'start_time': telescope.utils.utc_datetime_to_unix_timestamp(start_time),
+      'duration': selector.duration,
+      'site': selector.site_name,
+      'client_provider': selector.client_provider,
+      'metric': selector.metric,
+      'mlab_project': selector.mlab_project,
+      'ip_translation': selector.ip_translation_spec.strategy_name,
+      'db_snapshots': snapshot_identities,
+      'client_filter': client_filter,
+      'client_ranges_dataset': client_ranges_dataset,
+      }
+  selector_key = hashlib.sha1(json.dumps(selector_fields, sort_keys = True)).hexdigest()
+  return selector_key, [snapshot_date for snapshot_date, _, _ in snapshot_identities]
+
+def output_provenance(thread_metadata):
+  """ Identifies the selector, query and MaxMind snapshots behind a
+      selector's output in the form recorded in the manifests of output files.
+  """
+  provenance = {'db_snapshots': thread_metadata.get('db_snapshots') or []}
+  if thread_metadata.get('selector_key') is not None:
+    provenance['selector_keys'] = [thread_metadata['selector_key']]
+  if thread_metadata.get('query_hash') is not None:
+    provenance['query_hashes'] = [thread_metadata['query_hash']]
+  return provenance
+
+def metric_store_key(thread_metadata):
+  """ Key under which a selector's results are kept in a metric store. """
+  return (thread_metadata['site'], thread_metadata['client_provider'], thread_metadata['metric'])
+
+def plan_incremental_queries(metric_store, member_metadata, start_time, end_time, shard_unit):
+  """ Plans queries for only the parts of selectors' window that a metric
+      store does not cover yet.
+
+      Selectors that share a window are missing the same intervals when they
+      are refreshed together, in which case each interval is queried once for
+      all of them. Selectors missing different intervals are queried
+      separately. Long intervals are split into time shards like whole
+      windows are.
+
+      Args:
+        metric_store (telescope.metricstore.MetricStore): Store of earlier
+        results.
+
+        member_metadata (list): Metadata of the selectors that share the
+        window, which could otherwise be queried together.
+
+        start_time (datetime): Start of the window, inclusive.
+
+        end_time (datetime): End of the window, exclusive.
+
+        shard_unit (str): Unit by which to split long intervals, as for
+        plan_time_shards.
+
+      Returns:
+        (list): 2-tuples of the time window of a query and the metadata of the
+        selectors it serves, which direct the results to the store.
+  """
+  start_timestamp = telescope.utils.utc_datetime_to_unix_timestamp(start_time)
+  end_timestamp = telescope.utils.utc_datetime_to_unix_timestamp(end_time)
+  member_groups = []
+  member_groups_by_intervals = {}
+  for metadata in member_metadata:
+    missing_intervals = tuple(metric_store.missing_intervals(metric_store_key(metadata),
+                                                             start_timestamp, end_timestamp))
+    if missing_intervals not in member_groups_by_intervals:
+      member_groups_by_intervals[missing_intervals] = []
+      member_groups.append((missing_intervals, member_groups_by_intervals[missing_intervals]))
+    member_groups_by_intervals[missing_intervals].append(metadata)
+
+  query_plans = []
+  for missing_intervals, group_metadata in member_groups:
+    for interval_start, interval_end in missing_intervals:
+      interval_start_time = telescope.utils.unix_timestamp_to_utc_datetime(interval_start)
+      interval_end_time = telescope.utils.unix_timestamp_to_utc_datetime(interval_end)
+      time_windows = (plan_time_shards(interval_start_time, interval_end_time, shard_unit) or
+                      [(interval_start_time, interval_end_time)])
+      for time_window in time_windows:
+        slice_metadata = []
+        for metadata in group_metadata:
+          window_metadata = shard_thread_metadata(metadata, time_window, None)
+          window_metadata['metric_store'] = metric_store
+          window_metadata['store_window'] = tuple(telescope.utils.utc_datetime_to_unix_timestamp(window_time)
+                                                  for window_time in time_window)
+          slice_metadata.append(window_metadata)
+        query_plans.append((time_window, slice_metadata))
+  return query_plans
+
+def materialize_incremental_outputs(metric_store, incremental_outputs):
+  """ Writes the output file of each selector served by a metric store from
+      the store's results for the selector's window, once the store covers it.
+
+      Args:
+        metric_store (telescope.metricstore.MetricStore): Store of results.
+
+        incremental_outputs (list): 6-tuples of a selector's output file path,
+        output format, provenance to record in the file's manifest, store key,
+        and start and end timestamps of its window.
+
+      Returns:
+        (list): Output file paths of the selectors whose windows the store
+        does not fully cover, which are not written.
+  """
+  logger = logging.getLogger('telescope')
+  unwritten_filepaths = []
+  for data_filepath, output_format, provenance, store_key, start_timestamp, end_timestamp in incremental_outputs:
+    if not metric_store.covers(store_key, start_timestamp, end_timestamp):
+      logger.error('Store does not cover the window of {data_filepath}, not writing it.'.format(
+          data_filepath = data_filepath))
+      unwritten_filepaths.append(data_filepath)
+      continue
+    if write_metric_calculations_to_file(data_filepath,
+                                         metric_store.read_window(store_key, start_timestamp, end_timestamp),
+                                         output_format = output_format, provenance = provenance):
+      logger.info('Wrote {data_filepath} from the store.'.format(data_filepath = data_filepath))
+    else:
+      unwritten_filepaths.append(data_filepath)
+  return unwritten_filepaths
+
+def merge_time_shards(sharded_outputs):
+  """ Concatenates the outputs of the time shards of each selector, in time
+      order, into the selector's output file. A selector is merged only once
+      every one of its shards has been written, and its shard files are then
+      removed.
+
+      CSV and fixed-width binary shards are concatenated byte for byte. Shards
+      in formats with a file-level structure are read and written again.
+
+      Args:
+        sharded_outputs (list): 4-tuples of a selector's output file path, its
+        output format, its cache key (see fingerprint_selector), and the
+        paths of its shards' outputs, in time order. Shards written for
+        another selector are treated as missing.
+
+      Returns:
+        (list): Output file paths of the selectors that could not be merged.
+  """
+  logger = logging.getLogger('telescope')
+  unmerged_filepaths = []
+  for data_filepath, output_format, selector_key, shard_filepaths in sharded_outputs:
+    missing_shard_filepaths = [shard_path for shard_path in shard_filepaths
+                               if not telescope.utils.check_for_valid_cache(shard_path,
+                                                                            selector_key = selector_key)]
+    if missing_shard_filepaths:
+      logger.error('Could not merge {data_filepath}, missing shards: {missing}.'.format(
+          data_filepath = data_filepath, missing = ', '.join(missing_shard_filepaths)))
+      unmerged_filepaths.append(data_filepath)
+      continue
+
+    shard_manifests = [telescope.utils.read_output_manifest(shard_path) for shard_path in shard_filepaths]
+    provenance = {'selector_keys': sum((manifest['selector_keys'] for manifest in shard_manifests), []),
+                  'query_hashes': sum((manifest['query_hashes'] for manifest in shard_manifests), []),
+                  'db_snapshots': sum((manifest['db_snapshots'] for manifest in shard_manifests), [])}
+    if output_format in ('csv', 'binary'):
+      merged_file = telescope.outputformats.AtomicOutputFile(data_filepath)
+      try:
+        for shard_path in shard_filepaths:
+          with open(shard_path, 'rb') as shard_file:
+            shutil.copyfileobj(shard_file, merged_file)
+      except:
+        merged_file.abort()
+        raise
+      telescope.outputformats.commit_output_file(
+          merged_file, sum(manifest['rows'] for manifest in shard_manifests), provenance)
+    else:
+      merged_writer = create_metric_calculations_writer(data_filepath, output_format, provenance = provenance)
+      try:
+        for shard_path in shard_filepaths:
+          merged_writer.write(telescope.outputformats.read_results(shard_path, output_format))
+      except:
+        merged_writer.abort()
+        raise
+      merged_writer.close()
+    for shard_path in shard_filepaths:
+      os.remove(shard_path)
+      telescope.utils.remove_output_manifest(shard_path)
+    logger.info('Merged {shard_count} shards into {data_filepath}.'.format(
+        shard_count = len(shard_filepaths), data_filepath = data_filepath))
+  return unmerged_filepaths
 
 def duration_to_string(duration_seconds):
   """ Serializes an amount of time in seconds to a human-readable string
@@ -346,40 +959,23 @@ def duration_to_string(duration_seconds):
 
   return duration_string
 
-def wait_to_respect_thread_limit(concurrent_thread_limit, queue_size):
-  """ Waits until the number of active threads (including both background
-      worker threads and the main thread) have dropped below the maximum number
-      of permitted concurrent threads.
-
-      Args:
-        concurrent_thread_limit (int): Maximum number of permitted concurrent
-        threads.
-
-        queue_size (int): Total number of jobs waiting in work queue.
-  """
-  logger = logging.getLogger('telescope')
-  active_thread_count = threading.activeCount()
-  while active_thread_count >= concurrent_thread_limit:
-    logger.debug(('Reached thread limit ({thread_limit}), cooling off. '
-                  'Currently {thread_count} active threads and {queue_size} in'
-                  ' queue.').format(thread_limit = concurrent_thread_limit,
-                                   thread_count = active_thread_count,
-                                   queue_size = queue_size))
-    time.sleep(20)
-    active_thread_count = threading.activeCount()
-
-def process_selector_queue(selector_queue, google_auth_config,
-                           batchmode='automatic', max_tables_without_batch=2):
+def process_selector_queue(selector_queue, bigquery_call_pool, job_scheduler,
+                           batchmode='automatic', max_tables_without_batch=MAX_TABLES_WITHOUT_BATCH,
+                           query_result_cache=None, parallel_page_fetches=1,
+                           result_export_backend=None, run_journal=None):
   """ Processes the queue of Selector objects by launching BigQuery jobs for
-      each Selector and spawning threads to gather the results. Enforces query
-      rate limits so that queue processing obeys limits on maximum simultaneous
-      threads.
+      each Selector and handing them to the job scheduler, which gathers the
+      results. Submission waits for a free scheduler slot, so that queue
+      processing obeys limits on the number of jobs in flight.
 
       Args:
         selector_queue (Queue.Queue): A queue of Selector objects to process.
 
-        google_auth_config (external.GoogleAPIAuth): Object containing
-        GoogleAPI auth data.
+        bigquery_call_pool (telescope.external.BigQueryCallPool): Pool of
+        authorized BigQuery connections with which to submit jobs.
+
+        job_scheduler (telescope.scheduler.JobScheduler): Scheduler that waits
+        on submitted jobs and processes their results.
 
         batchmode (str): Indicates the batch mode to operate under.
 
@@ -388,23 +984,47 @@ def process_selector_queue(selector_queue, google_auth_config,
         SELECT portion of a query before the job is automatically converted to
         batch mode.
 
+        query_result_cache (telescope.resultcache.QueryResultCache): Cache of
+        query results to consult before running each query, or None to always
+        run queries.
+
+        parallel_page_fetches (int): Maximum number of pages of each job's
+        results to fetch at once.
+
+        result_export_backend (telescope.external.ResultExportBackend): Backend
+        through which to retrieve large results, or None to always page
+        through results.
+
+        run_journal (telescope.runjournal.RunJournal): Journal in which to
+        record submitted jobs, and from which to reattach to jobs submitted by
+        an earlier, interrupted run, or None to always submit queries.
+
       Returns:
-        (list): A list of 2-tuples where the first element is the spawned
-        worker thread that waits on query results and the second element is the
-        object that stores the results of the query.
+        (list): The objects that store the results of each query, either
+        already filled from the cache or filled by the job scheduler once the
+        query's job completes.
   """
   logger = logging.getLogger('telescope')
-  thread_monitor = []
+  external_query_handlers = []
 
   while not selector_queue.empty():
     bq_query_string, bq_table_span, thread_metadata, has_been_run = selector_queue.get(False)
 
+    external_query_handler = ExternalQueryHandler(query_result_cache, bigquery_call_pool, parallel_page_fetches,
+                                                  result_export_backend, run_journal)
+    external_query_handler.queue_set = (bq_query_string, bq_table_span, thread_metadata, True)
+    external_query_handler.metadata = thread_metadata
+    external_query_handler.query_string = bq_query_string
+    if external_query_handler.retrieve_data_from_cache():
+      external_query_handlers.append(external_query_handler)
+      continue
+
     """
-      Enforce concurrent rate limit and allow fine-grain controls over batch
-      mode. Aggressively batching also allows a fire-everything-and-wait
-      strategy, so we will skip the queue rate.
+      Allow fine-grain controls over batch mode. Batched jobs are limited only
+      by the total number of jobs in flight, which allows a
+      fire-everything-and-wait strategy.
     """
-    max_tables_without_batch = 2
+    max_tables_without_batch = MAX_TABLES_WITHOUT_BATCH
     if batchmode == 'all':
       is_batched_query = True
     elif batchmode == 'automatic' and bq_table_span > max_tables_without_batch:
@@ -417,39 +1037,42 @@ def process_selector_queue(selector_queue, google_auth_config,
     else:
       is_batched_query = False
 
+    job_scheduler.acquire_slot(is_batched_query)
+    bq_job_id = None
+    bq_job_submitted_time = None
     try:
-      bq_query_call = telescope.external.BigQueryCall(google_auth_config)
-      bq_job_id = bq_query_call.run_asynchronous_query(bq_query_string, batch_mode = is_batched_query)
+      with bigquery_call_pool.borrow() as bq_query_call:
+        journaled_job = run_journal.find_submitted_job(bq_query_string) if run_journal is not None else None
+        if journaled_job is not None and bq_query_call.is_job_reattachable(journaled_job[0]):
+          bq_job_id, bq_job_submitted_time = journaled_job
+          logger.info('Reattaching to job {job_id} submitted by an earlier run for {site} of {metric}.'.format(
+              job_id = bq_job_id, **thread_metadata))
+        else:
+          if thread_metadata.get('client_ranges_table') is not None:
+            bq_query_call.ensure_client_ranges_table(thread_metadata['client_ranges_table'])
+          bq_job_id = bq_query_call.run_asynchronous_query(bq_query_string, batch_mode = is_batched_query)
+          if bq_job_id is not None and run_journal is not None:
+            run_journal.record_submission(bq_query_string, bq_job_id,
+                                          '{site}, {client_provider}, {metric}, {date}, {duration}'.format(
+                                              **thread_metadata))
     except (SSLError, telescope.external.QueryFailure) as caught_error:
       logger.warn(("Caught request error {caught_error} on query, cooling " +
                     "down for a minute.").format(caught_error = caught_error))
-      selector_queue.put( (bq_query_string, bq_table_span, thread_metadata, True) )
       time.sleep(60)
       bq_job_id = None
 
     if bq_job_id is None:
-      logger.warn(("No job id returned for {site} of {metric} (concurrent threads: " +
-                    "{thread_count}).").format(thread_count = threading.activeCount(), **thread_metadata))
+      job_scheduler.release_slot(is_batched_query)
+      logger.warn("No job id returned for {site} of {metric}.".format(**thread_metadata))
       selector_queue.put( (bq_query_string, bq_table_span, thread_metadata, True) )
       continue
 
-    external_query_handler = ExternalQueryHandler()
-    external_query_handler.queue_set = (bq_query_string, bq_table_span, thread_metadata, True)
-    external_query_handler.metadata = thread_metadata
-    new_thread = threading.Thread(target=bq_query_call.monitor_query_queue,
-                                    args = (bq_job_id, thread_metadata, None,
-                                            external_query_handler.retrieve_data_upon_job_completion))
-    new_thread.daemon = True
-    new_thread.start()
-    thread_monitor.append( (new_thread, external_query_handler) )
-
-    if is_batched_query:
-      concurrent_thread_limit = MAX_THREADS_BATCH_MODE
-    else:
-      concurrent_thread_limit = MAX_THREADS_NORMAL_MODE
-    wait_to_respect_thread_limit(concurrent_thread_limit, selector_queue.qsize())
+    job_scheduler.add_job(bq_job_id, thread_metadata,
+                          external_query_handler.retrieve_data_upon_job_completion, is_batched_query,
+                          submitted_time = bq_job_submitted_time)
+    external_query_handlers.append(external_query_handler)
 
-  return thread_monitor
+  return external_query_handlers
 
 def main(args):
 
@@ -459,6 +1082,7 @@ def main(args):
   selectors = selectors_from_files(args.selector_in)
   ip_translator_factory = telescope.iptranslation.IPTranslationStrategyFactory()
   mlab_site_resolver = telescope.mlab.MLabSiteResolver()
+  pending_selectors = []
   for selector in selectors:
     thread_metadata = {
                       'date': selector.start_time.strftime('%Y-%m-%d-%H%M%S'),
@@ -467,6 +1091,8 @@ def main(args):
                       'client_provider': selector.client_provider,
                       'metric': selector.metric,
                       'mlab_project': selector.mlab_project,
+                      'output_format': telescope.outputformats.output_format_for_metric(args.outputformat,
+                                                                                        selector.metric),
                     }
     thread_metadata['data_filepath'] = build_filename('data',
                                                       args.output,
@@ -474,82 +1100,211 @@ def main(args):
                                                       thread_metadata['duration'],
                                                       thread_metadata['site'],
                                                       thread_metadata['client_provider'],
-                                                      thread_metadata['metric'])
-    if (args.ignorecache is False and
-        telescope.utils.check_for_valid_cache(thread_metadata['data_filepath']) is True):
+                                                      thread_metadata['metric'],
+                                                      thread_metadata['output_format'])
+    selector.ip_translation_spec.params['maxmind_dir'] = args.maxminddir
+    try:
+      thread_metadata['selector_key'], thread_metadata['db_snapshots'] = fingerprint_selector(
+          selector, ip_translator_factory, client_filter = args.clientfilter,
+          client_ranges_dataset = args.clientrangesdataset)
+    except (ValueError, telescope.iptranslation.MissingMaxMindError) as caught_error:
+      # Without its MaxMind snapshots the selector cannot be queried either,
+      # which is reported when its query is generated.
+      logger.warn('Could not identify the MaxMind snapshots of {data_filepath}: {error}'.format(
+          error = caught_error, **thread_metadata))
+      thread_metadata['selector_key'], thread_metadata['db_snapshots'] = None, None
+    if (args.ignorecache is False and thread_metadata['selector_key'] is not None and
+        telescope.utils.check_for_valid_cache(thread_metadata['data_filepath'],
+                                              selector_key = thread_metadata['selector_key']) is True):
       logger.info(('Raw data file found ({data_filepath}), assuming this is cached copy of same data and ' +
                    'moving off. Use --ignorecache to suppress this behavior.').format(**thread_metadata))
       continue
 
     logger.debug('Did not find existing data file: {data_filepath}'.format(**thread_metadata))
-    logger.debug(('Generating Query for subset of {site}, {client_provider}, {date}, ' +
-                  '{duration}.').format(**thread_metadata))
+    pending_selectors.append((selector, thread_metadata))
 
-    selector.ip_translation_spec.params['maxmind_dir'] = args.maxminddir
-
-    try:
-      ip_translator = ip_translator_factory.create(selector.ip_translation_spec)
-      bq_query_string, bq_table_span = generate_query(selector, ip_translator, mlab_site_resolver)
-    except MLabServerResolutionFailed as caught_error:
-      logger.error('Failed to resolve M-Lab servers: %s', caught_error)
-      # This error is fatal, so bail out here.
-      return None
-    except Exception as caught_error:
-      logger.error('Failed to generate queries: %s', caught_error)
-      continue
-
-    if args.savequery == True:
-      bigquery_filepath = build_filename('bigquery',
-                                         args.output,
-                                         thread_metadata['date'],
-                                         thread_metadata['duration'],
-                                         thread_metadata['site'],
-                                         thread_metadata['client_provider'],
-                                         thread_metadata['metric'])
-      write_bigquery_to_file(bigquery_filepath, bq_query_string)
-    if args.dryrun is False:
-      """ Offer Queue a tuple of the BQ statement, BQ table span, metadata,
-          and a boolean that indicates that the loop has not attempted to
-          run the query thus far (failed queries are pushed back to the end
-          of the loop).
-      """
-      selector_queue.put( (bq_query_string, bq_table_span, thread_metadata, False) )
+  if args.nofusion is True:
+    selector_groups = [[pending_selector] for pending_selector in pending_selectors]
+  else:
+    selector_groups = plan_fused_queries(pending_selectors)
+
+  metric_store = None
+  if args.incremental is True:
+    metric_store = telescope.metricstore.MetricStore(args.storedir)
+
+  sharded_outputs = []
+  incremental_outputs = []
+  for selector_group in selector_groups:
+    selector = selector_group[0][0]
+    member_metadata = [metadata for _, metadata in selector_group]
+    start_time = selector.start_time
+    end_time = start_time + datetime.timedelta(seconds = selector.duration)
+
+    if metric_store is not None and all(telescope.metrics_math.supports_results_array(metadata['metric'])
+                                        for metadata in member_metadata):
+      group_outputs = [(metadata['data_filepath'], metadata['output_format'], output_provenance(metadata),
+                        metric_store_key(metadata), telescope.utils.utc_datetime_to_unix_timestamp(start_time),
+                        telescope.utils.utc_datetime_to_unix_timestamp(end_time))
+                       for metadata in member_metadata]
+      query_plans = plan_incremental_queries(metric_store, member_metadata, start_time, end_time, args.shardby)
+      logger.info(('Store is missing {query_count} time slices of {site}, {client_provider}, {date}, ' +
+                   '{duration}.').format(query_count = len(query_plans), **member_metadata[0]))
+      if not query_plans:
+        # The store already covers the window, so the outputs are written
+        # without BigQuery, even on dry runs.
+        materialize_incremental_outputs(metric_store, group_outputs)
+      else:
+        incremental_outputs.extend(group_outputs)
     else:
-      logger.warn('Dry run flag caught, built query and reached the point that it would be posted, ' +
-                  'moving on.')
+      time_shards = plan_time_shards(start_time, end_time, args.shardby)
+      if time_shards is None:
+        query_plans = [(None, member_metadata)]
+      else:
+        logger.info(('Splitting {site}, {client_provider}, {date}, {duration} into {shard_count} ' +
+                     'shards by {shard_unit}.').format(shard_count = len(time_shards), shard_unit = args.shardby,
+                                                        **member_metadata[0]))
+        for metadata in member_metadata:
+          sharded_outputs.append((metadata['data_filepath'], metadata['output_format'], metadata['selector_key'],
+                                  [shard_filepath(metadata['data_filepath'], shard_index)
+                                   for shard_index in range(len(time_shards))]))
+        query_plans = []
+        for shard_index, time_window in enumerate(time_shards):
+          shard_member_metadata = [
+              shard_thread_metadata(metadata, time_window, shard_filepath(metadata['data_filepath'], shard_index))
+              for metadata in member_metadata]
+          if (args.ignorecache is False and
+              all(metadata['selector_key'] is not None and
+                  telescope.utils.check_for_valid_cache(metadata['data_filepath'],
+                                                        selector_key = metadata['selector_key'])
+                  for metadata in shard_member_metadata)):
+            logger.info('Shard data found ({data_filepath}), moving off.'.format(**shard_member_metadata[0]))
+            continue
+          query_plans.append((time_window, shard_member_metadata))
+
+    for time_window, shard_member_metadata in query_plans:
+      thread_metadata = shard_member_metadata[0]
+      if len(shard_member_metadata) > 1:
+        thread_metadata = fuse_thread_metadata(shard_member_metadata)
+        logger.debug('Fusing queries for {metric} into one query.'.format(**thread_metadata))
+
+      logger.debug(('Generating Query for subset of {site}, {client_provider}, {date}, ' +
+                    '{duration}.').format(**thread_metadata))
+
+      try:
+        ip_translator = ip_translator_factory.create(selector.ip_translation_spec, selector.start_time)
+        bq_query_string, bq_table_span, client_ranges_table, predicate_count = generate_query(
+            selector, ip_translator, mlab_site_resolver, client_filter = args.clientfilter,
+            client_ranges_dataset = args.clientrangesdataset,
+            metrics = [metadata['metric'] for metadata in shard_member_metadata],
+            time_window = time_window)
+        thread_metadata['client_ranges_table'] = client_ranges_table
+        thread_metadata['table_span'] = bq_table_span
+        thread_metadata['predicate_count'] = predicate_count
+        bq_query_hash = telescope.resultcache.query_hash(bq_query_string)
+        for metadata in shard_member_metadata:
+          metadata['query_hash'] = bq_query_hash
+      except MLabServerResolutionFailed as caught_error:
+        logger.error('Failed to resolve M-Lab servers: %s', caught_error)
+        # This error is fatal, so bail out here.
+        return None
+      except Exception as caught_error:
+        logger.error('Failed to generate queries: %s', caught_error)
+        continue
+
+      if args.savequery == True:
+        for metadata in shard_member_metadata:
+          bigquery_filepath = build_filename('bigquery',
+                                             args.output,
+                                             metadata['date'],
+                                             metadata['duration'],
+                                             metadata['site'],
+                                             metadata['client_provider'],
+                                             metadata['metric'])
+          write_bigquery_to_file(bigquery_filepath, bq_query_string)
+      if args.dryrun is False:
+        """ Offer Queue a tuple of the BQ statement, BQ table span, metadata,
+            and a boolean that indicates that the loop has not attempted to
+            run the query thus far (failed queries are pushed back to the end
+            of the loop).
+        """
+        selector_queue.put( (bq_query_string, bq_table_span, thread_metadata, False) )
+      else:
+        logger.warn('Dry run flag caught, built query and reached the point that it would be posted, ' +
+                    'moving on.')
   try:
-    if args.dryrun is False:
+    if args.dryrun is False and not selector_queue.empty():
       logger.info(("Finished processing selector files, approximately {0} queries " +
                     "to be performed.").format(selector_queue.qsize()))
       if os.path.exists(args.credentials_filepath) is False:
         logger.warn('No credentials for Google appear to exist, next step will be an authentication ' +
                     'mechanism for its API.')
 
+      google_api_scopes = [telescope.external.BIGQUERY_SCOPE]
+      if args.exportbucket:
+        google_api_scopes.append(telescope.external.CLOUD_STORAGE_SCOPE)
       try:
         google_auth_config = telescope.external.GoogleAPIAuth(
-            args.credentials_filepath, is_headless = args.noauth_local_webserver)
+            args.credentials_filepath, is_headless = args.noauth_local_webserver, scopes = google_api_scopes)
       except telescope.external.APIConfigError:
         logger.error("Could not find developer project, please create one in " +
                           "Developer Console to continue. (See README.md)")
         return None
 
+      query_result_cache = None
+      if args.querycache:
+        query_result_cache = telescope.resultcache.QueryResultCache(
+            args.querycache, args.querycachesize * 1024 * 1024)
+
+      result_export_backend = None
+      if args.exportbucket:
+        result_export_backend = telescope.external.ResultExportBackend(
+            args.exportbucket,
+            telescope.external.CloudStorageShardStore(google_auth_config.authenticate_with_google_storage),
+            row_threshold = args.exportrows)
+
+      run_journal = None
+      if args.runjournal:
+        run_journal = telescope.runjournal.RunJournal(args.runjournal)
+
+      job_duration_model = telescope.scheduler.JobDurationModel(args.jobdurations or None)
+      bigquery_call_pool = telescope.external.BigQueryCallPool(google_auth_config)
+      job_scheduler = telescope.scheduler.JobScheduler(
+          bigquery_call_pool.acquire,
+          MAX_JOBS_BATCH_MODE, MAX_JOBS_NORMAL_MODE, job_duration_model = job_duration_model)
+
       while not selector_queue.empty():
 
-        thread_monitor = process_selector_queue(selector_queue, google_auth_config, batchmode = args.batchmode)
+        external_query_handlers = process_selector_queue(selector_queue, bigquery_call_pool, job_scheduler,
+                                                         batchmode = args.batchmode,
+                                                         query_result_cache = query_result_cache,
+                                                         parallel_page_fetches = args.parallelpages,
+                                                         result_export_backend = result_export_backend,
+                                                         run_journal = run_journal)
+        job_scheduler.wait_until_idle()
 
-        for (existing_thread, external_query_handler) in thread_monitor:
-          existing_thread.join()
+        for external_query_handler in external_query_handlers:
           if external_query_handler.result != True and external_query_handler.fatal_error != True:
             selector_queue.put( external_query_handler.queue_set )
           elif external_query_handler.result != True and external_query_handler.fatal_error == True:
             logger.debug(('Fatal error on {site}, {client_provider}, {date}, ' +
-                '{duration}, moving along.').format(**thread_metadata))
+                '{duration}, moving along.').format(**external_query_handler.metadata))
           else:
             logger.debug(('Successfully retrieved {site}, {client_provider}, {date}, ' +
-                          '{duration}.').format(**thread_metadata))
+                          '{duration}.').format(**external_query_handler.metadata))
+      job_scheduler.stop()
+      if run_journal is not None:
+        run_journal.close()
+
+    if args.dryrun is False:
+      merge_time_shards(sharded_outputs)
+      if metric_store is not None:
+        materialize_incremental_outputs(metric_store, incremental_outputs)
 
   except KeyboardInterrupt:
     logger.error("Caught Interruption, Shutting Down Now.")
+    if args.runjournal:
+      logger.error(("Jobs in flight are recorded in {journal_path}; running again will reattach to " +
+                    "them rather than submitting them anew.").format(journal_path = args.runjournal))
 
   return False
 
@@ -565,7 +1320,9 @@ if __name__ == "__main__":
   parser.add_argument('-o', '--output', default='processed/',
                         help='Output file path. If the folder does not exist, it will be created.',
                         type=telescope.utils.create_directory_if_not_exists)
-  parser.add_argument('--maxminddir', default='resources/', help='MaxMind GeoLite ASN snapshot directory.')
+  parser.add_argument('--maxminddir', default='resources/',
+                        help=('MaxMind GeoLite ASN snapshot directory. Selectors without db_snapshots '
+                              'use the snapshot in it closest to their start time.'))
   parser.add_argument('--savequery', default=True, action='store_true',
                         help='Save the BigQuery statement to the [output] directory as a .sql')
   parser.add_argument('--dryrun', default=False, action='store_true',
@@ -576,6 +1333,50 @@ if __name__ == "__main__":
                         help='Authenticate to Google using another method than a local webserver')
   parser.add_argument('--batchmode', default='automatic', choices=['all', 'automatic', 'none'],
                         help='Control how batch mode is used to query BigQuery.')
+  parser.add_argument('--querycache', default='cache/',
+                        help=('Directory in which to cache raw query results, keyed by query. Set to an '
+                              'empty string to disable the cache.'))
+  parser.add_argument('--querycachesize', default=2048, type=int,
+                        help='Size in MB above which least recently used cached query results are evicted.')
+  parser.add_argument('--jobdurations', default='job_durations.json',
+                        help=('File in which to record how long BigQuery jobs take, to time status checks '
+                              'of similar jobs. Set to an empty string to not record durations.'))
+  parser.add_argument('--parallelpages', default=4, type=int,
+                        help=('Maximum number of pages of a query\'s results to download at once. Set to 1 '
+                              'to download pages one after another.'))
+  parser.add_argument('--exportbucket', default='',
+                        help=('Cloud Storage location, such as gs://bucket/telescope, to which to export '
+                              'large query results for download. Leave empty to always page through results.'))
+  parser.add_argument('--exportrows', default=2000000, type=int,
+                        help='Number of rows at and above which query results are exported when --exportbucket is set.')
+  parser.add_argument('--runjournal', default='run_journal.sqlite',
+                        help=('SQLite file in which to record the BigQuery job submitted for each query, so '
+                              'that an interrupted run reattaches to its jobs when restarted. Set to an empty '
+                              'string to not keep a journal.'))
+  parser.add_argument('--shardby', default='month', choices=['month', 'week', 'none'],
+                        help=('Split selectors spanning more than {0} monthly tables into queries over each '
+                              'month or week, run interactively and merged in time order, rather than one '
+                              'query run in batch mode.').format(MAX_TABLES_WITHOUT_BATCH))
+  parser.add_argument('--incremental', default=False, action='store_true',
+                        help=('Keep results in a local store by site, client provider and metric, query only '
+                              'the parts of each window the store does not cover yet, and write outputs from the '
+                              'store. Suits windows that are refreshed as they move forward.'))
+  parser.add_argument('--storedir', default='store/',
+                        help='Directory of the local results store used by --incremental.')
+  parser.add_argument('--outputformat', default='csv', choices=list(telescope.outputformats.OUTPUT_FORMATS),
+                        help=('Format of output data files: csv, compressed NumPy npz, columnar (row groups '
+                              'with a footer index), or fixed-width binary records of an int64 timestamp and '
+                              'a float64 result. Metrics whose results are not numbers are always written '
+                              'as csv.'))
+  parser.add_argument('--nofusion', default=False, action='store_true',
+                        help=('Run a separate query for each metric, rather than one query for all metrics '
+                              'that share a site, client provider and time window.'))
+  parser.add_argument('--clientfilter', default='inline', choices=['inline', 'join', 'automatic'],
+                        help=('Match client IP blocks with an inline predicate per range, by joining against '
+                              'an uploaded table of ranges, or by joining only for providers with more than '
+                              '{0} ranges.').format(MAX_INLINE_CLIENT_RANGES))
+  parser.add_argument('--clientrangesdataset', default='telescope',
+                        help='BigQuery dataset in your project in which to store uploaded client ranges tables.')
   parser.add_argument('--credentialspath', dest='credentials_filepath', default='bigquery_credentials.dat',
                       help='Google API Credentials. If it does not exist, will trigger Google auth.')
 
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import calendar
+import datetime
+import re
+
+import numpy
+
+# BigQuery field types held in typed arrays. All other types, including
+# STRING, are held in object arrays of the values BigQuery returned.
+_NUMPY_DTYPES = {
+    'INTEGER': numpy.int64,
+    'FLOAT': numpy.float64,
+    'TIMESTAMP': numpy.float64,
+    'BOOLEAN': numpy.bool_,
+    }
+
+
+class MeasurementColumns(object):
+  """ A batch of measurements held column by column.
+
+      Each column is a numpy masked array in which masked entries are NULL
+      values. Typed columns are decoded once, when the batch is created, so
+      that downstream code can operate on whole columns rather than converting
+      the values of each row.
+
+  """
+
+  def __init__(self, columns, field_types, length):
+    """ Creates a batch from decoded columns.
+
+        Args:
+          columns (dict): Masked arrays keyed by field name, all of the given
+            length.
+          field_types (dict): BigQuery type names keyed by field name.
+          length (int): Number of measurements in the batch.
+
+    """
+    self.columns = columns
+    self.field_types = field_types
+    self.length = length
+
+  def __len__(self):
+    return self.length
+
+  def __contains__(self, fieldname):
+    return fieldname in self.columns
+
+  def __getitem__(self, fieldname):
+    return self.columns[fieldname]
+
+  def typed_column(self, fieldname, dtype):
+    """ Returns a field as a masked array of the given numpy type.
+
+        Args:
+          fieldname (str): Name of the field.
+          dtype (type): Numpy type of the array to return.
+
+        Returns:
+          numpy.ma.MaskedArray: Values of the field, converted if the field is
+          held in an array of another type, with NULL values masked.
+
+        Raises:
+          ValueError: The batch does not have the field.
+
+    """
+    if fieldname not in self.columns:
+      raise ValueError('MissingField: ' + fieldname)
+    column = self.columns[fieldname]
+    if column.dtype != dtype:
+      null_mask = numpy.ma.getmaskarray(column)
+      column_data = numpy.ma.getdata(column)
+      if null_mask.any():
+        column_data = numpy.where(null_mask, 0, column_data)
+      column = numpy.ma.MaskedArray(column_data.astype(dtype), mask = null_mask)
+    return column
+
+  @property
+  def fieldnames(self):
+    return sorted(self.columns.keys())
+
+  def select(self, selection):
+    """ Builds a batch of a subset of the measurements.
+
+        Args:
+          selection (numpy.ndarray): Boolean mask or integer indices of the
+            measurements to keep.
+
+        Returns:
+          MeasurementColumns: Batch of the selected measurements.
+
+    """
+    selected_columns = dict((fieldname, column[selection])
+                            for fieldname, column in self.columns.iteritems())
+    if selection.dtype == numpy.bool_:
+      selected_length = int(numpy.count_nonzero(selection))
+    else:
+      selected_length = len(selection)
+    return MeasurementColumns(selected_columns, self.field_types, selected_length)
+
+  def iter_rows(self):
+    """ Converts the batch to rows.
+
+        Returns:
+          generator: Yields a dict of field name to value for each
+          measurement, with None in place of NULL values.
+
+    """
+    fieldnames = self.fieldnames
+    column_values = [self.columns[fieldname].tolist() for fieldname in fieldnames]
+    for row_values in zip(*column_values):
+      yield dict(zip(fieldnames, row_values))
+
+  @classmethod
+  def concatenate(cls, batches):
+    """ Joins batches with the same fields into a single batch. """
+    if not batches:
+      return cls({}, {}, 0)
+    columns = dict((fieldname, numpy.ma.concatenate([batch[fieldname] for batch in batches]))
+                   for fieldname in batches[0].columns)
+    return cls(columns, batches[0].field_types, sum(len(batch) for batch in batches))
+
+  @classmethod
+  def from_rows(cls, rows, field_types = None):
+    """ Builds a batch from rows of values in the form BigQuery returns them.
+
+        Args:
+          rows (list): Dicts of field name to string value or None.
+          field_types (dict): BigQuery type names keyed by field name. Fields
+            that are not listed are treated as STRING.
+
+        Returns:
+          MeasurementColumns: Batch of the rows.
+
+    """
+    field_types = field_types or {}
+    fieldnames = sorted(rows[0].keys()) if rows else sorted(field_types.keys())
+    columns = {}
+    for fieldname in fieldnames:
+      field_type = field_types.get(fieldname, 'STRING')
+      columns[fieldname] = decode_column([row[fieldname] for row in rows], field_type)
+    return cls(columns, dict((fieldname, field_types.get(fieldname, 'STRING'))
+                             for fieldname in fieldnames), len(rows))
+
+
+def column_dtype(field_type):
+  """ Numpy type of the array holding a field of the given BigQuery type, or
+      None if the field is held in an object array.
+  """
+  return _NUMPY_DTYPES.get(field_type)
+
+
+def decode_column(values, field_type):
+  """ Decodes the values of one field, as returned by BigQuery, into an array.
+
+      Args:
+        values (list): String values, or None for NULL values.
+        field_type (str): BigQuery type of the field.
+
+      Returns:
+        numpy.ma.MaskedArray: Decoded values, with NULL values masked.
+
+  """
+  null_mask = numpy.fromiter((value is None for value in values), dtype = numpy.bool_,
+                             count = len(values))
+  if field_type in _NUMPY_DTYPES:
+    if null_mask.any():
+      values = ['0' if value is None else value for value in values]
+    if field_type == 'BOOLEAN':
+      data = numpy.fromiter((value == 'true' for value in values), dtype = numpy.bool_,
+                            count = len(values))
+    else:
+      data = numpy.array(values).astype(_NUMPY_DTYPES[field_type])
+  else:
+    data = numpy.empty(len(values), dtype = object)
+    data[:] = values
+  return numpy.ma.MaskedArray(data, mask = null_mask)
+
+
+def decode_query_results_page(query_results_response):
+  """ Decodes a page of query results straight into columns.
+
+      Args:
+        query_results_response (dict): Response to a BigQuery getQueryResults
+          call.
+
+      Returns:
+        MeasurementColumns: Measurements in the page, typed according to the
+        schema of the response.
+
+  """
+  fields = query_results_response['schema']['fields']
+  results_rows = query_results_response.get('rows', [])
+  field_types = dict((field['name'], field.get('type', 'STRING')) for field in fields)
+
+  if results_rows:
+    column_values = zip(*[[result_value['v'] for result_value in results_row['f']]
+                          for results_row in results_rows])
+  else:
+    column_values = [[] for _ in fields]
+
+  columns = {}
+  for field, values in zip(fields, column_values):
+    columns[field['name']] = decode_column(list(values), field_types[field['name']])
+  return MeasurementColumns(columns, field_types, len(results_rows))
+
+
+def decode_exported_rows(exported_rows, fields):
+  """ Decodes rows of a table exported by BigQuery as newline-delimited JSON
+      into columns typed in the same way as query results.
+
+      Args:
+        exported_rows (list): Dicts of field name to JSON value, each parsed
+          from one line of an export. Fields with NULL values are omitted.
+        fields (list): Schema fields of the exported table, each a dict with a
+          name and a type.
+
+      Returns:
+        MeasurementColumns: Measurements in the rows.
+
+  """
+  field_types = dict((field['name'], field.get('type', 'STRING')) for field in fields)
+  columns = {}
+  for fieldname, field_type in field_types.iteritems():
+    columns[fieldname] = decode_column(
+        [_exported_value_text(exported_row.get(fieldname), field_type) for exported_row in exported_rows],
+        field_type)
+  return MeasurementColumns(columns, field_types, len(exported_rows))
+
+
+_EXPORTED_TIMESTAMP_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(\.\d+)?( UTC|Z)?$')
+
+
+def _exported_value_text(value, field_type):
+  """ Converts a JSON value of an export to the text in which query results
+      express the same value.
+  """
+  if value is None:
+    return None
+  if field_type == 'BOOLEAN':
+    if isinstance(value, bool):
+      return 'true' if value else 'false'
+    return value.lower()
+  if field_type == 'TIMESTAMP' and isinstance(value, basestring):
+    timestamp_match = _EXPORTED_TIMESTAMP_PATTERN.match(value)
+    if timestamp_match is not None:
+      timestamp = datetime.datetime.strptime(' '.join(timestamp_match.group(1, 2)), '%Y-%m-%d %H:%M:%S')
+      return repr(calendar.timegm(timestamp.timetuple()) + float(timestamp_match.group(3) or 0))
+    return value
+  if isinstance(value, float):
+    return repr(value)
+  if field_type in _NUMPY_DTYPES:
+    return str(value)
+  return value
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import numpy
+
+import columns
+
+
+class DecodeQueryResultsPageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.query_results_response = {
+        'schema': {'fields': [
+            {'name': 'web100_log_entry_log_time', 'type': 'INTEGER'},
+            {'name': 'web100_log_entry_snap_MinRTT', 'type': 'FLOAT'},
+            {'name': 'connection_spec_client_ip', 'type': 'STRING'},
+            {'name': 'web100_log_entry_is_last_entry', 'type': 'BOOLEAN'},
+            ]},
+        'rows': [
+            {'f': [{'v': '1392247312'}, {'v': '12.5'}, {'v': '10.0.0.1'}, {'v': 'true'}]},
+            {'f': [{'v': '1392247313'}, {'v': None}, {'v': None}, {'v': 'false'}]},
+            ],
+        }
+
+  def test_columns_are_typed_by_schema(self):
+    measurements = columns.decode_query_results_page(self.query_results_response)
+    self.assertEqual(2, len(measurements))
+    self.assertEqual(numpy.int64, measurements['web100_log_entry_log_time'].dtype)
+    self.assertEqual(numpy.float64, measurements['web100_log_entry_snap_MinRTT'].dtype)
+    self.assertEqual(numpy.bool_, measurements['web100_log_entry_is_last_entry'].dtype)
+    self.assertListEqual([1392247312, 1392247313], measurements['web100_log_entry_log_time'].tolist())
+    self.assertListEqual([True, False], measurements['web100_log_entry_is_last_entry'].tolist())
+
+  def test_null_values_are_masked(self):
+    measurements = columns.decode_query_results_page(self.query_results_response)
+    self.assertListEqual([False, True], numpy.ma.getmaskarray(measurements['web100_log_entry_snap_MinRTT']).tolist())
+    self.assertListEqual(['10.0.0.1', None], measurements['connection_spec_client_ip'].tolist())
+
+  def test_empty_page(self):
+    del self.query_results_response['rows']
+    measurements = columns.decode_query_results_page(self.query_results_response)
+    self.assertEqual(0, len(measurements))
+    self.assertEqual(numpy.int64, measurements['web100_log_entry_log_time'].dtype)
+
+  def test_select_and_iter_rows(self):
+    measurements = columns.decode_query_results_page(self.query_results_response)
+    selected = measurements.select(numpy.array([False, True]))
+    self.assertEqual(1, len(selected))
+    self.assertListEqual([{'web100_log_entry_log_time': 1392247313,
+                           'web100_log_entry_snap_MinRTT': None,
+                           'connection_spec_client_ip': None,
+                           'web100_log_entry_is_last_entry': False}], list(selected.iter_rows()))
+
+  def test_concatenate(self):
+    measurements = columns.decode_query_results_page(self.query_results_response)
+    joined = columns.MeasurementColumns.concatenate([measurements, measurements.select(numpy.array([0]))])
+    self.assertEqual(3, len(joined))
+    self.assertListEqual([12.5, None, 12.5], joined['web100_log_entry_snap_MinRTT'].tolist())
+
+
+class DecodeExportedRowsTest(unittest.TestCase):
+
+  def test_exported_rows_match_query_results(self):
+    fields = [{'name': 'web100_log_entry_log_time', 'type': 'INTEGER'},
+              {'name': 'web100_log_entry_snap_MinRTT', 'type': 'FLOAT'},
+              {'name': 'connection_spec_client_ip', 'type': 'STRING'},
+              {'name': 'web100_log_entry_is_last_entry', 'type': 'BOOLEAN'}]
+    exported_rows = [{'web100_log_entry_log_time': '1392247312', 'web100_log_entry_snap_MinRTT': 12.5,
+                      'connection_spec_client_ip': '10.0.0.1', 'web100_log_entry_is_last_entry': True},
+                     {'web100_log_entry_log_time': 1392247313, 'web100_log_entry_is_last_entry': 'false'}]
+    query_results_response = {
+        'schema': {'fields': fields},
+        'rows': [{'f': [{'v': '1392247312'}, {'v': '12.5'}, {'v': '10.0.0.1'}, {'v': 'true'}]},
+                 {'f': [{'v': '1392247313'}, {'v': None}, {'v': None}, {'v': 'false'}]}]}
+
+    exported = columns.decode_exported_rows(exported_rows, fields)
+    queried = columns.decode_query_results_page(query_results_response)
+    self.assertListEqual(list(queried.iter_rows()), list(exported.iter_rows()))
+    self.assertEqual(numpy.int64, exported['web100_log_entry_log_time'].dtype)
+
+  def test_timestamps_become_epoch_seconds(self):
+    fields = [{'name': 'log_time', 'type': 'TIMESTAMP'}]
+    exported = columns.decode_exported_rows([{'log_time': '2014-02-12 23:21:52.5 UTC'},
+                                             {'log_time': '1392247312.0'}], fields)
+    self.assertListEqual([1392247312.5, 1392247312.0], exported['log_time'].tolist())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,15 +16,26 @@
 # limitations under the License.
 
 
+import contextlib
+import gzip
 import httplib2
+import io
+import json
 import logging
-import datetime
+import os
+import Queue
+import shutil
+import tempfile
+import threading
 import time
 
 from ssl import SSLError
 
-from apiclient.discovery import build
+from apiclient.discovery import DISCOVERY_URI
+from apiclient.discovery import build_from_document
 from apiclient.errors import HttpError
+from apiclient.http import MediaIoBaseDownload
+from apiclient.http import MediaIoBaseUpload
 from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import flow_from_clientsecrets
@@ -33,6 +44,24 @@ from oauth2client.tools import run_flow
 
 from httplib import ResponseNotReady
 
+import columns
+import scheduler
+
+BIGQUERY_SCOPE = 'https://www.googleapis.com/auth/bigquery'
+CLOUD_STORAGE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+
+# Results of a query job are kept in an anonymous table for about a day after
+# the job completes.
+QUERY_RESULTS_LIFETIME_SECONDS = 23 * 60 * 60
+
+# Longest time to wait for the upload of a client ranges table, after which
+# the queries that need it are retried later.
+CLIENT_RANGES_LOAD_TIMEOUT_SECONDS = 10 * 60
+
+# Longest time to wait for the export of a job's results to Cloud Storage,
+# after which retrieval of the results fails and is retried later.
+EXPORT_TIMEOUT_SECONDS = 30 * 60
+
 class QueryFailure(Exception):
   def __init__(self, http_code, caught_error):
     self.code = http_code
@@ -60,9 +89,13 @@ class GoogleAPIAuthConfig:
 
 class GoogleAPIAuth:
 
-  def __init__(self, credentials_filepath, is_headless = False):
+  def __init__(self, credentials_filepath, is_headless = False, scopes = (BIGQUERY_SCOPE,)):
     self.logger = logging.getLogger('telescope')
     self.credentials_filepath = credentials_filepath
+    self.scopes = list(scopes)
+    self._credentials = None
+    self._discovery_documents = {}
+    self._lock = threading.Lock()
     self._set_headless_mode(is_headless)
     self.project_id = self._find_project_id_opportunistically()
 
@@ -70,20 +103,54 @@ class GoogleAPIAuth:
     GoogleAPIAuthConfig.noauth_local_webserver = is_headless
 
   def authenticate_with_google(self):
-
-    flow = flow_from_clientsecrets('client_secrets.json',
-                                   scope='https://www.googleapis.com/auth/bigquery')
-    storage = Storage(self.credentials_filepath)
-    credentials = storage.get()
-
-    http = httplib2.Http()
-    if credentials is None or credentials.invalid:
-      credentials = run_flow(flow= flow, storage=storage, flags= GoogleAPIAuthConfig, http=http)
-      self.logger.info("Successfully authenticated with Google, moving on to building query.")
-
-    http = credentials.authorize(http)
-
-    return build('bigquery', 'v2', http=http)
+    """ Builds an authorized BigQuery service with its own HTTP connection.
+
+        Credentials and the API's discovery document are loaded once and
+        shared by every service built, so building a service makes no
+        requests. Services are not thread-safe, so each thread needs its own.
+
+        Returns:
+          (apiclient.discovery.Resource): BigQuery v2 service.
+    """
+    return self._build_service('bigquery', 'v2')
+
+  def authenticate_with_google_storage(self):
+    """ Builds an authorized Cloud Storage service with its own HTTP
+        connection, in the same way as authenticate_with_google. Requires the
+        Cloud Storage scope.
+
+        Returns:
+          (apiclient.discovery.Resource): Cloud Storage v1 service.
+    """
+    return self._build_service('storage', 'v1')
+
+  def _build_service(self, api_name, api_version):
+    credentials = self._get_credentials()
+    http = credentials.authorize(httplib2.Http())
+    return build_from_document(self._get_discovery_document(http, api_name, api_version), http=http)
+
+  def _get_credentials(self):
+    with self._lock:
+      if self._credentials is None or self._credentials.invalid:
+        flow = flow_from_clientsecrets('client_secrets.json', scope=self.scopes)
+        storage = Storage(self.credentials_filepath)
+        credentials = storage.get()
+
+        if credentials is None or credentials.invalid or not credentials.has_scopes(self.scopes):
+          credentials = run_flow(flow= flow, storage=storage, flags= GoogleAPIAuthConfig, http=httplib2.Http())
+          self.logger.info("Successfully authenticated with Google, moving on to building query.")
+        self._credentials = credentials
+      return self._credentials
+
+  def _get_discovery_document(self, http, api_name, api_version):
+    with self._lock:
+      if (api_name, api_version) not in self._discovery_documents:
+        discovery_uri = DISCOVERY_URI.format(api = api_name, apiVersion = api_version)
+        response, content = http.request(discovery_uri)
+        if response.status >= 400:
+          raise HttpError(response, content, uri = discovery_uri)
+        self._discovery_documents[(api_name, api_version)] = content
+      return self._discovery_documents[(api_name, api_version)]
 
   def _find_project_id_opportunistically(self):
 
@@ -98,8 +165,47 @@ class GoogleAPIAuth:
 
     return project_numeric_id
 
+class BigQueryCallPool(object):
+  """ Thread-safe pool of BigQueryCall objects, so that jobs reuse
+      authorized services and their open HTTP connections rather than
+      authenticating anew.
+  """
+
+  def __init__(self, google_auth_config):
+    self._google_auth_config = google_auth_config
+    self._idle_calls = []
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """ Takes an idle BigQueryCall from the pool, creating one if none is
+        idle. Until it is released, no other caller uses it.
+    """
+    with self._lock:
+      if self._idle_calls:
+        return self._idle_calls.pop()
+    return BigQueryCall(self._google_auth_config)
+
+  def release(self, bigquery_call):
+    """ Returns a BigQueryCall taken with acquire to the pool. """
+    with self._lock:
+      self._idle_calls.append(bigquery_call)
+
+  @contextlib.contextmanager
+  def borrow(self):
+    """ Context manager that acquires a BigQueryCall and releases it on exit. """
+    bigquery_call = self.acquire()
+    try:
+      yield bigquery_call
+    finally:
+      self.release(bigquery_call)
+
 class BigQueryCall:
 
+  # Client ranges tables known to exist, shared across calls since the tables
+  # are content-addressed and never change once uploaded.
+  _existing_client_ranges_tables = set()
+  _existing_client_ranges_tables_lock = threading.Lock()
+
   def __init__(self, google_auth_config):
 
     self.logger = logging.getLogger('telescope')
@@ -113,42 +219,135 @@ class BigQueryCall:
     return None
 
   def retrieve_job_data(self, job_id, timeout = 0):
-    max_results_per_get = 100000
     job_data_to_return = []
-    job_collection = self.authenticated_service.jobs()
+    for job_data_page in self.iter_job_data_pages(job_id, timeout):
+      job_data_to_return.extend(job_data_page)
+    return job_data_to_return
 
-    query_request = {'projectId': self.project_id,
-                      'jobId': job_id,
-                      'maxResults':  max_results_per_get,
-                      'timeoutMs': timeout}
+  def iter_job_data_pages(self, job_id, timeout = 0, max_results_per_get = 100000):
+    """ Retrieves the results of a completed job one page at a time.
+
+        Each page is requested only once the previous page has been consumed,
+        so callers that process pages as they arrive hold a single page in
+        memory at a time.
+
+        Args:
+          job_id (str): ID of job for which to retrieve data.
+
+          timeout (int): Milliseconds to wait for the job to complete.
+
+          max_results_per_get (int): Maximum number of rows in each page.
+
+        Returns:
+          (generator): Yields lists of rows, each a dict of field name to
+          value.
+    """
+    for query_results_response in self._iter_query_results_responses(job_id, timeout, max_results_per_get):
+      fieldnames = [field['name'] for field in query_results_response['schema']['fields']]
+      yield [dict(zip(fieldnames, [result_value['v'] for result_value in results_row['f']]))
+             for results_row in query_results_response.get('rows', [])]
+
+  def iter_job_column_pages(self, job_id, timeout = 0, max_results_per_get = 100000,
+                            bigquery_call_pool = None, parallel_page_fetches = 1, ordered = True,
+                            result_export_backend = None):
+    """ Retrieves the results of a completed job one page at a time, decoding
+        each page into typed columns according to the result schema.
+
+        Args:
+          job_id (str): ID of job for which to retrieve data.
+
+          timeout (int): Milliseconds to wait for the job to complete.
+
+          max_results_per_get (int): Maximum number of rows in each page.
+
+          bigquery_call_pool (BigQueryCallPool): Pool from which to borrow
+            connections to fetch pages in parallel, or None to follow page
+            tokens in sequence.
+
+          parallel_page_fetches (int): Maximum number of pages to fetch at
+            once when a pool is given.
+
+          ordered (bool): Whether to yield pages in the order of the results.
+            When False, pages are yielded as soon as they are fetched, which is
+            suitable for callers that do not depend on the order of rows.
+
+          result_export_backend (ResultExportBackend): Backend through which
+            to retrieve results that are too large to page through, or None to
+            always page. Exports are unordered, so the backend is only used if
+            ordered is False.
+
+        Returns:
+          (generator): Yields a telescope.columns.MeasurementColumns for each
+          page.
+
+        Notes:
+          In parallel mode, the first page is fetched on this call's own
+          connection to learn the total number of rows, then the remaining
+          pages are requested by row offset. At most parallel_page_fetches
+          pages are fetched or held undelivered at any time, which bounds the
+          memory used when pages arrive faster than they are consumed.
+    """
+    if result_export_backend is not None and not ordered:
+      results_summary = self._get_query_results(job_id, {'projectId': self.project_id,
+                                                         'jobId': job_id,
+                                                         'maxResults': 0,
+                                                         'timeoutMs': timeout})
+      if result_export_backend.should_export(int(results_summary['totalRows'])):
+        for measurement_columns in result_export_backend.iter_job_column_pages(
+            self, job_id, results_summary['schema']['fields']):
+          yield measurement_columns
+        return
+
+    if bigquery_call_pool is None or parallel_page_fetches <= 1:
+      for query_results_response in self._iter_query_results_responses(job_id, timeout, max_results_per_get):
+        yield columns.decode_query_results_page(query_results_response)
+      return
+
+    first_response = self._get_query_results(job_id, {'projectId': self.project_id,
+                                                      'jobId': job_id,
+                                                      'maxResults': max_results_per_get,
+                                                      'timeoutMs': timeout})
+    total_rows = int(first_response['totalRows'])
+    if total_rows == 0:
+      self.logger.warn('BigQuery Report Job Completed, but no rows found.')
+      return
+    first_page_rows = len(first_response.get('rows', []))
+    yield columns.decode_query_results_page(first_response)
+    if first_page_rows == 0 or first_page_rows >= total_rows:
+      return
+
+    page_fetcher = _ParallelPageFetcher(bigquery_call_pool, job_id, first_page_rows, total_rows,
+                                        max_results_per_get, parallel_page_fetches)
+    try:
+      for measurement_columns in page_fetcher.iter_pages(ordered):
+        yield measurement_columns
+    finally:
+      page_fetcher.stop()
+    self.logger.debug("Complete, found {count} in parallel.".format(count = total_rows))
 
+  def _get_query_results(self, job_id, query_request):
+    """ Makes a getQueryResults request, retrying errors that could be
+        temporary.
+
+        Args:
+          job_id (str): ID of job for which to retrieve data.
+
+          query_request (dict): Arguments of the getQueryResults request.
+
+        Returns:
+          (dict): Response of the completed request.
+
+        Raises:
+          TableDoesNotExist: The job refers to tables that do not exist.
+          QueryFailure: BigQuery refused the request.
+    """
+    job_collection = self.authenticated_service.jobs()
     while True:
       try:
         query_results_response = job_collection.getQueryResults(**query_request).execute()
 
         assert query_results_response['jobComplete'] == True, 'IncompleteBigQuery'
-
-        if int(query_results_response['totalRows']) == 0:
-          self.logger.warn('BigQuery Report Job Completed, but no rows found. This ' +
-                            'is likely due to no data being present for site, ' +
-                            'client and time combination. Believing that, I will ' +
-                            'produce an empty file. The life of measurement is ' +
-                            'solitary, poor, nasty, brutish, and short.')
-          break
-        else:
-          fieldnames = [field['name'] for field in query_results_response['schema']['fields']]
-
-          for results_row in query_results_response['rows']:
-            new_results_row = dict(zip(fieldnames, [result_value['v'] for result_value in results_row['f']]))
-            job_data_to_return.append(new_results_row)
-
-          if query_results_response.has_key('pageToken'):
-            query_request['pageToken'] = query_results_response['pageToken']
-            self.logger.debug("Large result, have found {count} iterating with new page token.".format(
-                count = len(job_data_to_return)))
-          else:
-            self.logger.debug("Complete, found {count}.".format(count = len(job_data_to_return)))
-            break
+        return query_results_response
       except (SSLError, HttpError, ResponseNotReady) as caught_error:
         if caught_error.resp.status == 404:
           raise TableDoesNotExist()
@@ -167,7 +366,201 @@ class BigQueryCall:
                                                       notification_identifier = job_id))
 
           time.sleep(10)
-    return job_data_to_return
+
+  def _iter_query_results_responses(self, job_id, timeout, max_results_per_get):
+    rows_retrieved = 0
+
+    query_request = {'projectId': self.project_id,
+                      'jobId': job_id,
+                      'maxResults':  max_results_per_get,
+                      'timeoutMs': timeout}
+
+    while True:
+      query_results_response = self._get_query_results(job_id, query_request)
+
+      if int(query_results_response['totalRows']) == 0:
+        self.logger.warn('BigQuery Report Job Completed, but no rows found. This ' +
+                          'is likely due to no data being present for site, ' +
+                          'client and time combination. Believing that, I will ' +
+                          'produce an empty file. The life of measurement is ' +
+                          'solitary, poor, nasty, brutish, and short.')
+        break
+
+      rows_retrieved += len(query_results_response.get('rows', []))
+      yield query_results_response
+
+      if query_results_response.has_key('pageToken'):
+        query_request['pageToken'] = query_results_response['pageToken']
+        self.logger.debug("Large result, have found {count} iterating with new page token.".format(
+            count = rows_retrieved))
+      else:
+        self.logger.debug("Complete, found {count}.".format(count = rows_retrieved))
+        break
+
+  def extract_job_results(self, job_id, destination_uri_pattern, export_timeout_seconds = EXPORT_TIMEOUT_SECONDS,
+                          export_poll_schedule = None):
+    """ Exports the results of a completed query job to Cloud Storage as
+        gzipped, newline-delimited JSON shards, and waits for the export to
+        complete.
+
+        Args:
+          job_id (str): ID of the query job whose results to export.
+
+          destination_uri_pattern (str): Cloud Storage URI of the shards, with
+          a single '*' in place of the shard number.
+
+          export_timeout_seconds (float): Longest time to wait for the export
+          job to complete.
+
+          export_poll_schedule (telescope.scheduler.AdaptivePollSchedule):
+          Schedule of status checks of the export job. Defaults to the default
+          AdaptivePollSchedule.
+
+        Returns:
+          (list): Cloud Storage URIs of the shards written.
+
+        Raises:
+          QueryFailure: The export could not be started or failed, or did not
+          complete within export_timeout_seconds.
+    """
+    job_collection = self.authenticated_service.jobs()
+    try:
+      query_job = job_collection.get(projectId = self.project_id, jobId = job_id).execute()
+      extract_definition = {'configuration': {'extract': {
+          'sourceTable': query_job['configuration']['query']['destinationTable'],
+          'destinationUris': [destination_uri_pattern],
+          'destinationFormat': 'NEWLINE_DELIMITED_JSON',
+          'compression': 'GZIP'}}}
+      extract_job_id = job_collection.insert(projectId = self.project_id,
+                                             body = extract_definition).execute()['jobReference']['jobId']
+
+      export_poll_schedule = export_poll_schedule or scheduler.AdaptivePollSchedule()
+      extract_scheduled_job = scheduler.ScheduledJob(extract_job_id, {}, None, False)
+      export_deadline = extract_scheduled_job.submitted_time + export_timeout_seconds
+      while True:
+        extract_job = job_collection.get(projectId = self.project_id, jobId = extract_job_id).execute()
+        if extract_job['status']['state'] == 'DONE':
+          break
+        now = time.time()
+        if now >= export_deadline:
+          raise QueryFailure(None, 'Export of the results of {job_id} (job {extract_job_id}) did not complete '
+                             'within {timeout} seconds.'.format(job_id = job_id, extract_job_id = extract_job_id,
+                                                                timeout = export_timeout_seconds))
+        time.sleep(min(export_poll_schedule.next_delay(extract_scheduled_job, now), export_deadline - now))
+    except (SSLError, HttpError, ResponseNotReady) as caught_error:
+      raise QueryFailure(getattr(getattr(caught_error, 'resp', None), 'status', None), caught_error)
+
+    if 'errorResult' in extract_job['status']:
+      raise QueryFailure(None, extract_job['status']['errorResult'].get('message'))
+    shard_count = int(extract_job['statistics']['extract']['destinationUriFileCounts'][0])
+    self.logger.debug('Exported results of {job_id} to {shard_count} shards.'.format(
+        job_id = job_id, shard_count = shard_count))
+    return [destination_uri_pattern.replace('*', '%012d' % shard_number)
+            for shard_number in xrange(shard_count)]
+
+  def ensure_client_ranges_table(self, client_ranges_table, load_timeout_seconds = CLIENT_RANGES_LOAD_TIMEOUT_SECONDS,
+                                 load_poll_schedule = None):
+    """ Makes sure that a client ranges table exists in the project, uploading
+        it if it does not.
+
+        Args:
+          client_ranges_table (telescope.query.ClientRangesTable): Table to
+          upload.
+
+          load_timeout_seconds (float): Longest time to wait for the upload
+          job to complete.
+
+          load_poll_schedule (telescope.scheduler.AdaptivePollSchedule):
+          Schedule of status checks of the upload job. Defaults to the default
+          AdaptivePollSchedule.
+
+        Returns:
+          (bool) True if the table was uploaded, False if it already existed.
+
+        Raises:
+          QueryFailure: The table could not be checked or uploaded, or the
+          upload job did not complete within load_timeout_seconds.
+    """
+    table_key = (self.project_id, client_ranges_table.dataset_id, client_ranges_table.table_id)
+    with BigQueryCall._existing_client_ranges_tables_lock:
+      if table_key in BigQueryCall._existing_client_ranges_tables:
+        return False
+
+    try:
+      if self._does_table_exist(client_ranges_table.dataset_id, client_ranges_table.table_id):
+        was_uploaded = False
+      else:
+        self._create_dataset_if_not_exists(client_ranges_table.dataset_id)
+        self._load_client_ranges_table(client_ranges_table, load_timeout_seconds,
+                                       load_poll_schedule or scheduler.AdaptivePollSchedule())
+        was_uploaded = True
+    except HttpError as caught_error:
+      raise QueryFailure(caught_error.resp.status, caught_error)
+    except (SSLError, ResponseNotReady, httplib2.ServerNotFoundError) as caught_error:
+      raise QueryFailure(None, caught_error)
+
+    with BigQueryCall._existing_client_ranges_tables_lock:
+      BigQueryCall._existing_client_ranges_tables.add(table_key)
+    return was_uploaded
+
+  def _does_table_exist(self, dataset_id, table_id):
+    try:
+      self.authenticated_service.tables().get(projectId = self.project_id, datasetId = dataset_id,
+                                              tableId = table_id).execute()
+      return True
+    except HttpError as caught_error:
+      if caught_error.resp.status == 404:
+        return False
+      raise
+
+  def _create_dataset_if_not_exists(self, dataset_id):
+    dataset_collection = self.authenticated_service.datasets()
+    try:
+      dataset_collection.get(projectId = self.project_id, datasetId = dataset_id).execute()
+    except HttpError as caught_error:
+      if caught_error.resp.status != 404:
+        raise
+      dataset_definition = {'datasetReference': {'projectId': self.project_id, 'datasetId': dataset_id}}
+      try:
+        dataset_collection.insert(projectId = self.project_id, body = dataset_definition).execute()
+      except HttpError as caught_error:
+        # Another thread may have created it in the meantime.
+        if caught_error.resp.status != 409:
+          raise
+
+  def _load_client_ranges_table(self, client_ranges_table, load_timeout_seconds, load_poll_schedule):
+    rows_data = ''.join(json.dumps(row) + '\n' for row in client_ranges_table.rows())
+    job_definition = {'configuration': {'load': {
+        'destinationTable': {'projectId': self.project_id,
+                             'datasetId': client_ranges_table.dataset_id,
+                             'tableId': client_ranges_table.table_id},
+        'schema': {'fields': client_ranges_table.schema},
+        'sourceFormat': 'NEWLINE_DELIMITED_JSON',
+        'writeDisposition': 'WRITE_TRUNCATE'}}}
+    media_body = MediaIoBaseUpload(io.BytesIO(rows_data), mimetype = 'application/octet-stream')
+
+    job_collection = self.authenticated_service.jobs()
+    job_collection_insert = job_collection.insert(projectId = self.project_id, body = job_definition,
+                                                  media_body = media_body).execute()
+    job_id = job_collection_insert['jobReference']['jobId']
+    self.logger.info('Uploading client ranges table {table_id} ({range_count} ranges), job id: {job_id}'.format(
+        table_id = client_ranges_table.table_id, range_count = len(client_ranges_table.ip_ranges),
+        job_id = job_id))
+
+    load_job = scheduler.ScheduledJob(job_id, {}, None, False)
+    load_deadline = load_job.submitted_time + load_timeout_seconds
+    while True:
+      job_collection_state = job_collection.get(projectId = self.project_id, jobId = job_id).execute()
+      if job_collection_state['status']['state'] == 'DONE':
+        break
+      now = time.time()
+      if now >= load_deadline:
+        raise QueryFailure(None, 'Upload of client ranges table {table_id} (job {job_id}) did not complete '
+                           'within {timeout} seconds.'.format(table_id = client_ranges_table.table_id,
+                                                              job_id = job_id, timeout = load_timeout_seconds))
+      time.sleep(min(load_poll_schedule.next_delay(load_job, now), load_deadline - now))
+    if 'errorResult' in job_collection_state['status']:
+      raise QueryFailure(None, job_collection_state['status']['errorResult'].get('message'))
 
   def run_asynchronous_query(self, query_string, batch_mode = False):
     job_reference_id = None
@@ -194,46 +587,417 @@ class BigQueryCall:
 
     return job_reference_id
 
-  def monitor_query_queue(self, job_id, job_metadata, query_object = None, callback_function = None):
+  def get_job_status(self, job_id):
+    """ Retrieves the status of a job.
+
+        Args:
+          job_id (str): ID of the job.
 
-    query_object = query_object or self
+        Returns:
+          (dict): The job's status, whose 'state' is PENDING, RUNNING or DONE.
+    """
+    job_collection = self.authenticated_service.jobs()
+    return job_collection.get(projectId = self.project_id, jobId = job_id).execute()['status']
+
+  def is_job_reattachable(self, job_id, max_result_age_seconds = QUERY_RESULTS_LIFETIME_SECONDS):
+    """ Checks whether a previously submitted job can be waited on again
+        instead of submitting its query anew.
 
-    if self.project_id is not None:
-      started_checking = datetime.datetime.utcnow()
+        Args:
+          job_id (str): ID of the job.
 
-      notification_identifier = "{metric}, {site}, {client_provider}, {date}, {duration}".format(**job_metadata)
-      self.logger.info('Queued request for {notification_identifier}, received job id: {job_id}'.format(
-          notification_identifier = notification_identifier, job_id = job_id))
+          max_result_age_seconds (int): Time since the job completed after
+          which its results are assumed to have expired.
 
+        Returns:
+          (bool): True if the job is pending or running, or completed
+          successfully recently enough that its results are still available.
+    """
+    job_collection = self.authenticated_service.jobs()
+    try:
+      job = job_collection.get(projectId = self.project_id, jobId = job_id).execute()
+    except (SSLError, HttpError, ResponseNotReady, httplib2.ServerNotFoundError) as caught_error:
+      self.logger.warn('Could not retrieve job {job_id} to reattach to it: {caught_error}'.format(
+          job_id = job_id, caught_error = caught_error))
+      return False
+
+    job_status = job['status']
+    if job_status['state'] in ('PENDING', 'RUNNING'):
+      return True
+    if job_status['state'] != 'DONE' or 'errorResult' in job_status:
+      return False
+    job_end_time = int(job.get('statistics', {}).get('endTime', 0)) / 1000.0
+    return time.time() - job_end_time < max_result_age_seconds
+
+  def get_job_states(self, job_ids, max_results_per_list = 1000, max_list_pages = 2):
+    """ Retrieves the states of many jobs at once by listing the project's
+        most recent jobs, rather than retrieving each job.
+
+        Args:
+          job_ids (list): IDs of the jobs.
+
+          max_results_per_list (int): Maximum number of jobs in each page of
+          the job list.
+
+          max_list_pages (int): Maximum number of pages of the job list to
+          read. Jobs that do not appear in them, such as jobs that are too new
+          to be listed yet, are retrieved one by one.
+
+        Returns:
+          (dict): State of each job, PENDING, RUNNING or DONE, keyed by job ID.
+    """
+    job_summaries = self.get_job_summaries(job_ids, max_results_per_list, max_list_pages)
+    return dict((job_id, job_summary['state']) for job_id, job_summary in job_summaries.iteritems())
+
+  def get_job_summaries(self, job_ids, max_results_per_list = 1000, max_list_pages = 2):
+    """ Retrieves the states and run times of many jobs at once, in the same
+        way as get_job_states.
+
+        Returns:
+          (dict): Dicts keyed by job ID, each with the job's 'state' and its
+          'runtime_seconds', the time BigQuery took from the job's creation to
+          its completion, or None if the job has not completed.
+    """
+    job_collection = self.authenticated_service.jobs()
+    remaining_job_ids = set(job_ids)
+    job_summaries = {}
+
+    list_request = {'projectId': self.project_id,
+                    'projection': 'minimal',
+                    'maxResults': max_results_per_list}
+    list_pages_read = 0
+    while remaining_job_ids and list_pages_read < max_list_pages:
+      jobs_list = job_collection.list(**list_request).execute()
+      list_pages_read += 1
+      for listed_job in jobs_list.get('jobs', []):
+        listed_job_id = listed_job['jobReference']['jobId']
+        if listed_job_id in remaining_job_ids:
+          job_summaries[listed_job_id] = {
+              'state': listed_job['state'],
+              'runtime_seconds': _job_runtime_seconds(listed_job.get('statistics', {}))}
+          remaining_job_ids.remove(listed_job_id)
+      if not jobs_list.has_key('nextPageToken'):
+        break
+      list_request['pageToken'] = jobs_list['nextPageToken']
+
+    for job_id in remaining_job_ids:
+      job = job_collection.get(projectId = self.project_id, jobId = job_id).execute()
+      job_summaries[job_id] = {'state': job['status']['state'],
+                               'runtime_seconds': _job_runtime_seconds(job.get('statistics', {}))}
+    return job_summaries
+
+def _job_runtime_seconds(job_statistics):
+  """ Time in seconds BigQuery took to run a job, from its creation to its
+      completion, or None if the job has not completed.
+  """
+  if 'creationTime' not in job_statistics or 'endTime' not in job_statistics:
+    return None
+  return (int(job_statistics['endTime']) - int(job_statistics['creationTime'])) / 1000.0
+
+class _ParallelPageFetcher(object):
+  """ Fetches the pages of a job's results by row offset on a bounded set of
+      worker threads, each with a connection borrowed from a pool.
+  """
+
+  def __init__(self, bigquery_call_pool, job_id, first_start_index, total_rows,
+               rows_per_page, max_parallel_fetches):
+    self.logger = logging.getLogger('telescope')
+    self._bigquery_call_pool = bigquery_call_pool
+    self._job_id = job_id
+    self._first_start_index = first_start_index
+    self._total_rows = total_rows
+    self._rows_per_page = rows_per_page
+    self._start_indices = Queue.Queue()
+    for start_index in xrange(first_start_index, total_rows, rows_per_page):
+      self._start_indices.put(start_index)
+    self._page_count = self._start_indices.qsize()
+    # A worker takes a slot before it takes a page to fetch, and the slot is
+    # returned once the page is delivered, so that the pages in flight are
+    # always the earliest undelivered ones and ordered delivery cannot stall.
+    self._max_parallel_fetches = max_parallel_fetches
+    self._page_slots = threading.Semaphore(max_parallel_fetches)
+    self._fetched_pages = Queue.Queue()
+    self._stopped = threading.Event()
+
+    for _ in xrange(min(max_parallel_fetches, self._page_count)):
+      worker_thread = threading.Thread(target = self._fetch_pages)
+      worker_thread.daemon = True
+      worker_thread.start()
+
+  def iter_pages(self, ordered):
+    """ Yields a telescope.columns.MeasurementColumns for each page, in the
+        order of the results if ordered is True, otherwise as pages arrive.
+        Raises the first error encountered by a worker.
+    """
+    next_start_index = self._first_start_index
+    undelivered_pages = {}
+    for _ in xrange(self._page_count):
+      start_index, measurement_columns, caught_error = self._next_fetched_page()
+      if caught_error is not None:
+        raise caught_error
+      if not ordered:
+        yield measurement_columns
+        self._page_slots.release()
+        continue
+
+      undelivered_pages[start_index] = measurement_columns
+      while next_start_index in undelivered_pages:
+        yield undelivered_pages.pop(next_start_index)
+        self._page_slots.release()
+        next_start_index += self._rows_per_page
+
+  def stop(self):
+    """ Stops workers from fetching further pages. """
+    self._stopped.set()
+    for _ in xrange(self._max_parallel_fetches):
+      self._page_slots.release()
+
+  def _next_fetched_page(self):
+    # Waits with a timeout so that the wait can be interrupted.
+    while True:
+      try:
+        return self._fetched_pages.get(True, 1)
+      except Queue.Empty:
+        continue
+
+  def _fetch_pages(self):
+    start_index = None
+    try:
+      with self._bigquery_call_pool.borrow() as bigquery_call:
+        while True:
+          self._page_slots.acquire()
+          if self._stopped.is_set():
+            return
+          try:
+            start_index = self._start_indices.get(False)
+          except Queue.Empty:
+            self._page_slots.release()
+            return
+          measurement_columns = self._fetch_page(bigquery_call, start_index)
+          self._fetched_pages.put((start_index, measurement_columns, None))
+    except Exception as caught_error:
+      self._fetched_pages.put((start_index, None, caught_error))
+
+  def _fetch_page(self, bigquery_call, start_index):
+    # BigQuery may return fewer rows than requested to limit the size of a
+    # response, in which case the rest of the page is requested separately.
+    end_index = min(start_index + self._rows_per_page, self._total_rows)
+    page_batches = []
+    while start_index < end_index:
+      query_results_response = bigquery_call._get_query_results(
+          self._job_id, {'projectId': bigquery_call.project_id,
+                         'jobId': self._job_id,
+                         'startIndex': str(start_index),
+                         'maxResults': end_index - start_index,
+                         'timeoutMs': 0})
+      page_batch = columns.decode_query_results_page(query_results_response)
+      if len(page_batch) == 0:
+        raise QueryFailure(None, 'MissingQueryResultRows')
+      page_batches.append(page_batch)
+      start_index += len(page_batch)
+    self.logger.debug('Fetched rows {start} to {end} of {job_id}.'.format(
+        start = end_index - sum(len(batch) for batch in page_batches), end = end_index,
+        job_id = self._job_id))
+    return columns.MeasurementColumns.concatenate(page_batches)
+
+class ResultExportBackend(object):
+  """ Retrieves large query results by exporting them to Cloud Storage and
+      downloading the exported shards, which is faster and uses less memory
+      than paging through them as JSON.
+  """
+
+  def __init__(self, destination_uri_prefix, shard_store, row_threshold = 2000000,
+               max_parallel_downloads = 4, rows_per_batch = 100000):
+    """ Creates a new backend.
+
+        Args:
+          destination_uri_prefix (str): Cloud Storage URI under which to write
+            exports, such as gs://bucket/telescope.
+          shard_store (CloudStorageShardStore or LocalShardStore): Store from
+            which to download exported shards.
+          row_threshold (int): Number of rows at and above which results are
+            exported rather than paged through.
+          max_parallel_downloads (int): Maximum number of shards to download at
+            once.
+          rows_per_batch (int): Maximum number of rows in each batch of
+            measurements yielded.
+    """
+    self.logger = logging.getLogger('telescope')
+    self.destination_uri_prefix = destination_uri_prefix.rstrip('/')
+    self.shard_store = shard_store
+    self.row_threshold = row_threshold
+    self.max_parallel_downloads = max_parallel_downloads
+    self.rows_per_batch = rows_per_batch
+
+  def should_export(self, total_rows):
+    return total_rows >= self.row_threshold
+
+  def iter_job_column_pages(self, bigquery_call, job_id, fields):
+    """ Exports the results of a completed job and parses the shards as they
+        are downloaded.
+
+        Args:
+          bigquery_call (BigQueryCall): Connection with which to export.
+
+          job_id (str): ID of the query job whose results to retrieve.
+
+          fields (list): Schema fields of the results.
+
+        Returns:
+          (generator): Yields a telescope.columns.MeasurementColumns for each
+          batch of rows, in no particular order.
+
+        Notes:
+          Shards are downloaded to a temporary directory, so that only one
+          batch of rows is held in memory, and are removed from Cloud Storage
+          once retrieval ends and the downloads in progress have finished.
+    """
+    shard_uris = bigquery_call.extract_job_results(
+        job_id, '{prefix}/{job_id}/results-*.json.gz'.format(prefix = self.destination_uri_prefix,
+                                                             job_id = job_id))
+    download_directory = tempfile.mkdtemp(prefix = 'telescope-export-')
+    shard_downloads = _ShardDownloads(self.shard_store, shard_uris, download_directory,
+                                      self.max_parallel_downloads)
+    try:
+      for shard_path in shard_downloads.iter_downloaded_paths():
+        for measurement_columns in self._iter_shard_batches(shard_path, fields):
+          yield measurement_columns
+        os.remove(shard_path)
+    finally:
+      shard_downloads.stop()
+      shutil.rmtree(download_directory, ignore_errors = True)
+      for shard_uri in shard_uris:
+        try:
+          self.shard_store.delete_shard(shard_uri)
+        except Exception as caught_error:
+          self.logger.warn('Could not remove exported shard {uri}: {caught_error}'.format(
+              uri = shard_uri, caught_error = caught_error))
+
+  def _iter_shard_batches(self, shard_path, fields):
+    exported_rows = []
+    with gzip.open(shard_path, 'rb') as shard_file:
+      for shard_line in shard_file:
+        if not shard_line.strip():
+          continue
+        exported_rows.append(json.loads(shard_line))
+        if len(exported_rows) == self.rows_per_batch:
+          yield columns.decode_exported_rows(exported_rows, fields)
+          exported_rows = []
+    if exported_rows:
+      yield columns.decode_exported_rows(exported_rows, fields)
+
+class _ShardDownloads(object):
+  """ Downloads exported shards to local files on a bounded set of worker
+      threads.
+  """
+
+  def __init__(self, shard_store, shard_uris, download_directory, max_parallel_downloads):
+    self._shard_store = shard_store
+    self._download_directory = download_directory
+    self._shard_count = len(shard_uris)
+    self._pending_shards = Queue.Queue()
+    for shard_number, shard_uri in enumerate(shard_uris):
+      self._pending_shards.put((shard_number, shard_uri))
+    self._downloaded_shards = Queue.Queue()
+    self._stopped = threading.Event()
+
+    self._worker_threads = []
+    for _ in xrange(min(max_parallel_downloads, self._shard_count)):
+      worker_thread = threading.Thread(target = self._download_shards)
+      worker_thread.daemon = True
+      worker_thread.start()
+      self._worker_threads.append(worker_thread)
+
+  def iter_downloaded_paths(self):
+    """ Yields the local path of each shard as its download completes. Raises
+        the first error encountered by a worker.
+    """
+    for _ in xrange(self._shard_count):
       while True:
         try:
-          job_collection = query_object.authenticated_service.jobs()
-          job_collection_state = job_collection.get(projectId = self.project_id, jobId = job_id).execute()
-        except (SSLError, Exception, AttributeError, HttpError, httplib2.ServerNotFoundError) as caught_error:
-          self.logger.warn(('Encountered error ({caught_error}) monitoring ' +
-                            'for {notification_identifier}, could be temporary, ' +
-                            'not bailing out.').format(caught_error = caught_error,
-                                                      notification_identifier = notification_identifier))
-          job_collection_state = None
-
-        if job_collection_state is not None:
-          time_waiting = int((datetime.datetime.utcnow() - started_checking).total_seconds())
-
-          if job_collection_state['status']['state'] == 'RUNNING':
-            self.logger.info(('Waiting for {notification_identifier} to complete, spent {time_waiting} '
-                              'seconds so far.').format(notification_identifier = notification_identifier,
-                                                        time_waiting = time_waiting))
-            time.sleep(10)
-          elif job_collection_state['status']['state'] == 'PENDING':
-            self.logger.info(('Waiting for {notification_identifier} to submit, spent {time_waiting} '
-                              'seconds so far.').format(notification_identifier = notification_identifier,
-                                                        time_waiting = time_waiting))
-            time.sleep(60)
-          elif job_collection_state['status']['state'] == 'DONE' and callback_function is not None:
-            self.logger.info('Found completion status for {notification_identifier}.'.format(
-                notification_identifier = notification_identifier))
-            callback_function(job_id, query_object = self)
-            break
-          else:
-            raise Exception('UnknownBigQueryResponse')
-    return None
+          shard_path, caught_error = self._downloaded_shards.get(True, 1)
+          break
+        except Queue.Empty:
+          continue
+      if caught_error is not None:
+        raise caught_error
+      yield shard_path
+
+  def stop(self):
+    """ Stops workers from starting further downloads, and waits for the
+        downloads already in progress to finish, so that no worker is still
+        writing to the download directory or reading a shard afterwards.
+    """
+    self._stopped.set()
+    for worker_thread in self._worker_threads:
+      worker_thread.join()
+
+  def _download_shards(self):
+    while not self._stopped.is_set():
+      try:
+        shard_number, shard_uri = self._pending_shards.get(False)
+      except Queue.Empty:
+        return
+      shard_path = os.path.join(self._download_directory, 'shard-%012d.json.gz' % shard_number)
+      try:
+        self._shard_store.download_shard(shard_uri, shard_path)
+      except (IOError, OSError) as caught_error:
+        self._downloaded_shards.put((None, caught_error))
+        return
+      except Exception as caught_error:
+        self._downloaded_shards.put((None, QueryFailure(None, caught_error)))
+        return
+      self._downloaded_shards.put((shard_path, None))
+
+def _split_cloud_storage_uri(uri):
+  if not uri.startswith('gs://') or '/' not in uri[len('gs://'):]:
+    raise ValueError('InvalidCloudStorageURI: ' + uri)
+  return tuple(uri[len('gs://'):].split('/', 1))
+
+class CloudStorageShardStore(object):
+  """ Downloads and removes exported shards in Cloud Storage. """
+
+  def __init__(self, storage_service_factory, chunk_size_bytes = 16 * 1024 * 1024):
+    """ Creates a new store.
+
+        Args:
+          storage_service_factory (callable): Returns a new authorized Cloud
+            Storage service, such as GoogleAPIAuth.authenticate_with_google_storage.
+            Services are not thread-safe, so each download builds its own.
+          chunk_size_bytes (int): Size of each request of a download.
+    """
+    self._storage_service_factory = storage_service_factory
+    self._chunk_size_bytes = chunk_size_bytes
+
+  def download_shard(self, shard_uri, local_path):
+    bucket_name, object_name = _split_cloud_storage_uri(shard_uri)
+    media_request = self._storage_service_factory().objects().get_media(bucket = bucket_name,
+                                                                        object = object_name)
+    with open(local_path, 'wb') as local_file:
+      downloader = MediaIoBaseDownload(local_file, media_request, chunksize = self._chunk_size_bytes)
+      download_complete = False
+      while not download_complete:
+        _, download_complete = downloader.next_chunk()
+
+  def delete_shard(self, shard_uri):
+    bucket_name, object_name = _split_cloud_storage_uri(shard_uri)
+    self._storage_service_factory().objects().delete(bucket = bucket_name, object = object_name).execute()
+
+class LocalShardStore(object):
+  """ Exported shards on the local file system, laid out as
+      directory/bucket/object, for testing against shard fixtures or reading
+      exports copied out of Cloud Storage by other means.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def shard_path(self, shard_uri):
+    bucket_name, object_name = _split_cloud_storage_uri(shard_uri)
+    return os.path.join(self.directory, bucket_name, *object_name.split('/'))
+
+  def download_shard(self, shard_uri, local_path):
+    shutil.copyfile(self.shard_path(shard_uri), local_path)
+
+  def delete_shard(self, shard_uri):
+    os.remove(self.shard_path(shard_uri))
@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import httplib2
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from apiclient.errors import HttpError
+
+import external
+import query
+import scheduler
+
+class FakeRequest(object):
+  """ Stand-in for an apiclient HttpRequest that runs a function on execute. """
+
+  def __init__(self, execute_function):
+    self._execute_function = execute_function
+
+  def execute(self):
+    return self._execute_function()
+
+def raise_http_error(status):
+  raise HttpError(httplib2.Response({'status': status}), 'Fake error %d' % status)
+
+class FakeBigQueryService(object):
+  """ In-memory stand-in for the parts of the BigQuery v2 API that telescope
+      uses. Jobs complete as soon as they are inserted.
+  """
+
+  def __init__(self):
+    self.datasets_store = set()
+    self.tables_store = {}
+    self.jobs_store = {}
+    self.jobs_order = []
+    self.query_results_store = {}
+    self.max_rows_per_response = None
+    # Directory to which extract jobs write shards, laid out as read by
+    # external.LocalShardStore, and the number of shards each writes.
+    self.export_directory = None
+    self.export_shard_count = 3
+    # State in which inserted jobs are created.
+    self.inserted_job_state = 'DONE'
+    self.calls = []
+
+  def add_query_results(self, job_id, fieldnames, rows):
+    """ Records a completed query job whose results are the given rows, each
+        a list of string values in the order of fieldnames.
+    """
+    self.jobs_store[job_id] = {'jobReference': {'jobId': job_id},
+                               'configuration': {'query': {'destinationTable': {
+                                   'projectId': 'fake-project', 'datasetId': '_anonymous',
+                                   'tableId': 'anon_' + job_id}}},
+                               'status': {'state': 'DONE'},
+                               'statistics': {'creationTime': '1400000000000', 'endTime': '1400000000000'}}
+    self.jobs_order.append(job_id)
+    self.query_results_store[job_id] = (fieldnames, rows)
+
+  def datasets(self):
+    return FakeDatasetsCollection(self)
+
+  def tables(self):
+    return FakeTablesCollection(self)
+
+  def jobs(self):
+    return FakeJobsCollection(self)
+
+  def record_call(self, method_name):
+    self.calls.append(method_name)
+
+class FakeDatasetsCollection(object):
+
+  def __init__(self, service):
+    self._service = service
+
+  def get(self, projectId, datasetId):
+    def execute():
+      self._service.record_call('datasets.get')
+      if (projectId, datasetId) not in self._service.datasets_store:
+        raise_http_error(404)
+      return {'datasetReference': {'projectId': projectId, 'datasetId': datasetId}}
+    return FakeRequest(execute)
+
+  def insert(self, projectId, body):
+    def execute():
+      self._service.record_call('datasets.insert')
+      dataset_key = (projectId, body['datasetReference']['datasetId'])
+      if dataset_key in self._service.datasets_store:
+        raise_http_error(409)
+      self._service.datasets_store.add(dataset_key)
+      return body
+    return FakeRequest(execute)
+
+class FakeTablesCollection(object):
+
+  def __init__(self, service):
+    self._service = service
+
+  def get(self, projectId, datasetId, tableId):
+    def execute():
+      self._service.record_call('tables.get')
+      table_key = (projectId, datasetId, tableId)
+      if table_key not in self._service.tables_store:
+        raise_http_error(404)
+      return {'tableReference': {'projectId': projectId, 'datasetId': datasetId, 'tableId': tableId}}
+    return FakeRequest(execute)
+
+class FakeJobsCollection(object):
+
+  def __init__(self, service):
+    self._service = service
+
+  def insert(self, projectId, body, media_body = None):
+    def execute():
+      self._service.record_call('jobs.insert')
+      job_id = 'job_%d' % len(self._service.jobs_store)
+      job = {'jobReference': {'projectId': projectId, 'jobId': job_id},
+             'configuration': body['configuration'],
+             'status': {'state': self._service.inserted_job_state}}
+      load_configuration = body['configuration'].get('load')
+      if load_configuration is not None:
+        destination = load_configuration['destinationTable']
+        rows_data = media_body.getbytes(0, media_body.size())
+        self._service.tables_store[(destination['projectId'], destination['datasetId'],
+                                    destination['tableId'])] = [
+            json.loads(line) for line in rows_data.splitlines()]
+      extract_configuration = body['configuration'].get('extract')
+      if extract_configuration is not None:
+        job['statistics'] = {'extract': {'destinationUriFileCounts': [
+            str(self._service.export_shard_count)]}}
+        self._write_export_shards(extract_configuration)
+      self._service.jobs_store[job_id] = job
+      self._service.jobs_order.append(job_id)
+      return job
+    return FakeRequest(execute)
+
+  def _write_export_shards(self, extract_configuration):
+    source_job_id = extract_configuration['sourceTable']['tableId'][len('anon_'):]
+    fieldnames, rows = self._service.query_results_store[source_job_id]
+    shard_store = external.LocalShardStore(self._service.export_directory)
+    destination_uri_pattern = extract_configuration['destinationUris'][0]
+    for shard_number in range(self._service.export_shard_count):
+      shard_path = shard_store.shard_path(destination_uri_pattern.replace('*', '%012d' % shard_number))
+      if not os.path.exists(os.path.dirname(shard_path)):
+        os.makedirs(os.path.dirname(shard_path))
+      with gzip.open(shard_path, 'wb') as shard_file:
+        for row in rows[shard_number::self._service.export_shard_count]:
+          # Like BigQuery, omits NULL values from exported rows.
+          shard_file.write(json.dumps(dict((fieldname, value) for fieldname, value in zip(fieldnames, row)
+                                           if value is not None)) + '\n')
+
+  def get(self, projectId, jobId):
+    def execute():
+      self._service.record_call('jobs.get')
+      if jobId not in self._service.jobs_store:
+        raise_http_error(404)
+      return self._service.jobs_store[jobId]
+    return FakeRequest(execute)
+
+  def list(self, projectId, projection = None, maxResults = 1000, pageToken = None):
+    def execute():
+      self._service.record_call('jobs.list')
+      # Like BigQuery, lists the most recently created jobs first.
+      listed_job_ids = list(reversed(self._service.jobs_order))
+      page_start = int(pageToken or 0)
+      page_end = page_start + maxResults
+      response = {'jobs': [{'jobReference': self._service.jobs_store[job_id]['jobReference'],
+                            'state': self._service.jobs_store[job_id]['status']['state'],
+                            'statistics': self._service.jobs_store[job_id].get('statistics', {})}
+                           for job_id in listed_job_ids[page_start:page_end]]}
+      if page_end < len(listed_job_ids):
+        response['nextPageToken'] = str(page_end)
+      return response
+    return FakeRequest(execute)
+
+  def getQueryResults(self, projectId, jobId, maxResults, timeoutMs, pageToken = None, startIndex = None):
+    def execute():
+      self._service.record_call('jobs.getQueryResults')
+      if jobId not in self._service.query_results_store:
+        raise_http_error(404)
+      fieldnames, rows = self._service.query_results_store[jobId]
+      page_start = int(startIndex or pageToken or 0)
+      page_end = page_start + min(maxResults, self._service.max_rows_per_response or maxResults)
+      response = {'jobComplete': True,
+                  'totalRows': str(len(rows)),
+                  'schema': {'fields': [{'name': fieldname, 'type': 'STRING'} for fieldname in fieldnames]},
+                  'rows': [{'f': [{'v': value} for value in row]} for row in rows[page_start:page_end]]}
+      if page_end < len(rows):
+        response['pageToken'] = str(page_end)
+      return response
+    return FakeRequest(execute)
+
+class FakeGoogleAPIAuth(object):
+
+  def __init__(self, service, project_id = 'fake-project'):
+    self._service = service
+    self.project_id = project_id
+    self.authentication_count = 0
+
+  def authenticate_with_google(self):
+    self.authentication_count += 1
+    return self._service
+
+class BigQueryCallClientRangesTableTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeBigQueryService()
+    external.BigQueryCall._existing_client_ranges_tables.clear()
+    self.bigquery_call = external.BigQueryCall(FakeGoogleAPIAuth(self.service))
+
+  def testUploadsMissingTable(self):
+    client_ranges_table = query.ClientRangesTable('telescope', [(5, 10), (65530, 65540)])
+    self.assertTrue(self.bigquery_call.ensure_client_ranges_table(client_ranges_table))
+
+    self.assertIn(('fake-project', 'telescope'), self.service.datasets_store)
+    uploaded_rows = self.service.tables_store[('fake-project', 'telescope', client_ranges_table.table_id)]
+    self.assertListEqual(list(client_ranges_table.rows()), uploaded_rows)
+
+  def testReusesExistingTable(self):
+    client_ranges_table = query.ClientRangesTable('telescope', [(5, 10)])
+    self.assertTrue(self.bigquery_call.ensure_client_ranges_table(client_ranges_table))
+    self.assertFalse(self.bigquery_call.ensure_client_ranges_table(client_ranges_table))
+    self.assertEqual(1, self.service.calls.count('jobs.insert'))
+
+    # A fresh process only needs to check that the table exists.
+    external.BigQueryCall._existing_client_ranges_tables.clear()
+    self.assertFalse(self.bigquery_call.ensure_client_ranges_table(
+        query.ClientRangesTable('telescope', [(5, 7), (8, 10)])))
+    self.assertEqual(1, self.service.calls.count('jobs.insert'))
+
+  def testStalledUploadTimesOut(self):
+    self.service.inserted_job_state = 'RUNNING'
+    client_ranges_table = query.ClientRangesTable('telescope', [(5, 10)])
+    with self.assertRaises(external.QueryFailure):
+      self.bigquery_call.ensure_client_ranges_table(
+          client_ranges_table, load_timeout_seconds = 0.05,
+          load_poll_schedule = scheduler.AdaptivePollSchedule(minimum_delay = 0.01, maximum_delay = 0.01))
+    self.assertGreater(self.service.calls.count('jobs.get'), 1)
+
+    # The table is not assumed to exist, so it is checked again next time.
+    self.assertNotIn(('fake-project', 'telescope', client_ranges_table.table_id),
+                     external.BigQueryCall._existing_client_ranges_tables)
+
+  def testTablesAreContentAddressed(self):
+    first_table = query.ClientRangesTable('telescope', [(5, 10), (11, 20)])
+    second_table = query.ClientRangesTable('telescope', [(5, 20)])
+    third_table = query.ClientRangesTable('telescope', [(5, 21)])
+    self.assertEqual(first_table.table_id, second_table.table_id)
+    self.assertNotEqual(first_table.table_id, third_table.table_id)
+
+class BigQueryCallPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.google_auth_config = FakeGoogleAPIAuth(FakeBigQueryService())
+    self.bigquery_call_pool = external.BigQueryCallPool(self.google_auth_config)
+
+  def testReleasedCallsAreReused(self):
+    with self.bigquery_call_pool.borrow() as first_call:
+      pass
+    with self.bigquery_call_pool.borrow() as second_call:
+      pass
+    self.assertIs(first_call, second_call)
+    self.assertEqual(1, self.google_auth_config.authentication_count)
+
+  def testCallsInUseAreNotShared(self):
+    first_call = self.bigquery_call_pool.acquire()
+    second_call = self.bigquery_call_pool.acquire()
+    self.assertIsNot(first_call, second_call)
+    self.assertEqual(2, self.google_auth_config.authentication_count)
+
+  def testCallIsReleasedOnError(self):
+    with self.assertRaises(ValueError):
+      with self.bigquery_call_pool.borrow() as first_call:
+        raise ValueError('Failed query')
+    self.assertIs(first_call, self.bigquery_call_pool.acquire())
+
+class BigQueryCallJobStatesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeBigQueryService()
+    self.bigquery_call = external.BigQueryCall(FakeGoogleAPIAuth(self.service))
+    for job_index in range(30):
+      self.service.add_query_results('job_%d' % job_index, ['log_time'], [['1']])
+    self.service.jobs_store['job_28']['status']['state'] = 'RUNNING'
+    self.service.jobs_store['job_29']['status']['state'] = 'PENDING'
+
+  def testListsStatesOfRecentJobs(self):
+    job_states = self.bigquery_call.get_job_states(['job_27', 'job_28', 'job_29'], max_results_per_list = 10)
+    self.assertDictEqual({'job_27': 'DONE', 'job_28': 'RUNNING', 'job_29': 'PENDING'}, job_states)
+    self.assertListEqual(['jobs.list'], self.service.calls)
+
+  def testReadsFurtherPages(self):
+    job_states = self.bigquery_call.get_job_states(['job_15', 'job_29'], max_results_per_list = 10)
+    self.assertDictEqual({'job_15': 'DONE', 'job_29': 'PENDING'}, job_states)
+    self.assertListEqual(['jobs.list', 'jobs.list'], self.service.calls)
+
+  def testRetrievesUnlistedJobsIndividually(self):
+    job_states = self.bigquery_call.get_job_states(['job_0', 'job_29'], max_results_per_list = 10,
+                                                   max_list_pages = 2)
+    self.assertDictEqual({'job_0': 'DONE', 'job_29': 'PENDING'}, job_states)
+    self.assertListEqual(['jobs.list', 'jobs.list', 'jobs.get'], self.service.calls)
+
+  def testSummarizesRunTimesOfCompletedJobs(self):
+    self.service.jobs_store['job_27']['statistics'] = {'creationTime': '1400000000000',
+                                                       'startTime': '1400000002000',
+                                                       'endTime': '1400000012500'}
+    self.service.jobs_store['job_28']['statistics'] = {'creationTime': '1400000000000'}
+    job_summaries = self.bigquery_call.get_job_summaries(['job_0', 'job_27', 'job_28'],
+                                                         max_results_per_list = 10, max_list_pages = 1)
+    self.assertDictEqual({'job_0': {'state': 'DONE', 'runtime_seconds': 0.0},
+                          'job_27': {'state': 'DONE', 'runtime_seconds': 12.5},
+                          'job_28': {'state': 'RUNNING', 'runtime_seconds': None}}, job_summaries)
+
+class BigQueryCallReattachTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeBigQueryService()
+    self.bigquery_call = external.BigQueryCall(FakeGoogleAPIAuth(self.service))
+    self.service.add_query_results('job_query', ['log_time'], [['1']])
+    self.job = self.service.jobs_store['job_query']
+
+  def set_job_end_time(self, seconds_ago):
+    self.job['statistics'] = {'endTime': str(int((time.time() - seconds_ago) * 1000))}
+
+  def testRunningJobIsReattachable(self):
+    self.job['status'] = {'state': 'RUNNING'}
+    self.assertTrue(self.bigquery_call.is_job_reattachable('job_query'))
+
+  def testRecentlyCompletedJobIsReattachable(self):
+    self.set_job_end_time(60)
+    self.assertTrue(self.bigquery_call.is_job_reattachable('job_query'))
+
+  def testJobWithExpiredResultsIsNotReattachable(self):
+    self.set_job_end_time(external.QUERY_RESULTS_LIFETIME_SECONDS + 60)
+    self.assertFalse(self.bigquery_call.is_job_reattachable('job_query'))
+
+  def testFailedJobIsNotReattachable(self):
+    self.set_job_end_time(60)
+    self.job['status'] = {'state': 'DONE', 'errorResult': {'reason': 'invalidQuery'}}
+    self.assertFalse(self.bigquery_call.is_job_reattachable('job_query'))
+
+  def testMissingJobIsNotReattachable(self):
+    self.assertFalse(self.bigquery_call.is_job_reattachable('job_missing'))
+
+class BigQueryCallRetrieveJobDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeBigQueryService()
+    self.bigquery_call = external.BigQueryCall(FakeGoogleAPIAuth(self.service))
+    self.rows = [[str(row_index), str(row_index * 10)] for row_index in range(250)]
+    self.service.add_query_results('job_query', ['log_time', 'value'], self.rows)
+
+  def testIterJobDataPagesYieldsEachPage(self):
+    job_data_pages = self.bigquery_call.iter_job_data_pages('job_query', max_results_per_get = 100)
+    self.assertDictEqual({'log_time': '0', 'value': '0'}, next(job_data_pages)[0])
+    # Later pages are only requested once earlier pages are consumed.
+    self.assertEqual(1, self.service.calls.count('jobs.getQueryResults'))
+
+    remaining_pages = list(job_data_pages)
+    self.assertListEqual([100, 50], [len(job_data_page) for job_data_page in remaining_pages])
+    self.assertDictEqual({'log_time': '249', 'value': '2490'}, remaining_pages[-1][-1])
+
+  def testRetrieveJobDataJoinsPages(self):
+    retrieved_rows = self.bigquery_call.retrieve_job_data('job_query')
+    self.assertEqual(250, len(retrieved_rows))
+    self.assertDictEqual({'log_time': '249', 'value': '2490'}, retrieved_rows[-1])
+
+  def testMissingJobRaisesTableDoesNotExist(self):
+    with self.assertRaises(external.TableDoesNotExist):
+      list(self.bigquery_call.iter_job_data_pages('job_missing'))
+
+class BigQueryCallParallelPagesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeBigQueryService()
+    google_auth_config = FakeGoogleAPIAuth(self.service)
+    self.bigquery_call = external.BigQueryCall(google_auth_config)
+    self.bigquery_call_pool = external.BigQueryCallPool(google_auth_config)
+    self.rows = [[str(row_index), str(row_index * 10)] for row_index in range(1050)]
+    self.service.add_query_results('job_query', ['log_time', 'value'], self.rows)
+
+  def retrieve_log_times(self, ordered, parallel_page_fetches = 3):
+    column_pages = self.bigquery_call.iter_job_column_pages(
+        'job_query', max_results_per_get = 100, bigquery_call_pool = self.bigquery_call_pool,
+        parallel_page_fetches = parallel_page_fetches, ordered = ordered)
+    return [page['log_time'].tolist() for page in column_pages]
+
+  def testOrderedPagesAreReassembledInOrder(self):
+    log_time_pages = self.retrieve_log_times(ordered = True)
+    self.assertListEqual([row[0] for row in self.rows], sum(log_time_pages, []))
+    self.assertListEqual([100] * 10 + [50], [len(page) for page in log_time_pages])
+
+  def testUnorderedPagesContainEveryRowOnce(self):
+    log_time_pages = self.retrieve_log_times(ordered = False)
+    self.assertListEqual(sorted(row[0] for row in self.rows), sorted(sum(log_time_pages, [])))
+
+  def testShortResponsesAreCompletedWithinEachPage(self):
+    self.service.max_rows_per_response = 30
+    log_time_pages = self.retrieve_log_times(ordered = True)
+    self.assertListEqual([row[0] for row in self.rows], sum(log_time_pages, []))
+    # The first response, then four responses for each full page of 100 rows
+    # and one for the last 20 rows.
+    self.assertEqual(42, self.service.calls.count('jobs.getQueryResults'))
+
+  def testSinglePageIsNotFetchedAgain(self):
+    self.service.add_query_results('job_small', ['log_time'], [['1'], ['2']])
+    column_pages = list(self.bigquery_call.iter_job_column_pages(
+        'job_small', bigquery_call_pool = self.bigquery_call_pool, parallel_page_fetches = 3))
+    self.assertListEqual([['1', '2']], [page['log_time'].tolist() for page in column_pages])
+    self.assertEqual(1, self.service.calls.count('jobs.getQueryResults'))
+
+  def testWorkerErrorIsRaised(self):
+    original_get_query_results = FakeJobsCollection.getQueryResults
+    def get_query_results_failing_later_pages(jobs_collection, **query_request):
+      if query_request.get('startIndex') is not None:
+        return FakeRequest(lambda: raise_http_error(403))
+      return original_get_query_results(jobs_collection, **query_request)
+    FakeJobsCollection.getQueryResults = get_query_results_failing_later_pages
+    try:
+      with self.assertRaises(external.QueryFailure):
+        self.retrieve_log_times(ordered = True)
+    finally:
+      FakeJobsCollection.getQueryResults = original_get_query_results
+
+  def testWithoutPoolFollowsPageTokens(self):
+    column_pages = list(self.bigquery_call.iter_job_column_pages('job_query', max_results_per_get = 500))
+    self.assertListEqual([500, 500, 50], [len(page) for page in column_pages])
+
+class ResultExportBackendTest(unittest.TestCase):
+
+  def setUp(self):
+    self.export_directory = tempfile.mkdtemp()
+    self.service = FakeBigQueryService()
+    self.service.export_directory = self.export_directory
+    self.bigquery_call = external.BigQueryCall(FakeGoogleAPIAuth(self.service))
+    self.shard_store = external.LocalShardStore(self.export_directory)
+    self.result_export_backend = external.ResultExportBackend(
+        'gs://fake-bucket/telescope/', self.shard_store, row_threshold = 100, rows_per_batch = 40)
+    self.rows = [[str(row_index), None if row_index % 7 == 0 else str(row_index * 10)]
+                 for row_index in range(250)]
+    self.service.add_query_results('job_query', ['log_time', 'value'], self.rows)
+
+  def tearDown(self):
+    shutil.rmtree(self.export_directory)
+
+  def retrieve_rows(self, job_id):
+    column_pages = self.bigquery_call.iter_job_column_pages(
+        job_id, ordered = False, result_export_backend = self.result_export_backend)
+    return [(row['log_time'], row['value']) for page in column_pages for row in page.iter_rows()]
+
+  def testLargeResultsAreExported(self):
+    retrieved_rows = self.retrieve_rows('job_query')
+    self.assertListEqual(sorted((row[0], row[1]) for row in self.rows), sorted(retrieved_rows))
+    extract_jobs = [job for job in self.service.jobs_store.values() if 'extract' in job['configuration']]
+    self.assertEqual(1, len(extract_jobs))
+    self.assertListEqual(['gs://fake-bucket/telescope/job_query/results-*.json.gz'],
+                         extract_jobs[0]['configuration']['extract']['destinationUris'])
+    # Only the schema and row count are requested through the paged API.
+    self.assertEqual(1, self.service.calls.count('jobs.getQueryResults'))
+
+  def testExportedShardsAreRemoved(self):
+    self.retrieve_rows('job_query')
+    shard_directory = os.path.join(self.export_directory, 'fake-bucket', 'telescope', 'job_query')
+    self.assertListEqual([], os.listdir(shard_directory))
+
+  def testSmallResultsArePaged(self):
+    self.service.add_query_results('job_small', ['log_time', 'value'], self.rows[:99])
+    self.assertEqual(99, len(self.retrieve_rows('job_small')))
+    self.assertFalse(any('extract' in job['configuration'] for job in self.service.jobs_store.values()))
+
+  def testOrderedRetrievalIsPaged(self):
+    column_pages = list(self.bigquery_call.iter_job_column_pages(
+        'job_query', result_export_backend = self.result_export_backend))
+    self.assertEqual(250, sum(len(page) for page in column_pages))
+    self.assertFalse(any('extract' in job['configuration'] for job in self.service.jobs_store.values()))
+
+  def testStoppedRetrievalWaitsForDownloadsInProgress(self):
+    self.service.export_shard_count = 4
+    finished_downloads = []
+    class SlowShardStore(external.LocalShardStore):
+      def download_shard(self, shard_uri, local_path):
+        # Later shards are still downloading when the first is consumed.
+        if not shard_uri.endswith('results-000000000000.json.gz'):
+          time.sleep(0.1)
+        external.LocalShardStore.download_shard(self, shard_uri, local_path)
+        finished_downloads.append(local_path)
+    self.result_export_backend.shard_store = SlowShardStore(self.export_directory)
+    self.result_export_backend.max_parallel_downloads = 4
+
+    column_pages = self.bigquery_call.iter_job_column_pages(
+        'job_query', ordered = False, result_export_backend = self.result_export_backend)
+    next(column_pages)
+    column_pages.close()
+    self.assertEqual(4, len(finished_downloads))
+    for local_path in finished_downloads:
+      self.assertFalse(os.path.exists(os.path.dirname(local_path)))
+    shard_directory = os.path.join(self.export_directory, 'fake-bucket', 'telescope', 'job_query')
+    self.assertListEqual([], os.listdir(shard_directory))
+
+  def testStalledExportTimesOut(self):
+    self.service.inserted_job_state = 'RUNNING'
+    with self.assertRaises(external.QueryFailure):
+      self.bigquery_call.extract_job_results(
+          'job_query', 'gs://fake-bucket/telescope/job_query/results-*.json.gz', export_timeout_seconds = 0.05,
+          export_poll_schedule = scheduler.AdaptivePollSchedule(minimum_delay = 0.01, maximum_delay = 0.01))
+    self.assertGreater(self.service.calls.count('jobs.get'), 2)
+
+  def testMissingShardRaisesIOError(self):
+    shard_uris = self.bigquery_call.extract_job_results(
+        'job_query', 'gs://fake-bucket/telescope/job_query/results-*.json.gz')
+    os.remove(self.shard_store.shard_path(shard_uris[1]))
+    self.bigquery_call.extract_job_results = lambda job_id, destination_uri_pattern: shard_uris
+    with self.assertRaises(IOError):
+      self.retrieve_rows('job_query')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,6 +15,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy
+
+import query
 
 _MINIMUM_DURATION = 9000000 # greater than or equal to 9 seconds
 _MAXIMUM_DURATION = 3600000000 #  test lasted for an hour or more, probably erroneous
@@ -47,6 +50,111 @@ def filter_measurements_list(metric, measurements_list):
   assert metric in filter_functions.keys()
   return filter(filter_functions[metric], measurements_list)
 
+def filter_measurement_columns(metric, measurements):
+  """Applies measurement validation rules across whole columns of
+    measurements at once.
+
+    Produces the same selection as filter_measurements_list, without
+    converting measurements to rows.
+
+    Args:
+      metric (str): name of M-Lab metric to apply validation rules on for
+        provided measurements.
+      measurements (telescope.columns.MeasurementColumns): Measurement Lab
+        and web100 variables for each measurement.
+
+    Returns:
+      tuple: A boolean numpy array that is True for valid measurements, and a
+        dict of the number of measurements discarded by each validity rule,
+        keyed by rule name. Each discarded measurement is counted against the
+        first rule it fails.
+
+  """
+  assert metric in _COLUMN_FILTER_RULES.keys()
+  keep_mask = numpy.ones(len(measurements), dtype = numpy.bool_)
+  discard_counts = {}
+
+  if metric in query.METRIC_DATA_DIRECTIONS:
+    data_direction = _integer_column(measurements, 'connection_spec_data_direction')
+    assert numpy.all(data_direction == query.METRIC_DATA_DIRECTIONS[metric])
+
+  for rule_name, rule_function in _COLUMN_FILTER_RULES[metric]:
+    rule_mask = numpy.ma.filled(rule_function(measurements), False)
+    newly_discarded = keep_mask & ~rule_mask
+    discard_counts[rule_name] = int(numpy.count_nonzero(newly_discarded))
+    keep_mask &= rule_mask
+  return keep_mask, discard_counts
+
+def _integer_column(measurements, fieldname):
+  return measurements.typed_column(fieldname, numpy.int64)
+
+def _column_rule_c2s_duration(measurements):
+  duration = _integer_column(measurements, 'web100_log_entry_snap_Duration')
+  return (_MINIMUM_DURATION <= duration) & (duration < _MAXIMUM_DURATION)
+
+def _column_rule_c2s_bytes(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_HCThruOctetsReceived') >= _MINIMUM_PACKETS
+
+def _column_rule_s2c_duration(measurements):
+  duration = (_integer_column(measurements, 'web100_log_entry_snap_SndLimTimeRwin') +
+              _integer_column(measurements, 'web100_log_entry_snap_SndLimTimeCwnd') +
+              _integer_column(measurements, 'web100_log_entry_snap_SndLimTimeSnd'))
+  return (_MINIMUM_DURATION <= duration) & (duration < _MAXIMUM_DURATION)
+
+def _column_rule_s2c_bytes(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_HCThruOctetsAcked') >= _MINIMUM_PACKETS
+
+def _column_rule_s2c_congestion(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_CongSignals') > 0
+
+def _column_rule_tcp_state(measurements):
+  # State variables from http://www.web100.org/download/kernel/tcp-kis.txt
+  STATE_CLOSED = 1
+  STATE_ESTABLISHED = 5
+  STATE_TIME_WAIT = 11
+
+  state = _integer_column(measurements, 'web100_log_entry_snap_State')
+  return (state == STATE_CLOSED) | ((state >= STATE_ESTABLISHED) & (state <= STATE_TIME_WAIT))
+
+def _column_rule_min_rtt(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_MinRTT') != 0
+
+def _column_rule_sum_rtt(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_SumRTT') != 0
+
+def _column_rule_count_rtt(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_CountRTT') > 0
+
+def _column_rule_segments_retransmitted(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_SegsRetrans') != 0
+
+def _column_rule_data_segments_out(measurements):
+  return _integer_column(measurements, 'web100_log_entry_snap_DataSegsOut') > 0
+
+_C2S_COLUMN_FILTER_RULES = [
+    ('duration', _column_rule_c2s_duration),
+    ('bytes', _column_rule_c2s_bytes),
+    ('tcp_state', _column_rule_tcp_state),
+    ]
+_S2C_COLUMN_FILTER_RULES = [
+    ('duration', _column_rule_s2c_duration),
+    ('bytes', _column_rule_s2c_bytes),
+    ('congestion_signals', _column_rule_s2c_congestion),
+    ('tcp_state', _column_rule_tcp_state),
+    ]
+_COLUMN_FILTER_RULES = {
+    'download_throughput': _S2C_COLUMN_FILTER_RULES,
+    'upload_throughput': _C2S_COLUMN_FILTER_RULES,
+    'minimum_rtt': _S2C_COLUMN_FILTER_RULES + [('min_rtt', _column_rule_min_rtt),
+                                               ('count_rtt', _column_rule_count_rtt)],
+    'average_rtt': _S2C_COLUMN_FILTER_RULES + [('sum_rtt', _column_rule_sum_rtt),
+                                               ('count_rtt', _column_rule_count_rtt)],
+    'packet_retransmit_rate': _S2C_COLUMN_FILTER_RULES + [
+        ('segments_retransmitted', _column_rule_segments_retransmitted),
+        ('data_segments_out', _column_rule_data_segments_out)],
+    'hop_count': [],
+    }
+
 def _filter_c2s_measurement(measurement):
   """Applies measurement validity rules and tests presence of required fields
       for upload or client-to-server test.
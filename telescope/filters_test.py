@@ -1,6 +1,11 @@
-import filters
+import random
 import unittest
 
+import numpy
+
+import columns
+import filters
+
 class FiltersTest(unittest.TestCase):
   def test_filter_measurements_list(self):
     fake_good_data = {
@@ -38,4 +43,78 @@ class FiltersTest(unittest.TestCase):
     filtered_data_tuple = tuple(filters.filter_measurements_list(
         'upload_throughput', [fake_good_data]))
     self.assertEqual(good_data_tuple, filtered_data_tuple)
-    
+
+class FilterMeasurementColumnsTest(unittest.TestCase):
+
+  def setUp(self):
+    random_generator = random.Random(1234)
+    def random_value(choices):
+      return str(random_generator.choice(choices))
+
+    self.s2c_rows = []
+    for _ in range(500):
+      self.s2c_rows.append({
+          'connection_spec_data_direction': '1',
+          'web100_log_entry_snap_SndLimTimeRwin': random_value([0, 1000, 3000000, 3000000000]),
+          'web100_log_entry_snap_SndLimTimeCwnd': random_value([0, 3000000, 6000000]),
+          'web100_log_entry_snap_SndLimTimeSnd': random_value([0, 1, 3000000]),
+          'web100_log_entry_snap_HCThruOctetsAcked': random_value([0, 8191, 8192, 100000]),
+          'web100_log_entry_snap_CongSignals': random_value([0, 1, 5]),
+          'web100_log_entry_snap_State': random_value(range(0, 13)),
+          'web100_log_entry_snap_MinRTT': random_value([0, 1, 20]),
+          'web100_log_entry_snap_SumRTT': random_value([0, 100]),
+          'web100_log_entry_snap_CountRTT': random_value([0, 3]),
+          'web100_log_entry_snap_SegsRetrans': random_value([0, 2]),
+          'web100_log_entry_snap_DataSegsOut': random_value([0, 40]),
+          })
+    self.c2s_rows = []
+    for _ in range(500):
+      self.c2s_rows.append({
+          'connection_spec_data_direction': '0',
+          'web100_log_entry_snap_Duration': random_value([0, 8999999, 9000000, 3599999999, 3600000000]),
+          'web100_log_entry_snap_HCThruOctetsReceived': random_value([0, 8191, 8192, 100000]),
+          'web100_log_entry_snap_State': random_value(range(0, 13)),
+          })
+
+  def to_columns(self, rows):
+    return columns.MeasurementColumns.from_rows(rows, dict((fieldname, 'INTEGER') for fieldname in rows[0]))
+
+  def assertMatchesRowFilter(self, metric, rows):
+    keep_mask, discard_counts = filters.filter_measurement_columns(metric, self.to_columns(rows))
+    expected_keep_mask = [row in filters.filter_measurements_list(metric, [row]) for row in rows]
+    self.assertListEqual(expected_keep_mask, keep_mask.tolist())
+    self.assertEqual(keep_mask.size - numpy.count_nonzero(keep_mask), sum(discard_counts.values()))
+
+  def test_matches_row_filters(self):
+    for metric in ['download_throughput', 'minimum_rtt', 'average_rtt', 'packet_retransmit_rate']:
+      self.assertMatchesRowFilter(metric, self.s2c_rows)
+    self.assertMatchesRowFilter('upload_throughput', self.c2s_rows)
+
+  def test_discard_counts_attribute_first_failed_rule(self):
+    valid_row = {
+      'connection_spec_data_direction': '0',
+      'web100_log_entry_snap_Duration': '10000000',
+      'web100_log_entry_snap_HCThruOctetsReceived': '10000',
+      'web100_log_entry_snap_State': '1',
+    }
+    too_short_row = dict(valid_row, web100_log_entry_snap_Duration = '10000',
+                         web100_log_entry_snap_HCThruOctetsReceived = '10')
+    too_little_row = dict(valid_row, web100_log_entry_snap_HCThruOctetsReceived = '10')
+    keep_mask, discard_counts = filters.filter_measurement_columns(
+        'upload_throughput', self.to_columns([valid_row, too_short_row, too_little_row]))
+    self.assertListEqual([True, False, False], keep_mask.tolist())
+    self.assertDictEqual({'duration': 1, 'bytes': 1, 'tcp_state': 0}, discard_counts)
+
+  def test_null_values_are_discarded(self):
+    null_row = dict(self.c2s_rows[0], web100_log_entry_snap_State = None)
+    keep_mask, _ = filters.filter_measurement_columns('upload_throughput', self.to_columns([null_row]))
+    self.assertListEqual([False], keep_mask.tolist())
+
+  def test_missing_field_raises(self):
+    rows = [dict(self.c2s_rows[0])]
+    del rows[0]['web100_log_entry_snap_State']
+    with self.assertRaises(ValueError):
+      filters.filter_measurement_columns('upload_throughput', self.to_columns(rows))
+
+if __name__ == '__main__':
+  unittest.main()
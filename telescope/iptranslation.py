@@ -16,16 +16,55 @@
 # limitations under the License.
 
 
+import array
+import bisect
 import csv
 import datetime
 import logging
+import mmap
 import os
 import re
+import socket
+import struct
+import tempfile
+
+import numpy
+
+import utils
 
 class MissingMaxMindError(Exception):
   def __init__(self, db_location, io_error):
     Exception.__init__(self, 'Failed to open MaxMind database at %s\nError: %s' % (db_location, io_error))
 
+def ip_address_to_int(ip_address):
+  """ Converts a dotted-quad IPv4 address to its integer value.
+
+      Args:
+        ip_address (str): IPv4 address, such as '192.0.2.1'.
+
+      Returns:
+        int: The address as an unsigned 32-bit integer.
+
+  """
+  try:
+    return struct.unpack('!I', socket.inet_aton(ip_address))[0]
+  except socket.error:
+    raise ValueError('InvalidIPv4Address: %s' % ip_address)
+
+def ip_addresses_to_ints(ip_addresses):
+  """ Converts a sequence of dotted-quad IPv4 addresses to a NumPy array of
+      their integer values, suitable for lookup_ips_batch.
+
+      Args:
+        ip_addresses (iterable): IPv4 address strings.
+
+      Returns:
+        numpy.ndarray: uint32 array of the addresses' integer values.
+
+  """
+  packed_addresses = ''.join(socket.inet_aton(ip_address) for ip_address in ip_addresses)
+  return numpy.frombuffer(packed_addresses, dtype = '>u4').astype(numpy.uint32)
+
 class IPTranslationStrategySpec(object):
   """ Specification of parameters required to create an IPTranslationStrategy
       object.
@@ -35,45 +74,679 @@ class IPTranslationStrategySpec(object):
     self.strategy_name = strategy_name
     self.params = params
 
+class MaxMindSnapshotDirectory(object):
+  """ Index of the MaxMind ASN snapshots available in a directory, by date.
+
+  """
+  _SNAPSHOT_FILENAME_RE = re.compile(r'^GeoIPASNum2-(\d{8})\.csv$')
+
+  def __init__(self, maxmind_dir):
+    """ Lists the snapshots in a directory.
+
+        Args:
+          maxmind_dir (str): Directory containing GeoIPASNum2-YYYYMMDD.csv files.
+
+    """
+    self.maxmind_dir = maxmind_dir
+    snapshot_datetimes = []
+    try:
+      snapshot_filenames = os.listdir(maxmind_dir)
+    except OSError:
+      snapshot_filenames = []
+    for snapshot_filename in snapshot_filenames:
+      filename_match = self._SNAPSHOT_FILENAME_RE.match(snapshot_filename)
+      if filename_match is None:
+        continue
+      try:
+        snapshot_datetimes.append(datetime.datetime.strptime(filename_match.group(1), '%Y%m%d'))
+      except ValueError:
+        continue
+    self.snapshot_datetimes = sorted(snapshot_datetimes)
+
+  def __len__(self):
+    return len(self.snapshot_datetimes)
+
+  def find_nearest(self, target_datetime):
+    """ Finds the snapshot closest in time to a date.
+
+        Args:
+          target_datetime (datetime): Date to which the snapshot should be
+            closest.
+
+        Returns:
+          datetime: Date of the nearest snapshot, preferring the earlier
+          snapshot when two are equally close, or None if the directory has no
+          snapshots.
+
+    """
+    if not self.snapshot_datetimes:
+      return None
+    target_datetime = _to_naive_utc(target_datetime)
+    position = bisect.bisect_left(self.snapshot_datetimes, target_datetime)
+    candidates = self.snapshot_datetimes[max(0, position - 1):position + 1]
+    return min(candidates, key = lambda snapshot_datetime: abs(snapshot_datetime - target_datetime))
+
+
 class IPTranslationStrategyFactory(object):
 
   def __init__(self, file_opener = open):
     self._file_opener = file_opener
     self._cache = {}
+    self._snapshot_directories = {}
+
+  def create(self, ip_translation_spec, start_time = None):
+    """ Creates, or retrieves a previously created, IP translator for a spec.
 
-  def create(self, ip_translation_spec):
-    if ip_translation_spec in self._cache:
-      return self._cache[ip_translation_spec]
+        Args:
+          ip_translation_spec (IPTranslationStrategySpec): Specification of the
+          translator to create.
+
+          start_time (datetime, optional): Start of the data window the
+          translator will be used for. Required when the spec does not name
+          its MaxMind snapshots, in which case the snapshot closest to this
+          time is used.
+
+        Returns:
+          IPTranslationStrategy: The translator.
+
+    """
     if ip_translation_spec.strategy_name == 'maxmind':
-      ip_translator = self._create_maxmind_strategy(ip_translation_spec.params)
+      maxmind_dir = ip_translation_spec.params['maxmind_dir']
+      snapshot_datetimes = self._resolve_maxmind_snapshots(ip_translation_spec.params, start_time)
+      cache_key = ('maxmind', maxmind_dir, tuple(snapshot_datetimes))
+      if cache_key not in self._cache:
+        self._cache[cache_key] = self._create_maxmind_strategy(maxmind_dir, snapshot_datetimes)
+      return self._cache[cache_key]
     else:
-      ValueError('UnrecognizedIPTranslationStrategy')
-    self._cache[ip_translation_spec] = ip_translator
-    return ip_translator
+      raise ValueError('UnrecognizedIPTranslationStrategy')
+
+  def snapshot_identities(self, ip_translation_spec, start_time, end_time = None):
+    """ Identifies the MaxMind snapshots a translator created for a spec would
+        consult over a time window, without loading them.
+
+        Args:
+          ip_translation_spec (IPTranslationStrategySpec): Specification of the
+          translator.
+
+          start_time (datetime): Start of the time window, which also selects
+          the snapshot when the spec does not name its snapshots.
+
+          end_time (datetime, optional): End (exclusive) of the time window.
+          Defaults to no upper bound.
+
+        Returns:
+          list: (date, size, mtime) 3-tuples of the snapshots, in date order,
+          where date is a YYYY-MM-DD string and size and mtime are those of the
+          snapshot file, or None if the file does not exist.
+
+    """
+    if ip_translation_spec.strategy_name != 'maxmind':
+      raise ValueError('UnrecognizedIPTranslationStrategy')
+    maxmind_dir = ip_translation_spec.params['maxmind_dir']
+    snapshot_datetimes = sorted(self._resolve_maxmind_snapshots(ip_translation_spec.params, start_time))
+    identities = []
+    for snapshot_number in _find_snapshots_in_window(snapshot_datetimes, start_time, end_time):
+      snapshot_datetime = snapshot_datetimes[snapshot_number]
+      try:
+        snapshot_stat = os.stat(IPTranslationStrategyMaxMind.get_maxmind_snapshot_path(snapshot_datetime,
+                                                                                     maxmind_dir))
+        snapshot_size, snapshot_mtime = snapshot_stat.st_size, snapshot_stat.st_mtime
+      except OSError:
+        snapshot_size, snapshot_mtime = None, None
+      identities.append((snapshot_datetime.strftime('%Y-%m-%d'), snapshot_size, snapshot_mtime))
+    return identities
+
+  def _resolve_maxmind_snapshots(self, maxmind_params, start_time):
+    """ Determines the dates of the MaxMind snapshots to use for a spec.
+
+        Returns:
+          list: Snapshot datetimes, either as listed in the spec or, if it lists
+          none, the single snapshot in the MaxMind directory closest to
+          start_time.
 
-  def _create_maxmind_strategy(self, maxmind_params):
-    db_snapshot_strings = maxmind_params['db_snapshots']
-    if len(db_snapshot_strings) == 0:
+    """
+    db_snapshot_strings = maxmind_params.get('db_snapshots') or []
+    if len(db_snapshot_strings) > 0:
+      return [datetime.datetime.strptime(db_snapshot_string, '%Y-%m-%d')
+              for db_snapshot_string in db_snapshot_strings]
+    if start_time is None:
       raise ValueError('IPTranslationStrategyNoDatesSpecified')
 
     maxmind_dir = maxmind_params['maxmind_dir']
+    if maxmind_dir not in self._snapshot_directories:
+      self._snapshot_directories[maxmind_dir] = MaxMindSnapshotDirectory(maxmind_dir)
+    nearest_snapshot_datetime = self._snapshot_directories[maxmind_dir].find_nearest(start_time)
+    if nearest_snapshot_datetime is None:
+      raise MissingMaxMindError(maxmind_dir, 'No GeoIPASNum2-YYYYMMDD.csv snapshots found.')
+    logging.getLogger('telescope').debug('Using MaxMind snapshot from %s for data starting %s.',
+                                         nearest_snapshot_datetime.strftime('%Y-%m-%d'), start_time)
+    return [nearest_snapshot_datetime]
+
+  def _create_maxmind_strategy(self, maxmind_dir, snapshot_datetimes):
     snapshots = []
-    for db_snapshot_string in db_snapshot_strings:
-      snapshot_datetime = datetime.datetime.strptime(db_snapshot_string, '%Y-%m-%d')
+    for snapshot_datetime in snapshot_datetimes:
       snapshot_path = IPTranslationStrategyMaxMind.get_maxmind_snapshot_path(snapshot_datetime, maxmind_dir)
-      try:
-        snapshot_file = self._file_opener(snapshot_path, 'rb')
-        snapshot = (snapshot_datetime, snapshot_file)
-        snapshots.append(snapshot)
-      except IOError as io_error:
-        raise iptranslation.MissingMaxMindError(snapshot_filename, io_error)
+      snapshots.append((snapshot_datetime, self._load_maxmind_snapshot(snapshot_path)))
 
     return IPTranslationStrategyMaxMind(snapshots)
 
+  def _load_maxmind_snapshot(self, snapshot_path):
+    """ Loads the block index of a MaxMind snapshot, preferring the binary
+        sidecar file written by a previous parse of the same snapshot.
+
+        Args:
+          snapshot_path (str): Path to the MaxMind snapshot CSV file.
+
+        Returns:
+          MaxMindBlockIndex: Index of the blocks in the snapshot.
+
+        Notes:
+          * The sidecar is only used if it was built from a snapshot of the
+            same size and modification time, otherwise the CSV is parsed and
+            the sidecar is rewritten.
+    """
+    logger = logging.getLogger('telescope')
+    sidecar_path = MaxMindBlockIndex.get_sidecar_path(snapshot_path)
+    try:
+      snapshot_stat = os.stat(snapshot_path)
+    except OSError:
+      snapshot_stat = None
+
+    if snapshot_stat is not None:
+      block_index = MaxMindBlockIndex.from_sidecar(sidecar_path, snapshot_stat.st_size,
+                                                   snapshot_stat.st_mtime)
+      if block_index is not None:
+        logger.debug('Loaded %d blocks from MaxMind sidecar %s', len(block_index), sidecar_path)
+        return block_index
+
+    try:
+      snapshot_file = self._file_opener(snapshot_path, 'rb')
+    except IOError as io_error:
+      raise MissingMaxMindError(snapshot_path, io_error)
+    try:
+      block_index = MaxMindBlockIndex.from_csv(snapshot_file)
+    finally:
+      snapshot_file.close()
+
+    if snapshot_stat is not None:
+      try:
+        block_index.write_sidecar(sidecar_path, snapshot_stat.st_size, snapshot_stat.st_mtime)
+      except (IOError, OSError) as caught_error:
+        logger.warning('Could not write MaxMind sidecar %s: %s', sidecar_path, caught_error)
+    return block_index
+
+
+class MaxMindBlockIndex(object):
+  """ Compact, columnar index of the network blocks in a MaxMind ASN snapshot.
+
+      Block boundaries are held in parallel integer arrays and every distinct
+      ASN name is stored once in a name table. The blocks belonging to each
+      name are grouped in a compressed (offsets, rows) layout, and the name
+      table is indexed by the lowercase word tokens of each name. The tokens
+      are in turn indexed by their substrings of up to three characters, so
+      that a provider search only examines tokens and names that can possibly
+      match rather than every token, name or block in the snapshot.
+
+      An index can be saved to a binary sidecar file next to its snapshot and
+      memory-mapped back in, which avoids re-parsing the CSV and lets
+      concurrent processes share the same pages.
+
+  """
+  _SIDECAR_MAGIC = 'TLSCPASN'
+  _SIDECAR_VERSION = 2
+  # magic, version, snapshot size, snapshot mtime, block count, name count,
+  # name table length
+  _SIDECAR_HEADER = struct.Struct('<8sIQdIII')
+  _SIDECAR_ITEM_TYPE = numpy.dtype('<u4')
+  _MERGED_BLOCK_TYPE = numpy.dtype([('start', '<u4'), ('end', '<u4'), ('name_id', '<u4')])
+
+  def __init__(self, block_starts, block_ends, block_name_ids, asn_names,
+               name_block_offsets = None, name_block_rows = None):
+    """ Creates a new index over already-parsed snapshot columns.
+
+        Args:
+          block_starts (sequence): First address of each block.
+          block_ends (sequence): Last address of each block.
+          block_name_ids (sequence): Position in asn_names of each block's name.
+          asn_names (list): Table of distinct ASN names.
+          name_block_offsets (sequence, optional): For name i, the rows of its
+            blocks are name_block_rows[offsets[i]:offsets[i + 1]]. Computed
+            from block_name_ids if not specified.
+          name_block_rows (sequence, optional): Block rows grouped by name.
+
+    """
+    self.block_starts = block_starts
+    self.block_ends = block_ends
+    self.block_name_ids = block_name_ids
+    self.asn_names = asn_names
+    if name_block_offsets is None or name_block_rows is None:
+      name_block_offsets, name_block_rows = self._group_blocks_by_name(
+          block_name_ids, len(asn_names))
+    self.name_block_offsets = name_block_offsets
+    self.name_block_rows = name_block_rows
+    self._token_index = None
+    self._column_arrays = None
+
+  def __len__(self):
+    return len(self.block_starts)
+
+  @classmethod
+  def from_csv(cls, snapshot_file):
+    """ Parses a MaxMind snapshot file into a new index.
+
+        Args:
+          snapshot_file (file): File handle to a MaxMind ASN snapshot in CSV
+            format of (block_start, block_end, asn_name).
+
+        Returns:
+          MaxMindBlockIndex: Index of the blocks in the snapshot.
+
+    """
+    block_starts = array.array('L')
+    block_ends = array.array('L')
+    block_name_ids = array.array('L')
+    asn_names = []
+    asn_name_ids = {}
+
+    for block_row in csv.reader(snapshot_file):
+      if len(block_row) < 3:
+        continue
+      asn_name = block_row[2]
+      asn_name_id = asn_name_ids.get(asn_name)
+      if asn_name_id is None:
+        asn_name_id = len(asn_names)
+        asn_name_ids[asn_name] = asn_name_id
+        asn_names.append(asn_name)
+      block_starts.append(int(block_row[0]))
+      block_ends.append(int(block_row[1]))
+      block_name_ids.append(asn_name_id)
+
+    # Address lookups binary search the block starts, so keep the rows in
+    # address order even if the snapshot file is not.
+    start_values = numpy.asarray(block_starts)
+    if len(start_values) > 1 and (numpy.diff(start_values) < 0).any():
+      sorted_rows = numpy.argsort(start_values, kind = 'mergesort')
+      block_starts, block_ends, block_name_ids = [
+          array.array('L', numpy.asarray(column)[sorted_rows].tolist())
+          for column in (block_starts, block_ends, block_name_ids)]
+
+    return cls(block_starts, block_ends, block_name_ids, asn_names)
+
+  @staticmethod
+  def get_sidecar_path(snapshot_path):
+    return snapshot_path + '.idx'
+
+  @classmethod
+  def from_sidecar(cls, sidecar_path, snapshot_size, snapshot_mtime):
+    """ Memory-maps an index previously saved with write_sidecar.
+
+        Args:
+          sidecar_path (str): Path to the sidecar file.
+          snapshot_size (int): Size in bytes of the snapshot the index should
+            have been built from.
+          snapshot_mtime (float): Modification time of that snapshot.
+
+        Returns:
+          MaxMindBlockIndex: The mapped index, or None if the sidecar does not
+          exist, is malformed, or was built from a different snapshot.
+
+    """
+    try:
+      with open(sidecar_path, 'rb') as sidecar_file:
+        sidecar_map = mmap.mmap(sidecar_file.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+      return None
+
+    header = cls._SIDECAR_HEADER
+    if len(sidecar_map) < header.size:
+      return None
+    (magic, version, built_size, built_mtime, block_count, name_count,
+     names_length) = header.unpack_from(sidecar_map, 0)
+    if (magic != cls._SIDECAR_MAGIC or version != cls._SIDECAR_VERSION or
+        built_size != snapshot_size or built_mtime != snapshot_mtime):
+      return None
+
+    item_size = cls._SIDECAR_ITEM_TYPE.itemsize
+    array_lengths = (block_count, block_count, block_count, name_count + 1, block_count)
+    names_offset = header.size + sum(array_lengths) * item_size
+    if len(sidecar_map) != names_offset + names_length:
+      return None
+
+    columns = []
+    offset = header.size
+    for array_length in array_lengths:
+      columns.append(numpy.frombuffer(sidecar_map, dtype = cls._SIDECAR_ITEM_TYPE,
+                                      count = array_length, offset = offset))
+      offset += array_length * item_size
+
+    if name_count > 0:
+      asn_names = sidecar_map[names_offset:names_offset + names_length].split('\0')
+    else:
+      asn_names = []
+    block_starts, block_ends, block_name_ids, name_block_offsets, name_block_rows = columns
+    return cls(block_starts, block_ends, block_name_ids, asn_names,
+               name_block_offsets, name_block_rows)
+
+  def write_sidecar(self, sidecar_path, snapshot_size, snapshot_mtime):
+    """ Saves the index to a binary sidecar file that can be memory-mapped
+        with from_sidecar.
+
+        Args:
+          sidecar_path (str): Path to which to write the sidecar file.
+          snapshot_size (int): Size in bytes of the snapshot the index was built
+            from.
+          snapshot_mtime (float): Modification time of that snapshot.
+
+        Notes:
+          * The file is written under a temporary name and renamed into place,
+            so readers never observe a partially written sidecar.
+    """
+    names_blob = '\0'.join(self.asn_names)
+    header = self._SIDECAR_HEADER.pack(self._SIDECAR_MAGIC, self._SIDECAR_VERSION,
+                                       snapshot_size, snapshot_mtime, len(self),
+                                       len(self.asn_names), len(names_blob))
+    sidecar_dir = os.path.dirname(sidecar_path) or '.'
+    temp_fd, temp_path = tempfile.mkstemp(dir = sidecar_dir, prefix = '.maxmind-')
+    try:
+      with os.fdopen(temp_fd, 'wb') as sidecar_file:
+        sidecar_file.write(header)
+        for column in (self.block_starts, self.block_ends, self.block_name_ids,
+                       self.name_block_offsets, self.name_block_rows):
+          sidecar_file.write(numpy.asarray(column, dtype = self._SIDECAR_ITEM_TYPE).tostring())
+        sidecar_file.write(names_blob)
+      os.rename(temp_path, sidecar_path)
+    except:
+      os.remove(temp_path)
+      raise
+
+  def find_name_ids(self, search_names):
+    """ Finds the names in the name table that contain any of the search names.
+
+        Args:
+          search_names (list): Names to search for, matched as case-insensitive
+            substrings of ASN names.
+
+        Returns:
+          list: Sorted ids of the matching entries in the name table.
+
+    """
+    if self._token_index is None:
+      self._token_index = _TokenIndex(self.asn_names)
+
+    matching_name_ids = set()
+    for search_name in search_names:
+      search_name_lower = search_name.lower()
+      search_tokens = _tokenize_asn_name(search_name_lower)
+      if search_tokens:
+        # Any word of the search name must appear within a word of every name
+        # that contains it, so only names sharing such a word are candidates.
+        candidate_name_ids = self._token_index.find_name_ids(max(search_tokens, key = len))
+      else:
+        candidate_name_ids = xrange(len(self.asn_names))
+
+      for name_id in candidate_name_ids:
+        if search_name_lower in self.asn_names[name_id].lower():
+          matching_name_ids.add(name_id)
+    return sorted(matching_name_ids)
+
+  def block_rows_for_names(self, name_ids):
+    """ Lists the rows of all blocks that belong to a set of names.
+
+        Args:
+          name_ids (list): Ids of entries in the name table.
+
+        Returns:
+          list: Sorted block rows associated with any of the names.
+
+    """
+    block_rows = []
+    for name_id in name_ids:
+      block_rows.extend(self.name_block_rows[self.name_block_offsets[name_id]:
+                                             self.name_block_offsets[name_id + 1]])
+    block_rows.sort()
+    return block_rows
+
+  @classmethod
+  def merge(cls, block_indices):
+    """ Merges the indices of several snapshots into one index of their
+        distinct blocks.
+
+        Args:
+          block_indices (list): MaxMindBlockIndex of each snapshot.
+
+        Returns:
+          tuple: A 2-tuple of the merged MaxMindBlockIndex and a uint8 array
+          with one row per snapshot of bit-packed flags, in block order, of the
+          merged blocks present in that snapshot.
+
+        Notes:
+          * A block is distinct by its (start, end, ASN name), so the merged
+            index grows only with the blocks that change between snapshots.
+    """
+    asn_names = []
+    asn_name_ids = {}
+    snapshot_blocks = []
+    for block_index in block_indices:
+      merged_name_ids = numpy.empty(len(block_index.asn_names), dtype = numpy.int64)
+      for name_id, asn_name in enumerate(block_index.asn_names):
+        merged_name_id = asn_name_ids.get(asn_name)
+        if merged_name_id is None:
+          merged_name_id = len(asn_names)
+          asn_name_ids[asn_name] = merged_name_id
+          asn_names.append(asn_name)
+        merged_name_ids[name_id] = merged_name_id
+
+      blocks = numpy.empty(len(block_index), dtype = cls._MERGED_BLOCK_TYPE)
+      blocks['start'] = block_index.block_starts
+      blocks['end'] = block_index.block_ends
+      blocks['name_id'] = merged_name_ids[numpy.asarray(block_index.block_name_ids, dtype = numpy.int64)]
+      snapshot_blocks.append(blocks)
+
+    # numpy.unique sorts by (start, end, name_id), so the merged rows stay in
+    # address order.
+    merged_blocks, merged_rows = numpy.unique(numpy.concatenate(snapshot_blocks),
+                                              return_inverse = True)
+    is_block_in_snapshot = numpy.zeros((len(block_indices), len(merged_blocks)), dtype = numpy.bool_)
+    first_row = 0
+    for snapshot_number, blocks in enumerate(snapshot_blocks):
+      is_block_in_snapshot[snapshot_number, merged_rows[first_row:first_row + len(blocks)]] = True
+      first_row += len(blocks)
+
+    merged_index = cls(numpy.ascontiguousarray(merged_blocks['start']),
+                       numpy.ascontiguousarray(merged_blocks['end']),
+                       numpy.ascontiguousarray(merged_blocks['name_id']),
+                       asn_names)
+    return merged_index, numpy.packbits(is_block_in_snapshot, axis = 1)
+
+  def find_previous_valid_rows(self, block_validity):
+    """ Maps each block to the nearest block at or before it that is flagged
+        in a bitmap, which lets lookups restricted to the flagged blocks take a
+        single step after their binary search.
+
+        Args:
+          block_validity (numpy.ndarray): Bit-packed flags, in block order, of
+            the blocks to consider, such as one row of the bitmaps returned by
+            merge.
+
+        Returns:
+          numpy.ndarray: int64 array with, for each block row, the last flagged
+          row at or before it, or -1 if there is none.
+
+    """
+    is_block_valid = numpy.unpackbits(block_validity)[:len(self)].astype(numpy.bool_)
+    valid_rows = numpy.where(is_block_valid, numpy.arange(len(self), dtype = numpy.int64), -1)
+    return numpy.maximum.accumulate(valid_rows) if len(valid_rows) > 0 else valid_rows
+
+  def lookup_address(self, ip_address, previous_valid_rows = None):
+    """ Finds the block containing an address.
+
+        Args:
+          ip_address (int): Integer value of an IPv4 address.
+          previous_valid_rows (numpy.ndarray, optional): Rows of the blocks to
+            consider, as returned by find_previous_valid_rows. Defaults to every
+            block.
+
+        Returns:
+          int: Id in the name table of the containing block's name, or None if
+          no block contains the address.
+
+    """
+    block_row = bisect.bisect_right(self.block_starts, ip_address) - 1
+    if previous_valid_rows is not None and block_row >= 0:
+      # Blocks of one snapshot do not overlap, so the block that can contain
+      # the address is the last valid one starting at or before it.
+      block_row = int(previous_valid_rows[block_row])
+    if block_row >= 0 and ip_address <= self.block_ends[block_row]:
+      return int(self.block_name_ids[block_row])
+    return None
+
+  def lookup_addresses(self, ip_addresses, previous_valid_rows = None):
+    """ Finds the blocks containing each of an array of addresses.
+
+        Args:
+          ip_addresses (numpy.ndarray): Integer values of IPv4 addresses.
+          previous_valid_rows (numpy.ndarray, optional): Rows of the blocks to
+            consider, as for lookup_address.
+
+        Returns:
+          numpy.ndarray: int64 array of the ids in the name table of each
+          address's containing block, with -1 where no block contains it.
+
+    """
+    if self._column_arrays is None:
+      self._column_arrays = (numpy.asarray(self.block_starts, dtype = numpy.int64),
+                             numpy.asarray(self.block_ends, dtype = numpy.int64),
+                             numpy.asarray(self.block_name_ids, dtype = numpy.int64))
+    block_starts, block_ends, block_name_ids = self._column_arrays
+
+    ip_addresses = numpy.asarray(ip_addresses, dtype = numpy.int64)
+    block_rows = numpy.searchsorted(block_starts, ip_addresses, side = 'right') - 1
+    if previous_valid_rows is not None and len(block_starts) > 0:
+      block_rows = numpy.where(block_rows >= 0, previous_valid_rows[numpy.clip(block_rows, 0, None)], -1)
+    clipped_rows = numpy.clip(block_rows, 0, None)
+    name_ids = numpy.full(ip_addresses.shape, -1, dtype = numpy.int64)
+    if len(block_starts) > 0:
+      is_contained = (block_rows >= 0) & (ip_addresses <= block_ends[clipped_rows])
+      name_ids[is_contained] = block_name_ids[clipped_rows[is_contained]]
+    return name_ids
+
+  @staticmethod
+  def _group_blocks_by_name(block_name_ids, name_count):
+    """ Counting sort of block rows by name id. """
+    block_name_ids = numpy.asarray(block_name_ids, dtype = numpy.int64)
+    name_block_offsets = numpy.zeros(name_count + 1, dtype = numpy.int64)
+    name_block_offsets[1:] = numpy.cumsum(numpy.bincount(block_name_ids, minlength = name_count))
+    name_block_rows = numpy.argsort(block_name_ids, kind = 'mergesort')
+    return name_block_offsets, name_block_rows
+
+
+
+class _TokenIndex(object):
+  """ Index of the lowercase word tokens of a table of ASN names, which finds
+      the names with a token containing a given string.
+
+      Every token is listed under each of its distinct substrings of up to
+      _GRAM_LENGTH characters. A search string of that length or less is
+      looked up directly, and a longer one is only compared with the tokens
+      listed under its rarest substring of that length.
+
+  """
+  _GRAM_LENGTH = 3
+
+  def __init__(self, asn_names):
+    token_ids = {}
+    self._token_name_ids = []
+    self._tokens = []
+    for name_id, asn_name in enumerate(asn_names):
+      for token in set(_tokenize_asn_name(asn_name.lower())):
+        token_id = token_ids.get(token)
+        if token_id is None:
+          token_id = len(self._tokens)
+          token_ids[token] = token_id
+          self._tokens.append(token)
+          self._token_name_ids.append(array.array('L'))
+        self._token_name_ids[token_id].append(name_id)
+
+    self._gram_token_ids = {}
+    for token_id, token in enumerate(self._tokens):
+      for gram in self._grams(token):
+        self._gram_token_ids.setdefault(gram, array.array('L')).append(token_id)
+
+  def find_name_ids(self, search_token):
+    """ Finds the names that have a token containing search_token.
+
+        Returns:
+          set: Ids of the names in the name table.
+
+    """
+    if len(search_token) <= self._GRAM_LENGTH:
+      matching_token_ids = self._gram_token_ids.get(search_token, ())
+    else:
+      rarest_gram_token_ids = min(
+          (self._gram_token_ids.get(search_token[gram_start:gram_start + self._GRAM_LENGTH], ())
+           for gram_start in xrange(len(search_token) - self._GRAM_LENGTH + 1)), key = len)
+      matching_token_ids = [token_id for token_id in rarest_gram_token_ids
+                            if search_token in self._tokens[token_id]]
+
+    name_ids = set()
+    for token_id in matching_token_ids:
+      name_ids.update(self._token_name_ids[token_id])
+    return name_ids
+
+  @classmethod
+  def _grams(cls, token):
+    grams = set()
+    for gram_length in xrange(1, cls._GRAM_LENGTH + 1):
+      for gram_start in xrange(len(token) - gram_length + 1):
+        grams.add(token[gram_start:gram_start + gram_length])
+    return grams
+
+
+def _tokenize_asn_name(asn_name):
+  return re.findall(r'\w+', asn_name)
+
+
+def _find_snapshots_in_window(snapshot_datetimes, start_time, end_time):
+  """ Lists the snapshots valid at any point in [start_time, end_time).
+
+      Args:
+        snapshot_datetimes (list): Dates of the snapshots, in date order.
+        start_time (datetime): Start of the window, or None for no lower bound.
+        end_time (datetime): End of the window, or None for no upper bound.
+
+      Returns:
+        tuple: Positions of the snapshots in date order.
+
+  """
+  start_time = _to_naive_utc(start_time)
+  end_time = _to_naive_utc(end_time)
+  snapshot_numbers = []
+  for snapshot_number in range(len(snapshot_datetimes)):
+    is_first = snapshot_number == 0
+    is_last = snapshot_number == len(snapshot_datetimes) - 1
+    valid_from = snapshot_datetimes[snapshot_number]
+    valid_until = None if is_last else snapshot_datetimes[snapshot_number + 1]
+    if ((is_first or end_time is None or end_time > valid_from) and
+        (valid_until is None or start_time is None or start_time < valid_until)):
+      snapshot_numbers.append(snapshot_number)
+  return tuple(snapshot_numbers)
+
+
+def _to_naive_utc(datetime_value):
+  if datetime_value is None or datetime_value.tzinfo is None:
+    return datetime_value
+  return datetime_value.astimezone(utils.UTC()).replace(tzinfo = None)
+
 
 class IPTranslationStrategy(object):
 
-  def find_ip_blocks(self, asn_search_name):
+  def find_ip_blocks(self, asn_search_name, start_time = None, end_time = None):
+    raise NotImplementedError()
+
+  def lookup_ip(self, ip_address, at_time = None):
+    raise NotImplementedError()
+
+  def lookup_ips_batch(self, ip_addresses, at_time = None):
     raise NotImplementedError()
 
 class IPTranslationStrategyMaxMind(IPTranslationStrategy):
@@ -83,55 +756,165 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
 
         Args:
          snapshots (list): A list of 2-tuples where the first element is a datetime
-         and the second element is a file handle to the snapshot at that date.
+         and the second element is either a file handle to the snapshot at that
+         date or an already loaded MaxMindBlockIndex of it.
 
+        Notes:
+          * Each snapshot is considered valid from its own date until the date
+            of the next snapshot. The earliest snapshot is also used for times
+            before its date, and the latest for all times after its date.
+          * When there are several snapshots, their blocks are merged into one
+            store of distinct blocks, with a bitmap per snapshot recording which
+            of those blocks it contains. Searches consult the bitmaps of the
+            snapshots they concern as they run, and lookups a map, built from
+            the bitmap on first use, of each block to the nearest block at or
+            before it in the snapshot, so no per-snapshot copy of the blocks is
+            kept.
     """
     self.logger = logging.getLogger('telescope')
-    if len(snapshots) > 1:
-      raise NotImplementedError('Multiple MaxMind snapshot processing not yet implemented.')
-    snapshot_file = snapshots[0][1]
-    self._network_map = self._parse_maxmind_snapshot(snapshot_file)
+    snapshots = sorted(snapshots, key = lambda snapshot: snapshot[0])
+    self._snapshot_datetimes = [snapshot_datetime for snapshot_datetime, _ in snapshots]
+
+    block_indices = []
+    for _, snapshot in snapshots:
+      if not isinstance(snapshot, MaxMindBlockIndex):
+        snapshot = self._parse_maxmind_snapshot(snapshot)
+      block_indices.append(snapshot)
+
+    if len(block_indices) == 1:
+      self._block_index = block_indices[0]
+      self._snapshot_validity = None
+    else:
+      self._block_index, self._snapshot_validity = MaxMindBlockIndex.merge(block_indices)
+      self.logger.debug('Merged %d blocks from %d MaxMind snapshots into %d distinct blocks',
+                        sum(len(block_index) for block_index in block_indices),
+                        len(block_indices), len(self._block_index))
     self._cache = {}
+    self._asn_name_array = None
+    self._previous_valid_rows = {}
 
-  def find_ip_blocks(self, asn_search_name):
-    """ Search memory-cached copy of map of network maps.
-        Currently, searches each (block_start_address, block_end_address, asn_name)
-        list based on a case-insensitive match of the AS name.
+  def find_ip_blocks(self, asn_search_name, start_time = None, end_time = None):
+    """ Search memory-cached index of network blocks.
+        Currently, finds each (block_start_address, block_end_address) pair
+        whose AS name contains, case-insensitively, the AS names associated
+        with the search name.
 
         Args:
           asn_search_name (str): string to search AS names in order to identify network
           blocks.
 
+          start_time (datetime, optional): Start of the time window in which
+          blocks must be valid. Defaults to no lower bound.
+
+          end_time (datetime, optional): End (exclusive) of the time window in
+          which blocks must be valid. Defaults to no upper bound.
+
         Returns:
-          list: Matching tuples of (block_start_address, block_end_address,
-          asn_name), empty if no network found.
+          list: Matching tuples of (block_start_address, block_end_address),
+          in address order and empty if no network found. A block is included
+          if it appears in any snapshot valid during the time window.
 
         Notes:
-          * Maintains and consults an internal cache of results since lookup
-            process is relatively slow and results should not change.
+          * Maintains and consults an internal cache of results since results
+            should not change.
     """
-    if self._cache.has_key(asn_search_name):
-      return self._cache[asn_search_name]
+    snapshot_numbers = _find_snapshots_in_window(self._snapshot_datetimes, start_time, end_time)
+    cache_key = (asn_search_name, snapshot_numbers)
+    if self._cache.has_key(cache_key):
+      return self._cache[cache_key]
+
+    block_index = self._block_index
+    matching_name_ids = block_index.find_name_ids(self._translate_short_name(asn_search_name))
+    for name_id in matching_name_ids:
+      self.logger.debug(('Found IP block associated with name {asn_name} searching for term '
+                         '{asn_search_name}.').format(asn_name = block_index.asn_names[name_id],
+                                                    asn_search_name = asn_search_name))
+
+    block_rows = block_index.block_rows_for_names(matching_name_ids)
+    if self._snapshot_validity is not None:
+      is_block_in_window = self._find_blocks_in_snapshots(snapshot_numbers)
+      block_rows = [block_row for block_row in block_rows if is_block_in_window[block_row]]
 
-    notification_cache = set()
     blocks_to_return = []
-
-    asn_search_terms = self._translate_short_name(asn_search_name)
-    asn_name_re = re.compile(asn_search_terms, re.IGNORECASE)
-
-    for block_dict in self._network_map:
-      if asn_name_re.search(block_dict['asn_name']) is not None:
-        if not (block_dict['asn_name'] in notification_cache):
-          self.logger.debug(('Found IP block associated with name {asn_name} searching for term '
-                             '{asn_search_name}.').format(asn_name = block_dict['asn_name'],
-                                                        asn_search_name = asn_search_name))
-          notification_cache.add(block_dict['asn_name'])
-        block_start = int(block_dict['block_start'])
-        block_end = int(block_dict['block_end'])
-        blocks_to_return.append((block_start, block_end))
-    self._cache[asn_search_name] = blocks_to_return
+    for block_row in block_rows:
+      block = (int(block_index.block_starts[block_row]), int(block_index.block_ends[block_row]))
+      # Merged snapshots may hold the same range under several names.
+      if not blocks_to_return or blocks_to_return[-1] != block:
+        blocks_to_return.append(block)
+    self._cache[cache_key] = blocks_to_return
     return blocks_to_return
 
+  def lookup_ip(self, ip_address, at_time = None):
+    """ Finds the AS name associated with an IP address.
+
+        Args:
+          ip_address (str or int): IPv4 address, either in dotted-quad notation
+          or as its integer value.
+
+          at_time (datetime, optional): Time at which to resolve the address,
+          which selects the snapshot to use. Defaults to the latest snapshot.
+
+        Returns:
+          str: AS name of the block containing the address, or None if the
+          address is not in any block.
+
+    """
+    if isinstance(ip_address, basestring):
+      ip_address = ip_address_to_int(ip_address)
+    name_id = self._block_index.lookup_address(ip_address, self._get_previous_valid_rows(at_time))
+    if name_id is None:
+      return None
+    return self._block_index.asn_names[name_id]
+
+  def lookup_ips_batch(self, ip_addresses, at_time = None):
+    """ Finds the AS names associated with an array of IP addresses.
+
+        Args:
+          ip_addresses (numpy.ndarray): Integer values of IPv4 addresses, as
+          produced by ip_addresses_to_ints.
+
+          at_time (datetime, optional): Time at which to resolve the addresses,
+          which selects the snapshot to use. Defaults to the latest snapshot.
+
+        Returns:
+          numpy.ndarray: Object array of the AS name of the block containing
+          each address, None where the address is not in any block.
+
+        Notes:
+          * The lookup is a single vectorized binary search over the sorted
+            block starts, so it is suitable for millions of addresses at once.
+    """
+    if self._asn_name_array is None:
+      # The trailing None is selected by the -1 that marks unmatched addresses.
+      self._asn_name_array = numpy.array(list(self._block_index.asn_names) + [None], dtype = object)
+    return self._asn_name_array[self._block_index.lookup_addresses(ip_addresses,
+                                                                   self._get_previous_valid_rows(at_time))]
+
+  def _find_blocks_in_snapshots(self, snapshot_numbers):
+    """ Flags, in block order, the merged blocks that appear in any of the
+        specified snapshots.
+    """
+    if not snapshot_numbers:
+      return numpy.zeros(len(self._block_index), dtype = numpy.bool_)
+    packed_validity = numpy.bitwise_or.reduce(self._snapshot_validity[list(snapshot_numbers)], axis = 0)
+    return numpy.unpackbits(packed_validity)[:len(self._block_index)].astype(numpy.bool_)
+
+  def _get_previous_valid_rows(self, at_time):
+    """ Gets, computing it on first use, the map of each merged block to the
+        nearest block at or before it in the snapshot valid at a time, or None
+        if there is only one snapshot.
+    """
+    if self._snapshot_validity is None:
+      return None
+    if at_time is None:
+      snapshot_number = len(self._snapshot_datetimes) - 1
+    else:
+      snapshot_number = max(0, bisect.bisect_right(self._snapshot_datetimes, _to_naive_utc(at_time)) - 1)
+    if snapshot_number not in self._previous_valid_rows:
+      self._previous_valid_rows[snapshot_number] = self._block_index.find_previous_valid_rows(
+          self._snapshot_validity[snapshot_number])
+    return self._previous_valid_rows[snapshot_number]
+
   @staticmethod
   def get_maxmind_snapshot_path(snapshot_datetime, maxmind_dir):
     """ Generates the expected path of the MaxMind snapshot file based on the
@@ -149,36 +932,32 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
     return os.path.join(maxmind_dir, snapshot_filename)
 
   def _parse_maxmind_snapshot(self, snapshot_file):
-    """ Parses a MaxMind snapshot file into a list of blocks with associated
+    """ Parses a MaxMind snapshot file into an index of blocks with associated
         ASN names.
 
         Args:
-          snapshot_filename (str): Filename of MaxMind snapshot to parse.
+          snapshot_file (file): File handle to the MaxMind snapshot to parse.
 
         Returns:
-          list: A list of dicts, each containing a 'block_start', 'block_end',
-          and 'asn_name' entry, according to entries in the MaxMind snapshot.
+          MaxMindBlockIndex: Index of the blocks and ASN names in the snapshot.
 
     """
-    block_rows = []
-    csvReader = csv.DictReader(snapshot_file, fieldnames=['block_start', 'block_end', 'asn_name'])
-    for block_row in csvReader:
-      block_rows.append(block_row)
-    self.logger.debug('Parsed %d blocks from MaxMind snapshot', len(block_rows))
-    return block_rows
+    block_index = MaxMindBlockIndex.from_csv(snapshot_file)
+    self.logger.debug('Parsed %d blocks from MaxMind snapshot', len(block_index))
+    return block_index
 
   def _translate_short_name(self, short_name):
-    """ Translates an ISP shortname into a regex that matches all company names
-        that are part of the ISP.
+    """ Translates an ISP shortname into the list of company names that are
+        part of the ISP.
 
         Args:
           short_name (str): A short name for an ISP, such as 'twc' for Time Warner
           Cable.
 
         Returns:
-          str: A regex string that matches company names that are part of the
-          specified ISP. For example, level3 translates to:
-            '(Level 3 Communications)|(GBLX)'
+          list: Names matching company names that are part of the specified
+          ISP. For example, level3 translates to:
+            ['Level 3 Communications', 'GBLX']
 
     """
     short_name_map = {
@@ -188,23 +967,6 @@ class IPTranslationStrategyMaxMind(IPTranslationStrategy):
           'cablevision': ['Cablevision Systems', 'CSC Holdings', 'Cablevision Infrastructure', 'Cablevision Corporate', 'Optimum Online', 'Optimum WiFi', 'Optimum Network']
         }
     if short_name_map.has_key(short_name):
-      long_names = short_name_map[short_name]
-      return self._regex_xor_names(long_names)
-
-    return re.escape(short_name)
+      return short_name_map[short_name]
 
-  def _regex_xor_names(self, names):
-    """ Converts a list of names into a regex that matches any of the names.
-
-        Args:
-          names (list): A list of ISP names.
-
-        Returns:
-          str: A regex that matches any name in the list. For example, the
-          list ['foo', 'bar', 'baz'] would result in '(foo)|(bar)|(baz)'.
-
-    """
-    escaped_names = []
-    for name in names:
-      escaped_names.append(re.escape(name))
-    return '(' + ')|('.join(escaped_names) + ')'
+    return [short_name]
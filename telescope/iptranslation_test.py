@@ -2,7 +2,12 @@ import datetime
 import io
 import iptranslation
 import mock
+import numpy
+import os
+import shutil
+import tempfile
 import unittest
+import utils
 
 from mock import patch
 
@@ -77,5 +82,324 @@ class IPTranslationStrategyMaxMindTest(unittest.TestCase):
         ]
     self.assertBlocksMatchForSearch(mock_file_contents, 'centurylink', expected_blocks)
 
+  def testSubstringWithinWordMatches(self):
+    mock_file_contents = """1,4,"Comcast Cable Communications, Inc."
+5,10,"FooISP"
+11,14,"NotComcastic Networks"
+20,25,"Comcast Business"
+"""
+    expected_blocks = [
+        (1, 4),
+        (11, 14),
+        (20, 25)
+        ]
+    self.assertBlocksMatchForSearch(mock_file_contents, 'comcast', expected_blocks)
+
+  def testSearchWithoutWordCharacters(self):
+    mock_file_contents = """1,4,"AT&T Services"
+5,10,"FooISP"
+"""
+    self.assertBlocksMatchForSearch(mock_file_contents, '&', [(1, 4)])
+
+  def testBlocksReturnedInSnapshotOrder(self):
+    mock_file_contents = """1,4,"Level 3 Communications"
+5,10,"GBLX"
+11,14,"Level 3 Communications"
+"""
+    expected_blocks = [
+        (1, 4),
+        (5, 10),
+        (11, 14)
+        ]
+    self.assertBlocksMatchForSearch(mock_file_contents, 'level3', expected_blocks)
+
+  def testNoMatchingBlocks(self):
+    mock_file_contents = """5,10,"FooISP"
+"""
+    self.assertBlocksMatchForSearch(mock_file_contents, 'verizon', [])
+
+  def testLookupIp(self):
+    mock_file_contents = """16777216,16777471,"FooISP"
+16777472,16777727,"BarIsp"
+16778240,16779263,"FooISP"
+"""
+    translation_strategy = self.createIPTranslationStrategy(mock_file_contents)
+    self.assertEqual('FooISP', translation_strategy.lookup_ip('1.0.0.0'))
+    self.assertEqual('BarIsp', translation_strategy.lookup_ip('1.0.1.255'))
+    self.assertEqual('FooISP', translation_strategy.lookup_ip(16778241))
+    self.assertIsNone(translation_strategy.lookup_ip('1.0.2.0'))
+    self.assertIsNone(translation_strategy.lookup_ip('0.255.255.255'))
+    self.assertIsNone(translation_strategy.lookup_ip('1.0.8.0'))
+    self.assertRaises(ValueError, translation_strategy.lookup_ip, 'not an ip')
+
+  def testLookupIpsBatch(self):
+    mock_file_contents = """20,25,"BarIsp"
+5,10,"FooISP"
+"""
+    translation_strategy = self.createIPTranslationStrategy(mock_file_contents)
+    ip_addresses = numpy.array([4, 5, 10, 11, 20, 25, 26], dtype = numpy.uint32)
+    self.assertListEqual([None, 'FooISP', 'FooISP', None, 'BarIsp', 'BarIsp', None],
+                         list(translation_strategy.lookup_ips_batch(ip_addresses)))
+    self.assertListEqual([(5, 10), (20, 25)], translation_strategy.find_ip_blocks('isp'))
+
+  def testIpAddressesToInts(self):
+    self.assertEqual(16777217, iptranslation.ip_address_to_int('1.0.0.1'))
+    self.assertListEqual([16777217, 4294967295],
+                         list(iptranslation.ip_addresses_to_ints(['1.0.0.1', '255.255.255.255'])))
+
+class IPTranslationStrategyMaxMindMultipleSnapshotsTest(unittest.TestCase):
+
+  def setUp(self):
+    snapshot_contents = [
+        (datetime.datetime(2014, 1, 1), """5,10,"FooISP"
+20,25,"BarIsp"
+"""),
+        (datetime.datetime(2014, 3, 1), """5,10,"FooISP"
+20,25,"FooISP"
+30,35,"BarIsp"
+"""),
+        (datetime.datetime(2014, 2, 1), """5,10,"FooISP"
+20,25,"BarIsp"
+40,45,"BarIsp"
+"""),
+        ]
+    snapshots = [(snapshot_datetime, io.BytesIO(contents)) for snapshot_datetime, contents in snapshot_contents]
+    self.translation_strategy = iptranslation.IPTranslationStrategyMaxMind(snapshots)
+
+  def testBlocksWithinWindow(self):
+    find_ip_blocks = self.translation_strategy.find_ip_blocks
+    self.assertListEqual([(20, 25)], find_ip_blocks('bar', datetime.datetime(2014, 1, 5),
+                                                    datetime.datetime(2014, 1, 20)))
+    self.assertListEqual([(20, 25), (40, 45)], find_ip_blocks('bar', datetime.datetime(2014, 2, 1),
+                                                              datetime.datetime(2014, 3, 1)))
+    self.assertListEqual([(20, 25), (30, 35), (40, 45)], find_ip_blocks('bar', datetime.datetime(2014, 1, 5),
+                                                                        datetime.datetime(2014, 3, 2)))
+    self.assertListEqual([(5, 10), (20, 25)], find_ip_blocks('foo', datetime.datetime(2014, 6, 1),
+                                                             datetime.datetime(2014, 7, 1)))
+    self.assertListEqual([(20, 25)], find_ip_blocks('bar', datetime.datetime(2013, 6, 1),
+                                                    datetime.datetime(2013, 7, 1)))
+
+  def testBlocksWithoutWindowCoverAllSnapshots(self):
+    self.assertListEqual([(20, 25), (30, 35), (40, 45)], self.translation_strategy.find_ip_blocks('bar'))
+
+  def testTimezoneAwareWindow(self):
+    start_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 3, 5))
+    end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 3, 6))
+    self.assertListEqual([(30, 35)], self.translation_strategy.find_ip_blocks('bar', start_time, end_time))
+
+  def testLookupIpAtTime(self):
+    lookup_ip = self.translation_strategy.lookup_ip
+    self.assertEqual('FooISP', lookup_ip(22))
+    self.assertEqual('BarIsp', lookup_ip(22, datetime.datetime(2014, 2, 28)))
+    self.assertEqual('FooISP', lookup_ip(22, datetime.datetime(2014, 3, 1)))
+    self.assertIsNone(lookup_ip(42))
+    self.assertEqual('BarIsp', lookup_ip(42, datetime.datetime(2014, 2, 1)))
+    self.assertListEqual(['FooISP', 'BarIsp', None],
+                         list(self.translation_strategy.lookup_ips_batch(numpy.array([22, 30, 42]))))
+
+  def testLookupSkipsBlocksOfOtherSnapshots(self):
+    translation_strategy = iptranslation.IPTranslationStrategyMaxMind([
+        (datetime.datetime(2014, 1, 1), io.BytesIO("""1,100,"WideISP"
+""")),
+        (datetime.datetime(2014, 2, 1), io.BytesIO("""1,10,"SmallISP"
+50,60,"OtherISP"
+"""))])
+    january = datetime.datetime(2014, 1, 15)
+    self.assertEqual('WideISP', translation_strategy.lookup_ip(30, january))
+    self.assertIsNone(translation_strategy.lookup_ip(30))
+    self.assertEqual('SmallISP', translation_strategy.lookup_ip(5))
+    self.assertEqual('OtherISP', translation_strategy.lookup_ip(55))
+    self.assertListEqual(['WideISP', 'WideISP', 'WideISP'],
+                         list(translation_strategy.lookup_ips_batch(numpy.array([5, 30, 55]), january)))
+    self.assertListEqual(['SmallISP', None, 'OtherISP', None],
+                         list(translation_strategy.lookup_ips_batch(numpy.array([5, 30, 55, 0]))))
+
+  def testLookupInSparseSnapshotMergedWithDenseOne(self):
+    dense_snapshot = ''.join('%d,%d,"DenseISP%d"\n' % (block_number * 10, block_number * 10 + 9, block_number)
+                             for block_number in range(1, 1001))
+    translation_strategy = iptranslation.IPTranslationStrategyMaxMind([
+        (datetime.datetime(2014, 1, 1), io.BytesIO(dense_snapshot)),
+        (datetime.datetime(2014, 2, 1), io.BytesIO("""1,5,"SparseISP"
+10005,10009,"LastISP"
+"""))])
+    self.assertEqual('SparseISP', translation_strategy.lookup_ip(3))
+    self.assertIsNone(translation_strategy.lookup_ip(9999))
+    self.assertIsNone(translation_strategy.lookup_ip(5000))
+    self.assertEqual('LastISP', translation_strategy.lookup_ip(10007))
+    self.assertEqual('DenseISP500', translation_strategy.lookup_ip(5003, datetime.datetime(2014, 1, 15)))
+    self.assertIsNone(translation_strategy.lookup_ip(3, datetime.datetime(2014, 1, 15)))
+
+    ip_addresses = numpy.arange(0, 10020, 3)
+    expected_names = [translation_strategy.lookup_ip(int(ip_address)) for ip_address in ip_addresses]
+    self.assertListEqual(expected_names, list(translation_strategy.lookup_ips_batch(ip_addresses)))
+    self.assertEqual(set(['SparseISP', 'LastISP', None]), set(expected_names))
+
+    # Lookups map straight to the previous block of the snapshot instead of
+    # stepping back over the dense snapshot's blocks.
+    previous_valid_rows = translation_strategy._get_previous_valid_rows(None)
+    self.assertEqual(0, previous_valid_rows[500])
+    self.assertEqual(len(previous_valid_rows) - 1, previous_valid_rows[-1])
+
+  def testMergedBlocksAreDeduplicated(self):
+    block_index = self.translation_strategy._block_index
+    # (5, 10, FooISP) and (20, 25, BarIsp) are shared between snapshots.
+    self.assertEqual(5, len(block_index))
+
+class MaxMindBlockIndexTest(unittest.TestCase):
+
+  def testBlocksGroupedByName(self):
+    mock_file = io.BytesIO("""1,4,"A"
+5,10,"B"
+11,14,"A"
+""")
+    block_index = iptranslation.MaxMindBlockIndex.from_csv(mock_file)
+    self.assertEqual(3, len(block_index))
+    self.assertListEqual(['A', 'B'], block_index.asn_names)
+    self.assertListEqual([0, 2], block_index.block_rows_for_names([0]))
+    self.assertListEqual([1], block_index.block_rows_for_names([1]))
+    self.assertListEqual([0, 1, 2], block_index.block_rows_for_names([0, 1]))
+
+  def testFindNameIdsMatchesSubstrings(self):
+    mock_file = io.BytesIO("""1,4,"AS7922 Comcast Cable Communications, Inc."
+5,10,"AS701 MCI Communications Services"
+11,14,"AS7018 AT&T Services, Inc."
+15,20,"AS1 Level 3 Communications"
+""")
+    block_index = iptranslation.MaxMindBlockIndex.from_csv(mock_file)
+    self.assertListEqual([0], block_index.find_name_ids(['comcast']))
+    self.assertListEqual([0], block_index.find_name_ids(['omcas']))
+    self.assertListEqual([0, 1, 3], block_index.find_name_ids(['communications']))
+    self.assertListEqual([2], block_index.find_name_ids(['at&t']))
+    self.assertListEqual([3], block_index.find_name_ids(['level 3']))
+    self.assertListEqual([0, 2], block_index.find_name_ids(['comcast', 'AT&T']))
+    self.assertListEqual([], block_index.find_name_ids(['verizon']))
+
+  def testFindNameIdsComparesOnlyCandidateTokens(self):
+    asn_names = ['AS%d Provider%d' % (name_number, name_number) for name_number in range(2000)]
+    asn_names.append('AS9999 Comcast Cable')
+    token_index = iptranslation._TokenIndex(asn_names)
+    compared_tokens = []
+    class RecordingTokens(list):
+      def __getitem__(self, token_id):
+        compared_tokens.append(token_id)
+        return list.__getitem__(self, token_id)
+    token_index._tokens = RecordingTokens(token_index._tokens)
+    self.assertEqual(set([2000]), token_index.find_name_ids('comcast'))
+    self.assertEqual(1, len(compared_tokens))
+
+class MaxMindSidecarTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.snapshot_path = os.path.join(self.temp_dir, 'GeoIPASNum2-20140901.csv')
+    with open(self.snapshot_path, 'wb') as snapshot_file:
+      snapshot_file.write("""1,4,"Level 3 Communications"
+5,10,"FooISP"
+11,14,"GBLX"
+""")
+    self.sidecar_path = iptranslation.MaxMindBlockIndex.get_sidecar_path(self.snapshot_path)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testSidecarRoundTrip(self):
+    with open(self.snapshot_path, 'rb') as snapshot_file:
+      parsed_index = iptranslation.MaxMindBlockIndex.from_csv(snapshot_file)
+    parsed_index.write_sidecar(self.sidecar_path, 123, 456.5)
+
+    mapped_index = iptranslation.MaxMindBlockIndex.from_sidecar(self.sidecar_path, 123, 456.5)
+    self.assertEqual(3, len(mapped_index))
+    self.assertListEqual(parsed_index.asn_names, mapped_index.asn_names)
+    self.assertListEqual([1, 5, 11], list(mapped_index.block_starts))
+    self.assertListEqual([4, 10, 14], list(mapped_index.block_ends))
+    self.assertListEqual([0, 2], mapped_index.block_rows_for_names(mapped_index.find_name_ids(['level 3', 'gblx'])))
+
+  def testStaleSidecarIgnored(self):
+    with open(self.snapshot_path, 'rb') as snapshot_file:
+      iptranslation.MaxMindBlockIndex.from_csv(snapshot_file).write_sidecar(self.sidecar_path, 123, 456.5)
+    self.assertIsNone(iptranslation.MaxMindBlockIndex.from_sidecar(self.sidecar_path, 124, 456.5))
+    self.assertIsNone(iptranslation.MaxMindBlockIndex.from_sidecar(self.sidecar_path, 123, 457.0))
+    self.assertIsNone(iptranslation.MaxMindBlockIndex.from_sidecar(self.snapshot_path + '.missing', 123, 456.5))
+
+  def testFactoryReusesSidecar(self):
+    file_opener = mock.Mock(side_effect = open)
+    spec = iptranslation.IPTranslationStrategySpec('maxmind', {'db_snapshots': ['2014-09-01'],
+                                                               'maxmind_dir': self.temp_dir})
+    translator = iptranslation.IPTranslationStrategyFactory(file_opener).create(spec)
+    self.assertListEqual([(1, 4), (11, 14)], translator.find_ip_blocks('level3'))
+    self.assertEqual(1, file_opener.call_count)
+    self.assertTrue(os.path.exists(self.sidecar_path))
+
+    translator = iptranslation.IPTranslationStrategyFactory(file_opener).create(spec)
+    self.assertListEqual([(1, 4), (11, 14)], translator.find_ip_blocks('level3'))
+    self.assertEqual(1, file_opener.call_count)
+
+class MaxMindSnapshotDirectoryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    for snapshot_filename, contents in (('GeoIPASNum2-20140101.csv', '1,4,"FooISP"\n'),
+                                        ('GeoIPASNum2-20140301.csv', '1,4,"BarIsp"\n'),
+                                        ('GeoIPASNum2-20140601.csv', '1,4,"BazNet"\n'),
+                                        ('GeoIPASNum2-20140601.csv.idx', ''),
+                                        ('README', '')):
+      with open(os.path.join(self.temp_dir, snapshot_filename), 'wb') as snapshot_file:
+        snapshot_file.write(contents)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testFindNearest(self):
+    snapshot_directory = iptranslation.MaxMindSnapshotDirectory(self.temp_dir)
+    self.assertEqual(3, len(snapshot_directory))
+    find_nearest = snapshot_directory.find_nearest
+    self.assertEqual(datetime.datetime(2014, 1, 1), find_nearest(datetime.datetime(2013, 5, 1)))
+    self.assertEqual(datetime.datetime(2014, 1, 1), find_nearest(datetime.datetime(2014, 1, 30)))
+    self.assertEqual(datetime.datetime(2014, 3, 1), find_nearest(datetime.datetime(2014, 2, 1)))
+    self.assertEqual(datetime.datetime(2014, 3, 1), find_nearest(datetime.datetime(2014, 3, 1)))
+    self.assertEqual(datetime.datetime(2014, 6, 1), find_nearest(
+        utils.make_datetime_utc_aware(datetime.datetime(2015, 1, 1))))
+
+  def testFindNearestInEmptyDirectory(self):
+    snapshot_directory = iptranslation.MaxMindSnapshotDirectory(os.path.join(self.temp_dir, 'missing'))
+    self.assertIsNone(snapshot_directory.find_nearest(datetime.datetime(2014, 1, 1)))
+
+  def testFactoryUsesNearestSnapshot(self):
+    factory = iptranslation.IPTranslationStrategyFactory()
+    spec = iptranslation.IPTranslationStrategySpec('maxmind', {'db_snapshots': [],
+                                                               'maxmind_dir': self.temp_dir})
+    translator = factory.create(spec, datetime.datetime(2014, 2, 15))
+    self.assertListEqual([(1, 4)], translator.find_ip_blocks('bar'))
+    self.assertIs(translator, factory.create(spec, datetime.datetime(2014, 3, 10)))
+    self.assertIsNot(translator, factory.create(spec, datetime.datetime(2014, 5, 10)))
+    self.assertRaises(ValueError, factory.create, spec)
+
+  def testFactoryWithoutSnapshots(self):
+    factory = iptranslation.IPTranslationStrategyFactory()
+    spec = iptranslation.IPTranslationStrategySpec('maxmind', {'db_snapshots': [],
+                                                               'maxmind_dir': os.path.join(self.temp_dir, 'missing')})
+    self.assertRaises(iptranslation.MissingMaxMindError, factory.create, spec, datetime.datetime(2014, 2, 15))
+
+  def testSnapshotIdentitiesOfWindow(self):
+    def fail_to_open(path, mode):
+      raise AssertionError('Snapshot {path} should not be read.'.format(path = path))
+    factory = iptranslation.IPTranslationStrategyFactory(fail_to_open)
+    snapshot_path = os.path.join(self.temp_dir, 'GeoIPASNum2-20140301.csv')
+    os.utime(snapshot_path, (1400000000, 1400000000))
+    spec = iptranslation.IPTranslationStrategySpec('maxmind', {'db_snapshots': ['2014-01-01', '2014-03-01',
+                                                                                '2014-04-01'],
+                                                               'maxmind_dir': self.temp_dir})
+    self.assertListEqual([('2014-03-01', os.path.getsize(snapshot_path), 1400000000)],
+                         factory.snapshot_identities(spec, datetime.datetime(2014, 3, 5),
+                                                     datetime.datetime(2014, 3, 6)))
+    self.assertListEqual(['2014-01-01', '2014-03-01', '2014-04-01'],
+                         [date for date, _, _ in factory.snapshot_identities(spec, datetime.datetime(2014, 1, 5))])
+    self.assertEqual(('2014-04-01', None, None), factory.snapshot_identities(spec, datetime.datetime(2014, 5, 1))[0])
+
+    nearest_spec = iptranslation.IPTranslationStrategySpec('maxmind', {'db_snapshots': [],
+                                                                       'maxmind_dir': self.temp_dir})
+    self.assertListEqual(['2014-06-01'], [date for date, _, _ in factory.snapshot_identities(
+        nearest_spec, datetime.datetime(2014, 5, 10), datetime.datetime(2014, 5, 11))])
+
 if __name__ == '__main__':
   unittest.main()
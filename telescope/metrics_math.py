@@ -16,9 +16,15 @@
 # limitations under the License.
 
 
+import numpy
+
 import utils
 import mlab
 
+# Layout of calculated metric results: one (timestamp, result) record per
+# measurement.
+RESULT_DTYPE = numpy.dtype([('timestamp', numpy.int64), ('result', numpy.float64)])
+
 def calculate_results_list(metric, input_datarows):
   datarows_to_return = []
 
@@ -38,7 +44,7 @@ def calculate_results_list(metric, input_datarows):
       timestamp = datarow['web100_log_entry_log_time']
       calculated_result = calculate_avgrtt(datarow['web100_log_entry_snap_SumRTT'], datarow['web100_log_entry_snap_CountRTT'])
     elif metric == "download_throughput":
-      assert datarow['connection_spec_data_direction'] == '1'
+      assert int(datarow['connection_spec_data_direction']) == 1
 
       timestamp = datarow['web100_log_entry_log_time']
       data_transfered = float(datarow['web100_log_entry_snap_HCThruOctetsAcked'])
@@ -48,7 +54,7 @@ def calculate_results_list(metric, input_datarows):
       calculated_result = calculate_throughput(data_transfered, time_spent)
 
     elif metric == "upload_throughput":
-      assert datarow['connection_spec_data_direction'] == '0'
+      assert int(datarow['connection_spec_data_direction']) == 0
 
       timestamp = datarow['web100_log_entry_log_time']
       data_transfered = float(datarow['web100_log_entry_snap_HCThruOctetsReceived'])
@@ -56,7 +62,7 @@ def calculate_results_list(metric, input_datarows):
       calculated_result = calculate_throughput(data_transfered, time_spent)
 
     elif metric == "packet_retransmit_rate":
-      assert datarow['connection_spec_data_direction'] == '1'
+      assert int(datarow['connection_spec_data_direction']) == 1
 
       timestamp = datarow['web100_log_entry_log_time']
       segments_retransmitted = float(datarow['web100_log_entry_snap_SegsRetrans'])
@@ -74,6 +80,76 @@ def calculate_results_list(metric, input_datarows):
 
   return datarows_to_return
 
+def supports_results_array(metric):
+  """ Indicates whether calculate_results_array can calculate the metric. """
+  return metric in _ARRAY_CALCULATIONS
+
+def calculate_results_array(metric, measurements):
+  """ Calculates a metric over whole columns of measurements at once.
+
+      Produces the same results as calculate_results_list, in a compact array
+      rather than a list of dicts.
+
+      Args:
+        metric (str): Name of the metric to calculate. Must be a metric for
+          which supports_results_array is True.
+        measurements (telescope.columns.MeasurementColumns): Measurements that
+          passed validation for the metric.
+
+      Returns:
+        numpy.ndarray: Array of RESULT_DTYPE records, one per measurement,
+        omitting measurements with NULL values or an undefined result.
+  """
+  if metric not in _ARRAY_CALCULATIONS:
+    raise Exception("UnsupportedMetric")
+  data_direction, calculate_array = _ARRAY_CALCULATIONS[metric]
+  if data_direction is not None and len(measurements) > 0:
+    assert numpy.all(measurements.typed_column('connection_spec_data_direction', numpy.int64) == data_direction)
+
+  timestamps = measurements.typed_column('web100_log_entry_log_time', numpy.int64)
+  calculated_results = calculate_array(measurements)
+  has_values = ~(numpy.ma.getmaskarray(timestamps) | numpy.ma.getmaskarray(calculated_results))
+
+  results = numpy.empty(numpy.count_nonzero(has_values), dtype = RESULT_DTYPE)
+  results['timestamp'] = numpy.ma.getdata(timestamps)[has_values]
+  results['result'] = numpy.ma.getdata(calculated_results)[has_values]
+  return results
+
+def _float_column(measurements, fieldname):
+  return measurements.typed_column(fieldname, numpy.float64)
+
+def _calculate_minrtt_array(measurements):
+  return _float_column(measurements, 'web100_log_entry_snap_MinRTT')
+
+def _calculate_avgrtt_array(measurements):
+  return (_float_column(measurements, 'web100_log_entry_snap_SumRTT') /
+          _float_column(measurements, 'web100_log_entry_snap_CountRTT'))
+
+def _calculate_download_throughput_array(measurements):
+  time_spent = (measurements.typed_column('web100_log_entry_snap_SndLimTimeRwin', numpy.int64) +
+                measurements.typed_column('web100_log_entry_snap_SndLimTimeCwnd', numpy.int64) +
+                measurements.typed_column('web100_log_entry_snap_SndLimTimeSnd', numpy.int64))
+  return (_float_column(measurements, 'web100_log_entry_snap_HCThruOctetsAcked') /
+          time_spent.astype(numpy.float64)) * 8
+
+def _calculate_upload_throughput_array(measurements):
+  return (_float_column(measurements, 'web100_log_entry_snap_HCThruOctetsReceived') /
+          _float_column(measurements, 'web100_log_entry_snap_Duration')) * 8
+
+def _calculate_packet_retransmit_rate_array(measurements):
+  return (_float_column(measurements, 'web100_log_entry_snap_SegsRetrans') /
+          _float_column(measurements, 'web100_log_entry_snap_DataSegsOut'))
+
+# Array calculation for each metric, with the data direction its measurements
+# must have.
+_ARRAY_CALCULATIONS = {
+    'minimum_rtt': (None, _calculate_minrtt_array),
+    'average_rtt': (None, _calculate_avgrtt_array),
+    'download_throughput': (1, _calculate_download_throughput_array),
+    'upload_throughput': (0, _calculate_upload_throughput_array),
+    'packet_retransmit_rate': (1, _calculate_packet_retransmit_rate_array),
+    }
+
 def calculate_throughput(data_transfered, time_spent):
   return (float(data_transfered) / float(time_spent)) * 8
 
@@ -16,9 +16,11 @@
 # limitations under the License.
 
 
-import metrics_math
 import unittest
 
+import columns
+import metrics_math
+
 class MetricsMathTest(unittest.TestCase):
 
   def calculate_single_result(self, metric, datarow):
@@ -32,12 +34,19 @@ class MetricsMathTest(unittest.TestCase):
 
   def assertMetricMatchesExpected(self, datarow, metric_name, timestamp_expected, metric_value_expected):
     """ Asserts that, given a datarow, metrics_math library produces the
-        expected timestamp and result values for the specified metric.
+        expected timestamp and result values for the specified metric, with
+        both the row and the array calculations.
     """
     result = self.calculate_single_result(metric_name, datarow)
     self.assertEqual(timestamp_expected, result["timestamp"])
     self.assertEqual(metric_value_expected, result["result"])
 
+    measurements = columns.MeasurementColumns.from_rows(
+        [datarow], dict((fieldname, 'INTEGER') for fieldname in datarow))
+    results_array = metrics_math.calculate_results_array(metric_name, measurements)
+    self.assertEqual(metrics_math.RESULT_DTYPE, results_array.dtype)
+    self.assertListEqual([(timestamp_expected, metric_value_expected)], results_array.tolist())
+
   def test_calculate_results_list_hop_count(self):
     # TODO: Write this test.
     pass
@@ -91,6 +100,38 @@ class MetricsMathTest(unittest.TestCase):
     # Expected packet retransmit rate = 7 / 2 = 3.5
     result = self.assertMetricMatchesExpected(mock_row, "packet_retransmit_rate", 1407959123, 3.5)
 
+  def test_calculate_results_array_matches_list(self):
+    datarows = [{
+        "web100_log_entry_log_time": str(1407959123 + index),
+        "connection_spec_data_direction": "1",
+        "web100_log_entry_snap_HCThruOctetsAcked": str(1000 * index + 7),
+        "web100_log_entry_snap_SndLimTimeRwin": str(3 * index + 1),
+        "web100_log_entry_snap_SndLimTimeCwnd": str(index),
+        "web100_log_entry_snap_SndLimTimeSnd": "11",
+        } for index in range(100)]
+    measurements = columns.MeasurementColumns.from_rows(
+        datarows, dict((fieldname, 'INTEGER') for fieldname in datarows[0]))
+
+    results_list = metrics_math.calculate_results_list('download_throughput', datarows)
+    results_array = metrics_math.calculate_results_array('download_throughput', measurements)
+    self.assertListEqual([(row['timestamp'], row['result']) for row in results_list], results_array.tolist())
+
+  def test_calculate_results_array_omits_null_values(self):
+    datarows = [
+        {"web100_log_entry_log_time": "1407959123", "web100_log_entry_snap_MinRTT": "125"},
+        {"web100_log_entry_log_time": "1407959124", "web100_log_entry_snap_MinRTT": None},
+        ]
+    measurements = columns.MeasurementColumns.from_rows(
+        datarows, {"web100_log_entry_log_time": "INTEGER", "web100_log_entry_snap_MinRTT": "INTEGER"})
+    self.assertListEqual([(1407959123, 125.0)],
+                         metrics_math.calculate_results_array('minimum_rtt', measurements).tolist())
+
+  def test_calculate_results_array_unsupported_metric(self):
+    self.assertFalse(metrics_math.supports_results_array('hop_count'))
+    measurements = columns.MeasurementColumns.from_rows([{'log_time': '1407959123'}])
+    with self.assertRaises(Exception):
+      metrics_math.calculate_results_array('hop_count', measurements)
+
   def test_calculate_throughput(self):
     calculate = metrics_math.calculate_throughput
     self.assertEqual(160.0, calculate(10.0, 0.5))
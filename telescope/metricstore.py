@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy
+
+import metrics_math
+import utils
+
+_INDEX_FILENAME = 'index.json'
+_INDEX_VERSION = 2
+_PARTITION_FILE_MAGIC = 'TLSCMSP1'
+_PARTITION_FILE_EXTENSION = '.msp'
+_PARTITION_HEADER = struct.Struct('<qqqII')
+_PARTITION_SECONDS = 24 * 60 * 60
+_RESULT_DTYPE = numpy.dtype(metrics_math.RESULT_DTYPE).newbyteorder('<')
+
+
+def merge_intervals(intervals):
+  """ Merges time intervals into the minimal sorted list of intervals covering
+      the same times. Intervals are (start, end) tuples with an exclusive end,
+      and intervals that touch are merged.
+  """
+  merged_intervals = []
+  for interval_start, interval_end in sorted(intervals):
+    if interval_start >= interval_end:
+      continue
+    if merged_intervals and interval_start <= merged_intervals[-1][1]:
+      if interval_end > merged_intervals[-1][1]:
+        merged_intervals[-1] = (merged_intervals[-1][0], interval_end)
+    else:
+      merged_intervals.append((interval_start, interval_end))
+  return merged_intervals
+
+
+def subtract_intervals(start_time, end_time, intervals):
+  """ Finds the parts of the interval from start_time to end_time that none of
+      the given merged, sorted intervals cover.
+
+      Returns:
+        list: Uncovered (start, end) intervals in time order.
+
+  """
+  uncovered_intervals = []
+  uncovered_start = start_time
+  for interval_start, interval_end in intervals:
+    if interval_end <= uncovered_start:
+      continue
+    if interval_start >= end_time:
+      break
+    if interval_start > uncovered_start:
+      uncovered_intervals.append((uncovered_start, interval_start))
+    uncovered_start = max(uncovered_start, interval_end)
+  if uncovered_start < end_time:
+    uncovered_intervals.append((uncovered_start, end_time))
+  return uncovered_intervals
+
+
+class MetricStore(object):
+  """ Local store of calculated metric results, kept separately for each site,
+      client provider and metric, that remembers which time intervals it
+      covers.
+
+      Results are added a time slice at a time, typically from a query over
+      exactly that slice, and the slice's interval is recorded as covered once
+      all of its results are stored. Selectors whose windows overlap earlier
+      ones, such as a rolling window that moves forward a day at a time, then
+      only need to query the intervals the store does not cover yet, and their
+      whole window is read back from the store.
+
+      Results are partitioned by UTC day. Each partition is a small binary
+      file holding its timestamps and results as separate compressed columns,
+      and the index of each key records the minimum and maximum timestamp of
+      every partition, so that reading a window only opens the partitions
+      that overlap it. Overlapping windows share the same partitions rather
+      than duplicating results.
+
+      Times are Unix timestamps in seconds, and intervals have an exclusive
+      end, like the log_time conditions of queries.
+
+  """
+
+  def __init__(self, store_dir):
+    """ Opens a store, creating its directory if it does not exist.
+
+        Args:
+          store_dir (str): Directory holding the store.
+
+    """
+    self.logger = logging.getLogger('telescope')
+    self.store_dir = store_dir
+    self._lock = threading.Lock()
+    if not os.path.exists(store_dir):
+      os.makedirs(store_dir)
+
+  def covered_intervals(self, store_key):
+    """ Returns the merged, sorted intervals covered for a key, which is a
+        (site, client_provider, metric) tuple.
+    """
+    with self._lock:
+      return [tuple(interval) for interval in self._read_index(store_key)['covered']]
+
+  def missing_intervals(self, store_key, start_time, end_time):
+    """ Finds the parts of a window that the store does not cover yet.
+
+        Args:
+          store_key (tuple): (site, client_provider, metric) of the results.
+          start_time (int): Start of the window, inclusive.
+          end_time (int): End of the window, exclusive.
+
+        Returns:
+          list: Uncovered (start, end) intervals in time order.
+
+    """
+    return subtract_intervals(start_time, end_time, self.covered_intervals(store_key))
+
+  def covers(self, store_key, start_time, end_time):
+    return not self.missing_intervals(store_key, start_time, end_time)
+
+  def slice_writer(self, store_key, start_time, end_time):
+    """ Starts storing the results of one time slice incrementally.
+
+        Args:
+          store_key (tuple): (site, client_provider, metric) of the results.
+          start_time (int): Start of the slice, inclusive.
+          end_time (int): End of the slice, exclusive.
+
+        Returns:
+          MetricStoreSliceWriter: Writer to which to pass the results as they
+          are calculated. The slice is recorded as covered only once the
+          writer is closed.
+
+    """
+    return MetricStoreSliceWriter(self, store_key, start_time, end_time)
+
+  def read_window(self, store_key, start_time, end_time):
+    """ Reads the stored results within a window.
+
+        Args:
+          store_key (tuple): (site, client_provider, metric) of the results.
+          start_time (int): Start of the window, inclusive.
+          end_time (int): End of the window, exclusive.
+
+        Returns:
+          numpy.ndarray: telescope.metrics_math.RESULT_DTYPE records in the
+          window, in time order.
+
+    """
+    with self._lock:
+      partitions = self._read_index(store_key)['partitions']
+      key_dir = self._key_dir(store_key)
+      window_results = []
+      for partition in partitions:
+        if partition['rows'] == 0 or partition['max'] < start_time or partition['min'] >= end_time:
+          continue
+        partition_results = _read_partition(os.path.join(key_dir, partition['filename']))
+        if partition['min'] < start_time or partition['max'] >= end_time:
+          partition_timestamps = partition_results['timestamp']
+          partition_results = partition_results[(partition_timestamps >= start_time) &
+                                                (partition_timestamps < end_time)]
+        window_results.append(partition_results)
+    if not window_results:
+      return numpy.zeros(0, dtype = metrics_math.RESULT_DTYPE)
+    return numpy.concatenate(window_results)
+
+  def _key_dir(self, store_key):
+    return os.path.join(self.store_dir, *[utils.strip_special_chars(str(key_part)) for key_part in store_key])
+
+  def _read_index(self, store_key):
+    try:
+      with open(os.path.join(self._key_dir(store_key), _INDEX_FILENAME)) as index_file:
+        index = json.load(index_file)
+    except (IOError, ValueError):
+      index = None
+    if index is None or index.get('version') != _INDEX_VERSION:
+      return {'version': _INDEX_VERSION, 'covered': [], 'partitions': []}
+    return index
+
+  def _write_index(self, store_key, index):
+    key_dir = self._key_dir(store_key)
+    index_fd, index_temp_path = tempfile.mkstemp(dir = key_dir, prefix = '.tmp-')
+    with os.fdopen(index_fd, 'w') as index_file:
+      json.dump(index, index_file)
+    os.rename(index_temp_path, os.path.join(key_dir, _INDEX_FILENAME))
+
+  def _add_slice(self, store_key, start_time, end_time, slice_results):
+    """ Stores the complete results of a slice and records its interval as
+        covered. Stored results within the slice's interval are replaced, so
+        that refreshing an interval never stores a result twice.
+    """
+    key_dir = self._key_dir(store_key)
+    with self._lock:
+      index = self._read_index(store_key)
+      partitions_by_day = dict((partition['day'], partition) for partition in index['partitions'])
+      slice_days = _partition_days(slice_results['timestamp'])
+
+      first_day = start_time - start_time % _PARTITION_SECONDS
+      for partition_day in xrange(first_day, end_time, _PARTITION_SECONDS):
+        partition = partitions_by_day.get(partition_day)
+        if partition is None:
+          partition_results = slice_results[slice_days == partition_day]
+          if len(partition_results) == 0:
+            continue
+        else:
+          stored_results = _read_partition(os.path.join(key_dir, partition['filename']))
+          stored_timestamps = stored_results['timestamp']
+          partition_results = numpy.concatenate([
+              stored_results[(stored_timestamps < start_time) | (stored_timestamps >= end_time)],
+              slice_results[slice_days == partition_day]])
+        partition_results = partition_results[numpy.argsort(partition_results['timestamp'], kind = 'mergesort')]
+        partitions_by_day[partition_day] = _write_partition(key_dir, partition_day, partition_results)
+
+      index['partitions'] = [partitions_by_day[partition_day] for partition_day in sorted(partitions_by_day)]
+      index['covered'] = merge_intervals([tuple(interval) for interval in index['covered']] +
+                                         [(start_time, end_time)])
+      self._write_index(store_key, index)
+
+
+class MetricStoreSliceWriter(object):
+  """ Incrementally writes the results of one time slice to a MetricStore. It
+      offers the same write, close and abort methods as the writers of output
+      files.
+  """
+
+  def __init__(self, metric_store, store_key, start_time, end_time):
+    self._metric_store = metric_store
+    self._store_key = store_key
+    self._start_time = start_time
+    self._end_time = end_time
+    key_dir = metric_store._key_dir(store_key)
+    if not os.path.exists(key_dir):
+      os.makedirs(key_dir)
+    slice_fd, self._temp_path = tempfile.mkstemp(dir = key_dir, prefix = '.tmp-')
+    self._slice_file = os.fdopen(slice_fd, 'wb')
+
+  def write(self, metric_calculations):
+    """ Appends an array of telescope.metrics_math.RESULT_DTYPE records. """
+    if len(metric_calculations) == 0:
+      return
+    self._slice_file.write(numpy.asarray(metric_calculations).astype(_RESULT_DTYPE).tostring())
+
+  def close(self):
+    """ Adds the slice to the store and records its interval as covered. """
+    self._slice_file.close()
+    try:
+      slice_results = numpy.fromfile(self._temp_path, dtype = _RESULT_DTYPE).astype(metrics_math.RESULT_DTYPE)
+      self._metric_store._add_slice(self._store_key, self._start_time, self._end_time, slice_results)
+    finally:
+      os.remove(self._temp_path)
+
+  def abort(self):
+    """ Discards the partially written slice. """
+    self._slice_file.close()
+    try:
+      os.remove(self._temp_path)
+    except OSError:
+      pass
+
+
+def _partition_days(timestamps):
+  """ Start of the UTC day of each timestamp. """
+  return timestamps - timestamps % _PARTITION_SECONDS
+
+
+def _partition_filename(partition_day):
+  partition_date = datetime.datetime.utcfromtimestamp(partition_day)
+  return partition_date.strftime('%Y-%m-%d') + _PARTITION_FILE_EXTENSION
+
+
+def _write_partition(key_dir, partition_day, partition_results):
+  """ Writes a day's results, sorted by time, and returns the partition's
+      index entry.
+
+      A partition file holds a header of its row count, minimum and maximum
+      timestamp and the sizes of its two columns, followed by the columns:
+      timestamps as zlib-compressed little-endian differences between
+      consecutive timestamps, which are small and compress well, then results
+      as zlib-compressed little-endian float64 values.
+  """
+  partition_timestamps = partition_results['timestamp'].astype(numpy.int64)
+  if len(partition_results) > 0:
+    minimum_timestamp = int(partition_timestamps[0])
+    maximum_timestamp = int(partition_timestamps[-1])
+  else:
+    minimum_timestamp = maximum_timestamp = partition_day
+  timestamp_column = zlib.compress(
+      numpy.diff(partition_timestamps, prepend = minimum_timestamp).astype('<i8').tostring())
+  result_column = zlib.compress(partition_results['result'].astype('<f8').tostring())
+
+  partition_filename = _partition_filename(partition_day)
+  partition_fd, partition_temp_path = tempfile.mkstemp(dir = key_dir, prefix = '.tmp-')
+  with os.fdopen(partition_fd, 'wb') as partition_file:
+    partition_file.write(_PARTITION_FILE_MAGIC)
+    partition_file.write(_PARTITION_HEADER.pack(len(partition_results), minimum_timestamp, maximum_timestamp,
+                                                len(timestamp_column), len(result_column)))
+    partition_file.write(timestamp_column)
+    partition_file.write(result_column)
+  os.rename(partition_temp_path, os.path.join(key_dir, partition_filename))
+  return {'day': partition_day, 'filename': partition_filename, 'rows': len(partition_results),
+          'min': minimum_timestamp, 'max': maximum_timestamp}
+
+
+def _read_partition(partition_path):
+  """ Reads a partition written by _write_partition into an array of
+      telescope.metrics_math.RESULT_DTYPE records.
+  """
+  with open(partition_path, 'rb') as partition_file:
+    if partition_file.read(len(_PARTITION_FILE_MAGIC)) != _PARTITION_FILE_MAGIC:
+      raise ValueError('UnreadablePartition: ' + partition_path)
+    row_count, minimum_timestamp, _, timestamp_column_length, result_column_length = _PARTITION_HEADER.unpack(
+        partition_file.read(_PARTITION_HEADER.size))
+    timestamp_column = zlib.decompress(partition_file.read(timestamp_column_length))
+    result_column = zlib.decompress(partition_file.read(result_column_length))
+
+  partition_results = numpy.zeros(row_count, dtype = metrics_math.RESULT_DTYPE)
+  partition_results['timestamp'] = numpy.cumsum(numpy.frombuffer(timestamp_column, dtype = '<i8')) + minimum_timestamp
+  partition_results['result'] = numpy.frombuffer(result_column, dtype = '<f8')
+  return partition_results
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import metricstore
+import metrics_math
+
+
+def results_array(timestamps):
+  results = numpy.zeros(len(timestamps), dtype = metrics_math.RESULT_DTYPE)
+  results['timestamp'] = timestamps
+  results['result'] = [timestamp / 10.0 for timestamp in timestamps]
+  return results
+
+
+class IntervalsTest(unittest.TestCase):
+
+  def test_merge_intervals(self):
+    self.assertListEqual([(0, 20), (30, 40)],
+                         metricstore.merge_intervals([(10, 20), (30, 40), (0, 10), (5, 6), (7, 7)]))
+
+  def test_subtract_intervals(self):
+    self.assertListEqual([(0, 10), (20, 30), (40, 50)],
+                         metricstore.subtract_intervals(0, 50, [(10, 20), (30, 40)]))
+    self.assertListEqual([(25, 30)], metricstore.subtract_intervals(15, 35, [(10, 25), (30, 40)]))
+    self.assertListEqual([], metricstore.subtract_intervals(12, 18, [(10, 20)]))
+
+
+class MetricStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store_dir = tempfile.mkdtemp()
+    self.metric_store = metricstore.MetricStore(self.store_dir)
+    self.store_key = ('lga01', 'comcast', 'minimum_rtt')
+
+  def tearDown(self):
+    shutil.rmtree(self.store_dir)
+
+  def add_slice(self, start_time, end_time, timestamps):
+    slice_writer = self.metric_store.slice_writer(self.store_key, start_time, end_time)
+    slice_writer.write(results_array(timestamps))
+    slice_writer.close()
+
+  def test_rolling_window_only_misses_new_interval(self):
+    self.add_slice(100, 200, [150, 110, 199])
+    self.assertListEqual([(200, 250)], self.metric_store.missing_intervals(self.store_key, 120, 250))
+    self.add_slice(200, 250, [200, 249])
+
+    self.assertTrue(self.metric_store.covers(self.store_key, 120, 250))
+    window_results = self.metric_store.read_window(self.store_key, 120, 250)
+    self.assertListEqual([150, 199, 200, 249], window_results['timestamp'].tolist())
+    self.assertListEqual([15.0, 19.9, 20.0, 24.9], window_results['result'].tolist())
+
+  def test_store_persists_across_instances(self):
+    self.add_slice(100, 200, [150])
+    reopened_store = metricstore.MetricStore(self.store_dir)
+    self.assertListEqual([(100, 200)], reopened_store.covered_intervals(self.store_key))
+    self.assertListEqual([150], reopened_store.read_window(self.store_key, 0, 1000)['timestamp'].tolist())
+
+  def test_aborted_slice_is_not_covered(self):
+    slice_writer = self.metric_store.slice_writer(self.store_key, 100, 200)
+    slice_writer.write(results_array([150]))
+    slice_writer.abort()
+    self.assertListEqual([(100, 200)], self.metric_store.missing_intervals(self.store_key, 100, 200))
+    self.assertEqual(0, len(self.metric_store.read_window(self.store_key, 100, 200)))
+
+  def test_empty_slice_is_covered(self):
+    self.add_slice(100, 200, [])
+    self.assertTrue(self.metric_store.covers(self.store_key, 100, 200))
+
+  def test_refreshed_interval_replaces_stored_results(self):
+    self.add_slice(100, 200, [150, 190])
+    self.add_slice(180, 300, [185, 250])
+    self.assertListEqual([150, 185, 250], self.metric_store.read_window(self.store_key, 0, 1000)['timestamp'].tolist())
+    self.assertListEqual([(100, 300)], self.metric_store.covered_intervals(self.store_key))
+
+  def test_results_are_partitioned_by_day(self):
+    day = 24 * 60 * 60
+    first_day = 16000 * day
+    self.add_slice(first_day, first_day + 3 * day, [first_day + 10, first_day + 2 * day + 5, first_day + 20,
+                                                    first_day + day - 1])
+    key_dir = os.path.join(self.store_dir, 'lga01', 'comcast', 'minimum_rtt')
+    self.assertListEqual(['2013-10-22.msp', '2013-10-24.msp', 'index.json'], sorted(os.listdir(key_dir)))
+    self.assertListEqual([first_day + 10, first_day + 20, first_day + day - 1, first_day + 2 * day + 5],
+                         self.metric_store.read_window(self.store_key, first_day, first_day + 3 * day)['timestamp'].tolist())
+
+  def test_window_reads_only_overlapping_partitions(self):
+    day = 24 * 60 * 60
+    first_day = 16000 * day
+    self.add_slice(first_day, first_day + 3 * day, [first_day + 10, first_day + 2 * day + 5])
+    # Damaging a partition outside the window does not affect reading it.
+    with open(os.path.join(self.store_dir, 'lga01', 'comcast', 'minimum_rtt', '2013-10-22.msp'), 'wb') as partition_file:
+      partition_file.write('damaged')
+    window_results = self.metric_store.read_window(self.store_key, first_day + day, first_day + 3 * day)
+    self.assertListEqual([first_day + 2 * day + 5], window_results['timestamp'].tolist())
+    self.assertListEqual([(first_day + 2 * day + 5) / 10.0], window_results['result'].tolist())
+
+  def test_keys_are_separate(self):
+    self.add_slice(100, 200, [150])
+    self.assertListEqual([(100, 200)], self.metric_store.missing_intervals(('lga01', 'comcast', 'average_rtt'), 100, 200))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import cStringIO
+import errno
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+import numpy
+
+import metrics_math
+import utils
+
+# Formats in which metric results can be written, and the extension of each
+# format's output files. Only CSV can hold results that are not numbers.
+OUTPUT_FORMATS = ('csv', 'npz', 'columnar', 'binary')
+FILE_EXTENSIONS = {'csv': 'raw.csv', 'npz': 'raw.npz', 'columnar': 'raw.tlc', 'binary': 'raw.bin'}
+
+_FIXED_WIDTH_DTYPE = numpy.dtype([('timestamp', '<i8'), ('result', '<f8')])
+_COLUMNAR_FILE_MAGIC = 'TLSCCOL1'
+_COLUMNAR_ROW_GROUP_HEADER = struct.Struct('<IqqII')
+_COLUMNAR_FOOTER_LENGTH = struct.Struct('<I')
+_ROWS_PER_ROW_GROUP = 65536
+_OUTPUT_BUFFER_BYTES = 1024 * 1024
+_TOO_MANY_OPEN_FILES_RETRY_SECONDS = 20
+
+
+def output_format_for_metric(output_format, metric):
+  """ Format in which to write a metric's results: the requested format, or
+      CSV for metrics whose results are not numbers.
+  """
+  if output_format != 'csv' and not metrics_math.supports_results_array(metric):
+    return 'csv'
+  return output_format
+
+
+class AtomicOutputFile(object):
+  """ Buffered output file that is written under a temporary name and renamed
+      to its path only once it is committed, so that an interrupted write
+      never leaves a partial file at the output path. It keeps a checksum of
+      the data written to it.
+  """
+
+  def __init__(self, data_filepath, buffer_bytes = _OUTPUT_BUFFER_BYTES):
+    self.data_filepath = data_filepath
+    self._checksum = hashlib.sha1()
+    self._temp_path, self._data_file = _open_temp_file(data_filepath, buffer_bytes)
+
+  def write(self, data):
+    self._checksum.update(data)
+    self._data_file.write(data)
+
+  def tell(self):
+    return self._data_file.tell()
+
+  def commit(self):
+    """ Moves the written file to its path, replacing any earlier file.
+
+        Returns:
+          str: Checksum of the content of the file.
+    """
+    self._data_file.close()
+    # The manifest of an earlier file would otherwise describe the new file
+    # until the caller records a new manifest.
+    utils.remove_output_manifest(self.data_filepath)
+    os.rename(self._temp_path, self.data_filepath)
+    return 'sha1:' + self._checksum.hexdigest()
+
+  def abort(self):
+    """ Discards the written data, leaving any earlier file in place. """
+    self._data_file.close()
+    _remove_file(self._temp_path)
+
+
+def _open_temp_file(data_filepath, buffer_bytes):
+  logger = logging.getLogger('telescope')
+  while True:
+    try:
+      temp_fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(data_filepath) or '.', prefix = '.tmp-')
+      return temp_path, os.fdopen(temp_fd, 'wb', buffer_bytes)
+    except (IOError, OSError) as caught_error:
+      if caught_error.errno != errno.EMFILE:
+        raise
+      logger.error(("When writing raw output, caught {error}, " +
+                    "trying again shortly.").format(error = caught_error))
+      time.sleep(_TOO_MANY_OPEN_FILES_RETRY_SECONDS)
+
+
+def commit_output_file(output_file, row_count, provenance = None):
+  """ Commits an AtomicOutputFile and records its manifest.
+
+      Args:
+        output_file (AtomicOutputFile): File to commit.
+        row_count (int): Number of rows of results written to the file.
+        provenance (dict): Keyword arguments of
+          telescope.utils.write_output_manifest that identify the queries
+          whose results the file holds.
+
+  """
+  checksum = output_file.commit()
+  utils.write_output_manifest(output_file.data_filepath, row_count, checksum, **(provenance or {}))
+
+
+class NpzResultsWriter(object):
+  """ Writes results to a compressed NumPy .npz archive holding a 'timestamp'
+      and a 'result' array. The archive is written when the writer is closed.
+  """
+
+  def __init__(self, data_filepath, provenance = None):
+    self.data_filepath = data_filepath
+    self._provenance = provenance
+    self._result_batches = []
+
+  def write(self, metric_calculations):
+    """ Appends an array of telescope.metrics_math.RESULT_DTYPE records. """
+    if len(metric_calculations) > 0:
+      self._result_batches.append(metric_calculations)
+
+  def close(self):
+    results = _concatenate_results(self._result_batches)
+    # Archives are assembled in memory, since writing them seeks back over
+    # the data.
+    archive = cStringIO.StringIO()
+    numpy.savez_compressed(archive, timestamp = results['timestamp'], result = results['result'])
+    output_file = AtomicOutputFile(self.data_filepath)
+    try:
+      output_file.write(archive.getvalue())
+    except:
+      output_file.abort()
+      raise
+    commit_output_file(output_file, len(results), self._provenance)
+
+  def abort(self):
+    self._result_batches = []
+
+
+class ColumnarResultsWriter(object):
+  """ Writes results to a columnar file organized, like Parquet, in row groups
+      with a footer that indexes them.
+
+      Each row group holds its timestamps as zlib-compressed little-endian
+      differences between consecutive timestamps, which are small and
+      compress well, then its results as zlib-compressed little-endian
+      float64 values. The footer lists the offset, row count and minimum and
+      maximum timestamp of every row group, so that readers can skip row
+      groups outside a time window.
+  """
+
+  def __init__(self, data_filepath, provenance = None, rows_per_row_group = _ROWS_PER_ROW_GROUP):
+    self.data_filepath = data_filepath
+    self._provenance = provenance
+    self._rows_per_row_group = rows_per_row_group
+    self._pending_batches = []
+    self._pending_rows = 0
+    self._row_groups = []
+    self._data_file = AtomicOutputFile(data_filepath)
+    self._data_file.write(_COLUMNAR_FILE_MAGIC)
+
+  def write(self, metric_calculations):
+    """ Appends an array of telescope.metrics_math.RESULT_DTYPE records. """
+    if len(metric_calculations) == 0:
+      return
+    self._pending_batches.append(metric_calculations)
+    self._pending_rows += len(metric_calculations)
+    if self._pending_rows >= self._rows_per_row_group:
+      self._flush_row_groups(False)
+
+  def close(self):
+    self._flush_row_groups(True)
+    footer = json.dumps({'row_groups': self._row_groups})
+    self._data_file.write(footer)
+    self._data_file.write(_COLUMNAR_FOOTER_LENGTH.pack(len(footer)))
+    self._data_file.write(_COLUMNAR_FILE_MAGIC)
+    commit_output_file(self._data_file, sum(row_group['rows'] for row_group in self._row_groups),
+                       self._provenance)
+
+  def abort(self):
+    self._data_file.abort()
+
+  def _flush_row_groups(self, include_partial_row_group):
+    pending_results = _concatenate_results(self._pending_batches)
+    row_group_start = 0
+    while (len(pending_results) - row_group_start >= self._rows_per_row_group or
+           (include_partial_row_group and row_group_start < len(pending_results))):
+      row_group_end = min(row_group_start + self._rows_per_row_group, len(pending_results))
+      self._write_row_group(pending_results[row_group_start:row_group_end])
+      row_group_start = row_group_end
+    self._pending_batches = [pending_results[row_group_start:]]
+    self._pending_rows = len(pending_results) - row_group_start
+
+  def _write_row_group(self, row_group_results):
+    timestamps = row_group_results['timestamp'].astype(numpy.int64)
+    timestamp_column = zlib.compress(numpy.diff(timestamps, prepend = 0).astype('<i8').tostring())
+    result_column = zlib.compress(row_group_results['result'].astype('<f8').tostring())
+    self._row_groups.append({'offset': self._data_file.tell(), 'rows': len(row_group_results),
+                             'min': int(timestamps.min()), 'max': int(timestamps.max())})
+    self._data_file.write(_COLUMNAR_ROW_GROUP_HEADER.pack(len(row_group_results), int(timestamps.min()),
+                                                          int(timestamps.max()), len(timestamp_column),
+                                                          len(result_column)))
+    self._data_file.write(timestamp_column)
+    self._data_file.write(result_column)
+
+
+class FixedWidthResultsWriter(object):
+  """ Writes results as consecutive 16-byte records of a little-endian int64
+      timestamp and float64 result, which can be loaded with numpy.fromfile.
+  """
+
+  def __init__(self, data_filepath, provenance = None):
+    self.data_filepath = data_filepath
+    self._provenance = provenance
+    self._row_count = 0
+    self._data_file = AtomicOutputFile(data_filepath)
+
+  def write(self, metric_calculations):
+    """ Appends an array of telescope.metrics_math.RESULT_DTYPE records. """
+    if len(metric_calculations) > 0:
+      self._data_file.write(numpy.asarray(metric_calculations).astype(_FIXED_WIDTH_DTYPE).tostring())
+      self._row_count += len(metric_calculations)
+
+  def close(self):
+    commit_output_file(self._data_file, self._row_count, self._provenance)
+
+  def abort(self):
+    self._data_file.abort()
+
+
+RESULTS_WRITERS = {'npz': NpzResultsWriter, 'columnar': ColumnarResultsWriter, 'binary': FixedWidthResultsWriter}
+
+
+def read_results(data_filepath, output_format = None, start_time = None, end_time = None):
+  """ Reads results written in one of the binary output formats.
+
+      Args:
+        data_filepath (str): Path of the output file.
+        output_format (str): Format of the file. Defaults to the format whose
+          extension the file has.
+        start_time (int): If given, only results at or after this timestamp
+          are returned.
+        end_time (int): If given, only results before this timestamp are
+          returned. Columnar files skip row groups outside the window.
+
+      Returns:
+        numpy.ndarray: telescope.metrics_math.RESULT_DTYPE records, in the
+        order they were written.
+
+  """
+  if output_format is None:
+    output_format = _format_of_filepath(data_filepath)
+  if output_format == 'npz':
+    with open(data_filepath, 'rb') as data_file:
+      archive = numpy.load(data_file)
+      results = numpy.zeros(len(archive['timestamp']), dtype = metrics_math.RESULT_DTYPE)
+      results['timestamp'] = archive['timestamp']
+      results['result'] = archive['result']
+  elif output_format == 'columnar':
+    results = _read_columnar_results(data_filepath, start_time, end_time)
+  elif output_format == 'binary':
+    results = numpy.fromfile(data_filepath, dtype = _FIXED_WIDTH_DTYPE).astype(metrics_math.RESULT_DTYPE)
+  else:
+    raise ValueError('UnsupportedOutputFormat: ' + str(output_format))
+
+  if start_time is not None:
+    results = results[results['timestamp'] >= start_time]
+  if end_time is not None:
+    results = results[results['timestamp'] < end_time]
+  return results
+
+
+def _read_columnar_results(data_filepath, start_time, end_time):
+  with open(data_filepath, 'rb') as data_file:
+    if data_file.read(len(_COLUMNAR_FILE_MAGIC)) != _COLUMNAR_FILE_MAGIC:
+      raise ValueError('UnreadableColumnarFile: ' + data_filepath)
+    data_file.seek(-(len(_COLUMNAR_FILE_MAGIC) + _COLUMNAR_FOOTER_LENGTH.size), os.SEEK_END)
+    footer_length, = _COLUMNAR_FOOTER_LENGTH.unpack(data_file.read(_COLUMNAR_FOOTER_LENGTH.size))
+    if data_file.read(len(_COLUMNAR_FILE_MAGIC)) != _COLUMNAR_FILE_MAGIC:
+      raise ValueError('TruncatedColumnarFile: ' + data_filepath)
+    data_file.seek(-(len(_COLUMNAR_FILE_MAGIC) + _COLUMNAR_FOOTER_LENGTH.size + footer_length), os.SEEK_END)
+    footer = json.loads(data_file.read(footer_length))
+
+    row_group_results = []
+    for row_group in footer['row_groups']:
+      if ((start_time is not None and row_group['max'] < start_time) or
+          (end_time is not None and row_group['min'] >= end_time)):
+        continue
+      data_file.seek(row_group['offset'])
+      row_count, _, _, timestamp_column_length, result_column_length = _COLUMNAR_ROW_GROUP_HEADER.unpack(
+          data_file.read(_COLUMNAR_ROW_GROUP_HEADER.size))
+      timestamp_column = zlib.decompress(data_file.read(timestamp_column_length))
+      result_column = zlib.decompress(data_file.read(result_column_length))
+      results = numpy.zeros(row_count, dtype = metrics_math.RESULT_DTYPE)
+      results['timestamp'] = numpy.cumsum(numpy.frombuffer(timestamp_column, dtype = '<i8'))
+      results['result'] = numpy.frombuffer(result_column, dtype = '<f8')
+      row_group_results.append(results)
+  return _concatenate_results(row_group_results)
+
+
+def _format_of_filepath(data_filepath):
+  for output_format, file_extension in FILE_EXTENSIONS.iteritems():
+    if data_filepath.endswith(file_extension):
+      return output_format
+  raise ValueError('UnknownOutputFormat: ' + data_filepath)
+
+
+def _concatenate_results(result_batches):
+  if not result_batches:
+    return numpy.zeros(0, dtype = metrics_math.RESULT_DTYPE)
+  return numpy.concatenate([numpy.asarray(batch).astype(metrics_math.RESULT_DTYPE) for batch in result_batches])
+
+
+def _remove_file(filepath):
+  try:
+    os.remove(filepath)
+  except OSError:
+    pass
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import metrics_math
+import outputformats
+import utils
+
+
+def results_array(timestamps):
+  results = numpy.zeros(len(timestamps), dtype = metrics_math.RESULT_DTYPE)
+  results['timestamp'] = timestamps
+  results['result'] = [timestamp / 10.0 for timestamp in timestamps]
+  return results
+
+
+class ResultsWritersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def write_batches(self, output_format, batches, **writer_args):
+    data_filepath = os.path.join(self.output_dir, 'out-' + outputformats.FILE_EXTENSIONS[output_format])
+    results_writer = outputformats.RESULTS_WRITERS[output_format](data_filepath, **writer_args)
+    for batch in batches:
+      results_writer.write(batch)
+    results_writer.close()
+    return data_filepath
+
+  def assertResultsEqual(self, expected_results, actual_results):
+    self.assertEqual(metrics_math.RESULT_DTYPE, actual_results.dtype)
+    self.assertListEqual(expected_results.tolist(), actual_results.tolist())
+
+  def test_formats_round_trip(self):
+    batches = [results_array([1400000000, 1400000300, 1399999900]), results_array([]),
+               results_array([1400000600])]
+    for output_format in ('npz', 'columnar', 'binary'):
+      data_filepath = self.write_batches(output_format, batches)
+      self.assertResultsEqual(numpy.concatenate(batches), outputformats.read_results(data_filepath))
+
+  def test_formats_round_trip_empty_output(self):
+    for output_format in ('npz', 'columnar', 'binary'):
+      data_filepath = self.write_batches(output_format, [])
+      self.assertEqual(0, len(outputformats.read_results(data_filepath)))
+
+  def test_fixed_width_records(self):
+    data_filepath = self.write_batches('binary', [results_array([1400000000, 1400000010])])
+    self.assertEqual(32, os.path.getsize(data_filepath))
+    records = numpy.fromfile(data_filepath, dtype = [('timestamp', '<i8'), ('result', '<f8')])
+    self.assertListEqual([(1400000000, 140000000.0), (1400000010, 140000001.0)], records.tolist())
+
+  def test_npz_arrays(self):
+    data_filepath = self.write_batches('npz', [results_array([1400000000, 1400000010])])
+    archive = numpy.load(data_filepath)
+    self.assertListEqual([1400000000, 1400000010], archive['timestamp'].tolist())
+    self.assertListEqual([140000000.0, 140000001.0], archive['result'].tolist())
+
+  def test_columnar_row_groups_prune_time_window(self):
+    timestamps = range(1400000000, 1400000100)
+    data_filepath = self.write_batches('columnar', [results_array(timestamps[:35]), results_array(timestamps[35:])],
+                                       rows_per_row_group = 10)
+    self.assertResultsEqual(results_array(timestamps), outputformats.read_results(data_filepath))
+    self.assertResultsEqual(results_array(timestamps[42:57]),
+                            outputformats.read_results(data_filepath, start_time = 1400000042,
+                                                       end_time = 1400000057))
+
+  def test_abort_removes_partial_file(self):
+    for output_format in ('npz', 'columnar', 'binary'):
+      data_filepath = os.path.join(self.output_dir, 'out-' + outputformats.FILE_EXTENSIONS[output_format])
+      results_writer = outputformats.RESULTS_WRITERS[output_format](data_filepath)
+      results_writer.write(results_array([1400000000]))
+      results_writer.abort()
+      self.assertFalse(os.path.exists(data_filepath))
+
+  def test_close_records_manifest(self):
+    for output_format in ('npz', 'columnar', 'binary'):
+      data_filepath = os.path.join(self.output_dir, 'out-' + outputformats.FILE_EXTENSIONS[output_format])
+      results_writer = outputformats.RESULTS_WRITERS[output_format](
+          data_filepath, {'query_hashes': ['q1'], 'db_snapshots': ['2014-09-01']})
+      results_writer.write(results_array([1400000000, 1400000010]))
+      results_writer.write(results_array([1400000020]))
+      self.assertFalse(utils.check_for_valid_cache(data_filepath))
+      results_writer.close()
+      self.assertTrue(utils.check_for_valid_cache(data_filepath))
+      manifest = utils.read_output_manifest(data_filepath)
+      self.assertEqual(3, manifest['rows'])
+      self.assertListEqual(['q1'], manifest['query_hashes'])
+      self.assertListEqual(['2014-09-01'], manifest['db_snapshots'])
+
+  def test_output_format_for_metric(self):
+    self.assertEqual('columnar', outputformats.output_format_for_metric('columnar', 'minimum_rtt'))
+    self.assertEqual('csv', outputformats.output_format_for_metric('columnar', 'hop_count'))
+    self.assertEqual('csv', outputformats.output_format_for_metric('csv', 'minimum_rtt'))
+
+
+class AtomicOutputFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+    self.data_filepath = os.path.join(self.output_dir, 'out-raw.csv')
+    with open(self.data_filepath, 'w') as data_file:
+      data_file.write('earlier')
+    utils.write_output_manifest(self.data_filepath, 1, 'sha1:earlier')
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def read_data_file(self):
+    with open(self.data_filepath, 'r') as data_file:
+      return data_file.read()
+
+  def test_commit_replaces_file(self):
+    output_file = outputformats.AtomicOutputFile(self.data_filepath)
+    output_file.write('later')
+    self.assertEqual('earlier', self.read_data_file())
+    self.assertEqual('sha1:' + hashlib.sha1('later').hexdigest(), output_file.commit())
+    self.assertEqual('later', self.read_data_file())
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath))
+    self.assertListEqual(['out-raw.csv'], os.listdir(self.output_dir))
+
+  def test_abort_keeps_earlier_file(self):
+    output_file = outputformats.AtomicOutputFile(self.data_filepath)
+    output_file.write('partial')
+    output_file.abort()
+    self.assertEqual('earlier', self.read_data_file())
+    self.assertTrue(utils.check_for_valid_cache(self.data_filepath))
+    self.assertListEqual(['out-raw.csv', 'out-raw.csv.manifest'], sorted(os.listdir(self.output_dir)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,6 +16,7 @@
 # limitations under the License.
 
 
+import hashlib
 import logging
 import datetime
 import dateutil.relativedelta
@@ -25,22 +26,150 @@ from dateutil import rrule
 
 import utils
 
+# Value of connection_spec.data_direction for the measurements of each NDT
+# metric: 1 for server-to-client tests and 0 for client-to-server tests.
+METRIC_DATA_DIRECTIONS = {
+    'download_throughput': 1,
+    'minimum_rtt': 1,
+    'average_rtt': 1,
+    'packet_retransmit_rate': 1,
+    'upload_throughput': 0,
+    }
+
+def merge_ip_blocks(ip_blocks):
+  """ Merges IP blocks into the minimal set of ranges covering the same
+      addresses.
+
+      Args:
+        ip_blocks (list): Tuples of (block_start, block_end), inclusive, in any
+          order and possibly overlapping or duplicated.
+
+      Returns:
+        list: Sorted, non-overlapping (range_start, range_end) tuples. Blocks
+        that overlap or are adjacent (one ends at the address before the next
+        starts) are merged into a single range.
+
+  """
+  merged_ranges = []
+  for block_start, block_end in sorted(ip_blocks):
+    if merged_ranges and block_start <= merged_ranges[-1][1] + 1:
+      if block_end > merged_ranges[-1][1]:
+        merged_ranges[-1] = (merged_ranges[-1][0], block_end)
+    else:
+      merged_ranges.append((block_start, block_end))
+  return merged_ranges
+
+def split_time_window(start_time, end_time, shard_unit):
+  """ Splits a time window into consecutive, non-overlapping shards at
+      calendar boundaries.
+
+      Args:
+        start_time (datetime): Start of the window, inclusive.
+        end_time (datetime): End of the window, exclusive.
+        shard_unit (str): 'month' to split at the first of each month, so that
+          each shard covers a single monthly table, or 'week' to split at the
+          start of each Monday.
+
+      Returns:
+        list: (shard_start, shard_end) tuples of datetimes that cover the
+        window, in time order. The first and last shards are shortened to the
+        window.
+
+  """
+  if shard_unit == 'month':
+    next_boundary = lambda shard_start: (shard_start.replace(day = 1, hour = 0, minute = 0, second = 0,
+                                                             microsecond = 0) +
+                                         dateutil.relativedelta.relativedelta(months = 1))
+  elif shard_unit == 'week':
+    next_boundary = lambda shard_start: (shard_start.replace(hour = 0, minute = 0, second = 0, microsecond = 0) +
+                                         datetime.timedelta(days = 7 - shard_start.weekday()))
+  else:
+    raise ValueError('UnsupportedShardUnit')
+
+  time_shards = []
+  shard_start = start_time
+  while shard_start < end_time:
+    shard_end = min(next_boundary(shard_start), end_time)
+    time_shards.append((shard_start, shard_end))
+    shard_start = shard_end
+  return time_shards
+
+class ClientRangesTable(object):
+  """ A small BigQuery table of client IP ranges that queries can join against
+      instead of listing every range in their WHERE clause.
+
+      Each range is stored once for every /16 prefix it spans, so that
+      measurements can be matched to candidate ranges with an equality join on
+      their address prefix before the exact range check. Tables are named by a
+      hash of their contents, so a table uploaded for one query can be reused by
+      any later query over the same ranges.
+
+  """
+  prefix_bits = 16
+  schema = [{'name': 'prefix', 'type': 'INTEGER'},
+            {'name': 'range_start', 'type': 'INTEGER'},
+            {'name': 'range_end', 'type': 'INTEGER'}]
+
+  def __init__(self, dataset_id, ip_blocks):
+    """ Creates a new client ranges table.
+
+        Args:
+          dataset_id (str): BigQuery dataset, in the project running the query,
+            that holds the table.
+          ip_blocks (list): Tuples of (block_start, block_end) to include.
+
+    """
+    self.dataset_id = dataset_id
+    self.ip_ranges = merge_ip_blocks(ip_blocks)
+    ranges_hash = hashlib.sha1(','.join('%d-%d' % ip_range for ip_range in self.ip_ranges))
+    self.table_id = 'client_ranges_' + ranges_hash.hexdigest()[:20]
+
+  def reference(self):
+    """ Legacy SQL reference to the table. Omitting the project makes BigQuery
+        resolve the table in the project that runs the query.
+    """
+    return '[{dataset_id}.{table_id}]'.format(dataset_id = self.dataset_id, table_id = self.table_id)
+
+  def rows(self):
+    """ Yields the rows of the table as dicts matching its schema. """
+    for range_start, range_end in self.ip_ranges:
+      for prefix in xrange(range_start >> self.prefix_bits, (range_end >> self.prefix_bits) + 1):
+        yield {'prefix': prefix, 'range_start': range_start, 'range_end': range_end}
+
 class BigQueryQueryGenerator:
 
   database_name = "measurement-lab"
   table_format = "[{database_name}:m_lab.{table_date}]"
 
-  def __init__(self, start_time, end_time, metric, project, server_ips, client_ip_blocks):
+  def __init__(self, start_time, end_time, metric, project, server_ips, client_ip_blocks,
+               client_ranges_table = None):
+    """ Generates a query for measurements of a metric.
+
+        Args:
+          metric (str or list): Metric to select fields for, or a list of
+            metrics to select the union of their fields for. Measurements are
+            restricted to one data direction only if all metrics share it.
+
+          client_ranges_table (ClientRangesTable, optional): If specified,
+            client IP blocks are matched by joining against this table rather
+            than with an inline predicate per range. The caller is responsible
+            for making sure the table exists before running the query.
+
+    """
     self.logger = logging.getLogger('telescope')
     self._select_list = self._build_select_list(metric)
     self._table_list = self._build_table_list(start_time, end_time)
     self._conditional_dict = {}
+    self._client_ranges_table = client_ranges_table
     is_web100 = project != 'paris_traceroute'
     self._add_data_direction_conditional(metric)
     self._add_log_time_conditional(start_time, end_time, is_web100)
     self._add_client_network_blocks_conditional(client_ip_blocks, is_web100)
     self._add_server_ips_conditional(server_ips, is_web100)
-    self._query = self._create_query_string(project)
+    if client_ranges_table is None:
+      self._query = self._create_query_string(project)
+    else:
+      self._query = self._create_client_ranges_join_query_string(project)
 
   def query(self):
     return self._query
@@ -48,6 +177,21 @@ class BigQueryQueryGenerator:
   def table_span(self):
     return len(self._table_list)
 
+  def predicate_count(self):
+    """ Number of range and address predicates in the query's WHERE clause,
+        which largely determines how long BigQuery takes to run it.
+    """
+    predicate_count = len(self._conditional_dict['log_time']) + len(self._conditional_dict['server_ip'])
+    if self._client_ranges_table is None:
+      predicate_count += len(self._conditional_dict['client_network_block'])
+    return predicate_count
+
+  def client_block_compression_ratio(self):
+    """ Ratio of the number of client IP blocks given to the generator to the
+        number of merged ranges that appear in the query.
+    """
+    return self._client_block_compression_ratio
+
   def _build_table_list(self, start_time, end_time):
     """ Enumerates monthly BigQuery tables covered between two datetime objects.
 
@@ -117,17 +261,21 @@ class BigQueryQueryGenerator:
     }
 
     if metric == 'all':
-      for metric_type, metric_names in metrics_types.iteritems():
-        metric_names_to_return |= metric_names
-    elif metric_types.has_key(metric):
-      metric_names_to_return |= set(metric_types[metric])
+      metrics = metric_types.keys()
+    elif isinstance(metric, basestring):
+      metrics = [metric]
     else:
-      raise ValueError('UnsupportedMetric')
+      metrics = metric
+
+    for metric in metrics:
+      if not metric_types.has_key(metric):
+        raise ValueError('UnsupportedMetric')
+      metric_names_to_return |= set(metric_types[metric])
 
     sorted_metric_names = sorted(list(metric_names_to_return))
     return sorted_metric_names
 
-  def _create_query_string(self, mlab_project = 'ndt'):
+  def _create_query_string(self, mlab_project = 'ndt', select_list = None, include_client_blocks = True):
 
     built_query_format = "SELECT\n\t{select_list}\nFROM\n\t{table_list}\nWHERE\n\t{conditional_list}"
     non_null_fields = []
@@ -149,7 +297,7 @@ class BigQueryQueryGenerator:
     for field in non_null_fields:
       non_null_conditions.append('%s IS NOT NULL' % field)
 
-    select_list_string = ",\n\t".join(self._select_list)
+    select_list_string = ",\n\t".join(select_list or self._select_list)
     table_list_string = ',\n\t'.join(self._table_list)
 
     conditional_list_string = "\n\tAND ".join(non_null_conditions + tool_specific_conditions)
@@ -164,8 +312,9 @@ class BigQueryQueryGenerator:
     server_ips_joined = " OR\n\t\t".join(self._conditional_dict['server_ip'])
     conditional_list_string += "\n\tAND ({server_ips})".format(server_ips = server_ips_joined)
 
-    client_ips_joined = " OR\n\t\t".join(self._conditional_dict['client_network_block'])
-    conditional_list_string += "\n\tAND ({client_ips})".format(client_ips = client_ips_joined)
+    if include_client_blocks:
+      client_ips_joined = " OR\n\t\t".join(self._conditional_dict['client_network_block'])
+      conditional_list_string += "\n\tAND ({client_ips})".format(client_ips = client_ips_joined)
 
     built_query_string = built_query_format.format(select_list = select_list_string,
                                                    table_list = table_list_string,
@@ -173,6 +322,33 @@ class BigQueryQueryGenerator:
 
     return built_query_string
 
+  def _create_client_ranges_join_query_string(self, mlab_project = 'ndt'):
+    """ Builds a query that selects measurements in an inner query without any
+        client IP condition, then keeps only those whose client address falls
+        in a range of the client ranges table.
+    """
+    client_ranges_table = self._client_ranges_table
+    select_aliases = [field.replace('.', '_') for field in self._select_list]
+
+    inner_select_list = ['{field} AS {alias}'.format(field = field, alias = alias)
+                         for field, alias in zip(self._select_list, select_aliases)]
+    inner_select_list.append('PARSE_IP({remote_ip_fieldname}) AS client_ip'.format(
+        remote_ip_fieldname = self._remote_ip_fieldname))
+    inner_select_list.append('INTEGER(PARSE_IP({remote_ip_fieldname}) / {prefix_size}) AS client_ip_prefix'.format(
+        remote_ip_fieldname = self._remote_ip_fieldname, prefix_size = 2 ** client_ranges_table.prefix_bits))
+    inner_query_string = self._create_query_string(mlab_project, select_list = inner_select_list,
+                                                   include_client_blocks = False)
+
+    outer_select_list = ['measurements.{alias} AS {alias}'.format(alias = alias) for alias in select_aliases]
+    built_query_format = ("SELECT\n\t{select_list}\nFROM (\n\t{inner_query}\n) AS measurements\n" +
+                          "JOIN\n\t{client_ranges_table} AS client_ranges\n" +
+                          "ON\n\tmeasurements.client_ip_prefix = client_ranges.prefix\n" +
+                          "WHERE\n\tmeasurements.client_ip BETWEEN client_ranges.range_start AND " +
+                          "client_ranges.range_end")
+    return built_query_format.format(select_list = ",\n\t".join(outer_select_list),
+                                     inner_query = inner_query_string.replace('\n', '\n\t'),
+                                     client_ranges_table = client_ranges_table.reference())
+
   def _add_log_time_conditional(self, start_time_datetime, end_time_datetime, is_web100):
     if not (self._conditional_dict.has_key('log_time')):
       self._conditional_dict['log_time'] = set()
@@ -193,27 +369,39 @@ class BigQueryQueryGenerator:
     self._conditional_dict['log_time'].add(new_statement)
 
   def _add_data_direction_conditional(self, metric):
-    if metric in ['download_throughput', 'minimum_rtt', 'average_rtt', 'packet_retransmit_rate']:
-      self._conditional_dict['data_direction'] = 'connection_spec.data_direction == 1'
-    elif metric in ['upload_throughput']:
-      self._conditional_dict['data_direction'] = 'connection_spec.data_direction == 0'
+    if isinstance(metric, basestring):
+      metrics = [metric]
+    else:
+      metrics = metric
 
-  def _add_client_network_blocks_conditional(self, client_ip_blocks, is_web100):
-    # remove duplicates, warn if any are found
-    unique_client_ip_blocks = list(set(client_ip_blocks))
-    if len(client_ip_blocks) != len(unique_client_ip_blocks):
-      self.logger.warning('Client IP blocks contained duplicates.')
+    # A query for several metrics can only be restricted to one direction if
+    # every metric is measured in that direction.
+    data_directions = set(METRIC_DATA_DIRECTIONS.get(metric) for metric in metrics)
+    if len(data_directions) == 1 and None not in data_directions:
+      self._conditional_dict['data_direction'] = 'connection_spec.data_direction == {data_direction}'.format(
+          data_direction = data_directions.pop())
 
-    # sort the blocks for the sake of consistent query generation
-    unique_client_ip_blocks = sorted(unique_client_ip_blocks, key = lambda block: block[0])
+  def _add_client_network_blocks_conditional(self, client_ip_blocks, is_web100):
+    # merging also removes duplicates and sorts the blocks, which keeps query
+    # generation consistent
+    merged_client_ip_blocks = merge_ip_blocks(client_ip_blocks)
+    if len(merged_client_ip_blocks) > 0:
+      self._client_block_compression_ratio = float(len(client_ip_blocks)) / len(merged_client_ip_blocks)
+    else:
+      self._client_block_compression_ratio = 1.0
+    self.logger.info(('Merged {block_count} client IP blocks into {range_count} ranges ' +
+                      '({ratio:.1f}x).').format(block_count = len(client_ip_blocks),
+                                                range_count = len(merged_client_ip_blocks),
+                                                ratio = self._client_block_compression_ratio))
 
     if is_web100:
       remote_ip_fieldname = 'web100_log_entry.connection_spec.remote_ip'
     else:
       remote_ip_fieldname = 'connection_spec.client_ip'
+    self._remote_ip_fieldname = remote_ip_fieldname
 
     self._conditional_dict['client_network_block'] = []
-    for start_block, end_block in client_ip_blocks:
+    for start_block, end_block in merged_client_ip_blocks:
       new_statement = ('PARSE_IP({remote_ip_fieldname}) BETWEEN ' +
                        '{start_block} AND {end_block}').format(remote_ip_fieldname = remote_ip_fieldname,
                                                                start_block = start_block,
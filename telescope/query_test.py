@@ -302,6 +302,198 @@ WHERE
        PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 35 AND 80)"""
     self.assertQueriesEqual(query_expected, query_actual)
 
+  def testNdtQueryMergesClientBlocks(self):
+    start_time = datetime.datetime(2014, 1, 1)
+    end_time = datetime.datetime(2014, 2, 1)
+    server_ips = ['1.1.1.1',]
+    client_ip_blocks = [
+        (35, 80),
+        (5, 10),
+        (11, 20),
+        (40, 50),
+        (5, 10),
+        (79, 90)
+        ]
+    query_actual = self.generate_download_throughput_query(start_time,
+                                                           end_time,
+                                                           server_ips,
+                                                           client_ip_blocks)
+    self.assertIn("""(PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 5 AND 20 OR
+\t\tPARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 35 AND 90)""", query_actual)
+
+  def testNdtQueryJoinsClientRangesTable(self):
+    client_ranges_table = query.ClientRangesTable('telescope', [(5, 10), (35, 80)])
+    generator = query.BigQueryQueryGenerator(
+        utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1)),
+        utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 1)),
+        'upload_throughput', 'ndt', ['1.1.1.1'], [(5, 10), (35, 80)], client_ranges_table)
+    query_expected = """
+SELECT
+  measurements.connection_spec_data_direction AS connection_spec_data_direction,
+  measurements.web100_log_entry_log_time AS web100_log_entry_log_time,
+  measurements.web100_log_entry_snap_Duration AS web100_log_entry_snap_Duration,
+  measurements.web100_log_entry_snap_HCThruOctetsReceived AS web100_log_entry_snap_HCThruOctetsReceived,
+  measurements.web100_log_entry_snap_State AS web100_log_entry_snap_State
+FROM (
+  SELECT
+    connection_spec.data_direction AS connection_spec_data_direction,
+    web100_log_entry.log_time AS web100_log_entry_log_time,
+    web100_log_entry.snap.Duration AS web100_log_entry_snap_Duration,
+    web100_log_entry.snap.HCThruOctetsReceived AS web100_log_entry_snap_HCThruOctetsReceived,
+    web100_log_entry.snap.State AS web100_log_entry_snap_State,
+    PARSE_IP(web100_log_entry.connection_spec.remote_ip) AS client_ip,
+    INTEGER(PARSE_IP(web100_log_entry.connection_spec.remote_ip) / 65536) AS client_ip_prefix
+  FROM
+    [measurement-lab:m_lab.2014_01]
+  WHERE
+    connection_spec.data_direction IS NOT NULL
+    AND web100_log_entry.is_last_entry IS NOT NULL
+    AND web100_log_entry.snap.HCThruOctetsAcked IS NOT NULL
+    AND web100_log_entry.snap.CongSignals IS NOT NULL
+    AND web100_log_entry.connection_spec.remote_ip IS NOT NULL
+    AND web100_log_entry.connection_spec.local_ip IS NOT NULL
+    AND project = 0
+    AND web100_log_entry.is_last_entry = True
+    AND connection_spec.data_direction == 0
+    AND ((web100_log_entry.log_time >= 1388534400) AND (web100_log_entry.log_time < 1391212800))
+    AND (web100_log_entry.connection_spec.local_ip = '1.1.1.1')
+) AS measurements
+JOIN
+  [telescope.{table_id}] AS client_ranges
+ON
+  measurements.client_ip_prefix = client_ranges.prefix
+WHERE
+  measurements.client_ip BETWEEN client_ranges.range_start AND client_ranges.range_end""".format(
+      table_id = client_ranges_table.table_id)
+    self.assertQueriesEqual(query_expected, generator.query())
+
+  def testNdtQueryForSeveralMetrics(self):
+    start_time = datetime.datetime(2014, 1, 1)
+    end_time = datetime.datetime(2014, 2, 1)
+    server_ips = ['1.1.1.1',]
+    client_ip_blocks = [(5, 10),]
+    query_actual = self.generate_ndt_query(start_time,
+                                           end_time,
+                                           ['upload_throughput', 'minimum_rtt'],
+                                           server_ips,
+                                           client_ip_blocks)
+    query_expected = """
+SELECT
+  connection_spec.data_direction,
+  web100_log_entry.log_time,
+  web100_log_entry.snap.CongSignals,
+  web100_log_entry.snap.CountRTT,
+  web100_log_entry.snap.Duration,
+  web100_log_entry.snap.HCThruOctetsAcked,
+  web100_log_entry.snap.HCThruOctetsReceived,
+  web100_log_entry.snap.MinRTT,
+  web100_log_entry.snap.SndLimTimeCwnd,
+  web100_log_entry.snap.SndLimTimeRwin,
+  web100_log_entry.snap.SndLimTimeSnd,
+  web100_log_entry.snap.State
+FROM
+  [measurement-lab:m_lab.2014_01]
+WHERE
+  connection_spec.data_direction IS NOT NULL
+  AND web100_log_entry.is_last_entry IS NOT NULL
+  AND web100_log_entry.snap.HCThruOctetsAcked IS NOT NULL
+  AND web100_log_entry.snap.CongSignals IS NOT NULL
+  AND web100_log_entry.connection_spec.remote_ip IS NOT NULL
+  AND web100_log_entry.connection_spec.local_ip IS NOT NULL
+  AND project = 0
+  AND web100_log_entry.is_last_entry = True
+  AND ((web100_log_entry.log_time >= 1388534400) AND (web100_log_entry.log_time < 1391212800))
+  AND (web100_log_entry.connection_spec.local_ip = '1.1.1.1')
+  AND (PARSE_IP(web100_log_entry.connection_spec.remote_ip) BETWEEN 5 AND 10)"""
+    self.assertQueriesEqual(query_expected, query_actual)
+
+  def testNdtQueryForSeveralMetricsInOneDirection(self):
+    start_time = datetime.datetime(2014, 1, 1)
+    end_time = datetime.datetime(2014, 2, 1)
+    query_actual = self.generate_ndt_query(start_time,
+                                           end_time,
+                                           ['average_rtt', 'minimum_rtt', 'download_throughput'],
+                                           ['1.1.1.1',],
+                                           [(5, 10),])
+    self.assertIn('AND connection_spec.data_direction == 1', query_actual)
+
+class SplitTimeWindowTest(unittest.TestCase):
+
+  def testMonthShardsFollowMonthlyTables(self):
+    time_shards = query.split_time_window(datetime.datetime(2014, 1, 15), datetime.datetime(2014, 3, 10), 'month')
+    self.assertListEqual([(datetime.datetime(2014, 1, 15), datetime.datetime(2014, 2, 1)),
+                          (datetime.datetime(2014, 2, 1), datetime.datetime(2014, 3, 1)),
+                          (datetime.datetime(2014, 3, 1), datetime.datetime(2014, 3, 10))], time_shards)
+    for shard_start, shard_end in time_shards:
+      shard_generator = query.BigQueryQueryGenerator(utils.make_datetime_utc_aware(shard_start),
+                                                     utils.make_datetime_utc_aware(shard_end),
+                                                     'minimum_rtt', 'ndt', ['1.1.1.1'], [(5, 10)])
+      self.assertEqual(1, shard_generator.table_span())
+
+  def testWeekShardsStartOnMondays(self):
+    time_shards = query.split_time_window(datetime.datetime(2014, 1, 1, 12), datetime.datetime(2014, 1, 14), 'week')
+    self.assertListEqual([(datetime.datetime(2014, 1, 1, 12), datetime.datetime(2014, 1, 6)),
+                          (datetime.datetime(2014, 1, 6), datetime.datetime(2014, 1, 13)),
+                          (datetime.datetime(2014, 1, 13), datetime.datetime(2014, 1, 14))], time_shards)
+
+  def testWindowWithinOneShard(self):
+    time_shards = query.split_time_window(datetime.datetime(2014, 1, 1), datetime.datetime(2014, 2, 1), 'month')
+    self.assertListEqual([(datetime.datetime(2014, 1, 1), datetime.datetime(2014, 2, 1))], time_shards)
+
+  def testTimeZoneIsKept(self):
+    start_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 15))
+    end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 10))
+    time_shards = query.split_time_window(start_time, end_time, 'month')
+    self.assertEqual(utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 1)), time_shards[0][1])
+    self.assertIsNotNone(time_shards[0][1].tzinfo)
+
+  def testUnsupportedShardUnit(self):
+    with self.assertRaises(ValueError):
+      query.split_time_window(datetime.datetime(2014, 1, 1), datetime.datetime(2014, 2, 1), 'day')
+
+class ClientRangesTableTest(unittest.TestCase):
+
+  def testRowsCoverEveryPrefix(self):
+    client_ranges_table = query.ClientRangesTable('telescope', [(65530, 131080), (5, 10), (6, 12)])
+    self.assertListEqual([(5, 12), (65530, 131080)], client_ranges_table.ip_ranges)
+    self.assertListEqual([
+        {'prefix': 0, 'range_start': 5, 'range_end': 12},
+        {'prefix': 0, 'range_start': 65530, 'range_end': 131080},
+        {'prefix': 1, 'range_start': 65530, 'range_end': 131080},
+        {'prefix': 2, 'range_start': 65530, 'range_end': 131080},
+        ], list(client_ranges_table.rows()))
+    self.assertEqual('[telescope.%s]' % client_ranges_table.table_id, client_ranges_table.reference())
+
+class MergeIPBlocksTest(unittest.TestCase):
+
+  def testMergeIPBlocks(self):
+    self.assertListEqual([], query.merge_ip_blocks([]))
+    self.assertListEqual([(5, 10)], query.merge_ip_blocks([(5, 10), (5, 10)]))
+    self.assertListEqual([(5, 10), (12, 20)], query.merge_ip_blocks([(12, 20), (5, 10)]))
+    self.assertListEqual([(5, 20)], query.merge_ip_blocks([(11, 20), (5, 10)]))
+    self.assertListEqual([(5, 20)], query.merge_ip_blocks([(5, 20), (7, 9)]))
+    self.assertListEqual([(1, 30)], query.merge_ip_blocks([(1, 10), (20, 30), (5, 25)]))
+
+  def testCompressionRatio(self):
+    generator = query.BigQueryQueryGenerator(
+        utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1)),
+        utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 1)),
+        'download_throughput', 'ndt', ['1.1.1.1'], [(1, 10), (11, 20), (30, 40), (41, 50)])
+    self.assertEqual(2.0, generator.client_block_compression_ratio())
+
+  def testPredicateCount(self):
+    start_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 1, 1))
+    end_time = utils.make_datetime_utc_aware(datetime.datetime(2014, 2, 1))
+    client_ip_blocks = [(1, 10), (30, 40), (60, 70)]
+    generator = query.BigQueryQueryGenerator(start_time, end_time, 'download_throughput', 'ndt',
+                                             ['1.1.1.1', '2.2.2.2'], client_ip_blocks)
+    self.assertEqual(6, generator.predicate_count())
+
+    # Client ranges matched by a join do not add predicates.
+    generator = query.BigQueryQueryGenerator(start_time, end_time, 'download_throughput', 'ndt',
+                                             ['1.1.1.1', '2.2.2.2'], client_ip_blocks,
+                                             query.ClientRangesTable('telescope', client_ip_blocks))
+    self.assertEqual(3, generator.predicate_count())
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy
+
+import columns
+
+_CACHE_FILE_MAGIC = 'TLSCQRC2'
+_CACHE_FILE_EXTENSION = '.qrc'
+_CHUNK_LENGTH = struct.Struct('<I')
+_MEASUREMENTS_PER_CHUNK = 100000
+
+
+def normalize_query(query_string):
+  """ Collapses whitespace in a query so that formatting differences do not
+      change its cache key.
+  """
+  return re.sub(r'\s+', ' ', query_string).strip()
+
+
+def query_hash(query_string):
+  """ Content hash of a query, used as the key of its cached results.
+
+      Args:
+        query_string (str): BigQuery query string.
+
+      Returns:
+        str: Hex SHA-1 digest of the normalized query.
+
+  """
+  return hashlib.sha1(normalize_query(query_string)).hexdigest()
+
+
+class QueryResultCache(object):
+  """ Local, content-addressed cache of raw BigQuery query results.
+
+      Results are keyed by a hash of the normalized query string, so identical
+      queries hit the cache regardless of where their output is written. Each
+      entry is stored as zlib-compressed chunks of typed columns, which are
+      read back without decoding the values again. When the cache grows beyond
+      its size limit, the least recently used entries are removed.
+
+  """
+
+  def __init__(self, cache_dir, max_size_bytes):
+    """ Creates a new cache.
+
+        Args:
+          cache_dir (str): Directory in which to store cached results. Created
+            if it does not exist.
+          max_size_bytes (int): Total size of cached results above which the
+            least recently used entries are evicted.
+
+    """
+    self.logger = logging.getLogger('telescope')
+    self.cache_dir = cache_dir
+    self.max_size_bytes = max_size_bytes
+    self._lock = threading.Lock()
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+
+  def get(self, query_string):
+    """ Retrieves the cached results of a query.
+
+        Args:
+          query_string (str): BigQuery query string.
+
+        Returns:
+          telescope.columns.MeasurementColumns: Cached measurements, or None
+          if the query's results are not cached.
+
+    """
+    result_pages = self.get_pages(query_string)
+    if result_pages is None:
+      return None
+    try:
+      return columns.MeasurementColumns.concatenate(list(result_pages))
+    except ValueError:
+      return None
+
+  def get_pages(self, query_string):
+    """ Retrieves the cached results of a query one stored chunk at a time.
+
+        Args:
+          query_string (str): BigQuery query string.
+
+        Returns:
+          generator: Yields a telescope.columns.MeasurementColumns for each
+          stored chunk, or None if the query's results are not cached. Raises ValueError while
+          iterating if the entry turns out to be unreadable, in which case the
+          entry is discarded.
+
+    """
+    entry_path = self._entry_path(query_string)
+    try:
+      entry_file = open(entry_path, 'rb')
+    except IOError:
+      return None
+    if entry_file.read(len(_CACHE_FILE_MAGIC)) != _CACHE_FILE_MAGIC:
+      entry_file.close()
+      self.logger.warning('Discarding unreadable cached results %s.', entry_path)
+      self.discard(query_string)
+      return None
+
+    try:
+      # The modification time of an entry records when it was last used.
+      os.utime(entry_path, None)
+    except OSError:
+      pass
+    return self._iter_entry_pages(query_string, entry_file)
+
+  def _iter_entry_pages(self, query_string, entry_file):
+    with entry_file:
+      try:
+        for measurement_columns in _read_chunks(entry_file):
+          yield measurement_columns
+      except (ValueError, struct.error, zlib.error) as caught_error:
+        self.logger.warning('Discarding unreadable cached results %s: %s', entry_file.name, caught_error)
+        self.discard(query_string)
+        raise ValueError('UnreadableCacheEntry')
+
+  def put(self, query_string, measurement_columns):
+    """ Stores the results of a query, then evicts entries if the cache is
+        over its size limit.
+
+        Args:
+          query_string (str): BigQuery query string.
+          measurement_columns (telescope.columns.MeasurementColumns): Results
+            of the query.
+
+    """
+    entry_writer = self.writer(query_string)
+    try:
+      for chunk_start in xrange(0, len(measurement_columns), _MEASUREMENTS_PER_CHUNK):
+        chunk_end = min(chunk_start + _MEASUREMENTS_PER_CHUNK, len(measurement_columns))
+        entry_writer.write_columns(measurement_columns.select(numpy.arange(chunk_start, chunk_end)))
+    except:
+      entry_writer.abort()
+      raise
+    entry_writer.commit()
+
+  def writer(self, query_string):
+    """ Starts storing the results of a query incrementally.
+
+        Args:
+          query_string (str): BigQuery query string.
+
+        Returns:
+          QueryResultCacheWriter: Writer to which to pass the measurements as
+          they are retrieved. The entry becomes visible only once the writer is
+          committed.
+
+    """
+    return QueryResultCacheWriter(self, query_string)
+
+  def discard(self, query_string):
+    """ Removes the cached results of a query, if any. """
+    try:
+      os.remove(self._entry_path(query_string))
+    except OSError:
+      pass
+
+  def _entry_path(self, query_string):
+    return os.path.join(self.cache_dir, query_hash(query_string) + _CACHE_FILE_EXTENSION)
+
+  def _evict(self):
+    """ Removes least recently used entries until the cache fits its limit. """
+    with self._lock:
+      entries = []
+      total_size = 0
+      for entry_filename in os.listdir(self.cache_dir):
+        if not entry_filename.endswith(_CACHE_FILE_EXTENSION):
+          continue
+        entry_path = os.path.join(self.cache_dir, entry_filename)
+        try:
+          entry_stat = os.stat(entry_path)
+        except OSError:
+          continue
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        total_size += entry_stat.st_size
+
+      for _, entry_size, entry_path in sorted(entries):
+        if total_size <= self.max_size_bytes:
+          break
+        try:
+          os.remove(entry_path)
+          self.logger.debug('Evicted cached results %s.', entry_path)
+        except OSError:
+          pass
+        total_size -= entry_size
+
+
+class QueryResultCacheWriter(object):
+  """ Incrementally writes the results of one query to the cache. """
+
+  def __init__(self, query_result_cache, query_string):
+    self._query_result_cache = query_result_cache
+    self._entry_path = query_result_cache._entry_path(query_string)
+    entry_fd, self._temp_path = tempfile.mkstemp(dir = query_result_cache.cache_dir, prefix = '.tmp-')
+    self._entry_file = os.fdopen(entry_fd, 'wb')
+    self._entry_file.write(_CACHE_FILE_MAGIC)
+
+  def write_columns(self, measurement_columns):
+    """ Appends a telescope.columns.MeasurementColumns to the entry. """
+    if len(measurement_columns) > 0:
+      _write_chunk(self._entry_file, measurement_columns)
+
+  def commit(self):
+    """ Makes the entry visible, then evicts entries if the cache is over its
+        size limit.
+    """
+    self._entry_file.close()
+    os.rename(self._temp_path, self._entry_path)
+    self._query_result_cache._evict()
+
+  def abort(self):
+    """ Discards the partially written entry. """
+    self._entry_file.close()
+    try:
+      os.remove(self._temp_path)
+    except OSError:
+      pass
+
+
+def _write_chunk(entry_file, measurement_columns):
+  fieldnames = measurement_columns.fieldnames
+  header = {'length': len(measurement_columns),
+            'fields': [[fieldname, measurement_columns.field_types[fieldname]] for fieldname in fieldnames]}
+  chunk_parts = [json.dumps(header)]
+  for fieldname in fieldnames:
+    column = measurement_columns[fieldname]
+    dtype = columns.column_dtype(measurement_columns.field_types[fieldname])
+    chunk_parts.append(numpy.packbits(numpy.ma.getmaskarray(column)).tostring())
+    if dtype is not None:
+      chunk_parts.append(numpy.ma.getdata(column).astype(numpy.dtype(dtype).newbyteorder('<')).tostring())
+    else:
+      chunk_parts.append(json.dumps(numpy.ma.getdata(column).tolist()))
+
+  chunk = zlib.compress(''.join(_CHUNK_LENGTH.pack(len(chunk_part)) + chunk_part
+                                for chunk_part in chunk_parts))
+  entry_file.write(_CHUNK_LENGTH.pack(len(chunk)))
+  entry_file.write(chunk)
+
+
+def _read_chunks(entry_file):
+  while True:
+    chunk_length_bytes = entry_file.read(_CHUNK_LENGTH.size)
+    if not chunk_length_bytes:
+      return
+    chunk_length, = _CHUNK_LENGTH.unpack(chunk_length_bytes)
+    chunk_parts = _split_chunk(zlib.decompress(entry_file.read(chunk_length)))
+    try:
+      yield _decode_chunk(chunk_parts)
+    except StopIteration:
+      raise ValueError('TruncatedCacheChunk')
+
+
+def _decode_chunk(chunk_parts):
+  header = json.loads(next(chunk_parts))
+  length = header['length']
+  decoded_columns = {}
+  field_types = {}
+  for fieldname, field_type in header['fields']:
+    null_mask = numpy.unpackbits(numpy.frombuffer(next(chunk_parts), dtype = numpy.uint8))[:length]
+    dtype = columns.column_dtype(field_type)
+    if dtype is not None:
+      data = numpy.frombuffer(next(chunk_parts), dtype = numpy.dtype(dtype).newbyteorder('<'))
+      data = data.astype(dtype)
+    else:
+      data = numpy.empty(length, dtype = object)
+      data[:] = json.loads(next(chunk_parts))
+    if len(data) != length or len(null_mask) != length:
+      raise ValueError('TruncatedCacheChunk')
+    decoded_columns[fieldname] = numpy.ma.MaskedArray(data, mask = null_mask.astype(numpy.bool_))
+    field_types[fieldname] = field_type
+  return columns.MeasurementColumns(decoded_columns, field_types, length)
+
+
+def _split_chunk(chunk):
+  chunk_offset = 0
+  while chunk_offset < len(chunk):
+    chunk_part_length, = _CHUNK_LENGTH.unpack_from(chunk, chunk_offset)
+    chunk_offset += _CHUNK_LENGTH.size
+    if chunk_offset + chunk_part_length > len(chunk):
+      raise ValueError('TruncatedCacheChunk')
+    yield chunk[chunk_offset:chunk_offset + chunk_part_length]
+    chunk_offset += chunk_part_length
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import columns
+import resultcache
+
+
+class QueryResultCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    rows = [
+        {'web100_log_entry_log_time': '1392247312', 'web100_log_entry_snap_SmoothedRTT': '120.5',
+         'connection_spec_client_ip': '10.0.0.1'},
+        {'web100_log_entry_log_time': '1392247313', 'web100_log_entry_snap_SmoothedRTT': None,
+         'connection_spec_client_ip': None},
+        ]
+    self.measurements = columns.MeasurementColumns.from_rows(rows, {
+        'web100_log_entry_log_time': 'INTEGER', 'web100_log_entry_snap_SmoothedRTT': 'FLOAT'})
+
+  def assertColumnsEqual(self, expected, actual):
+    self.assertIsNotNone(actual)
+    self.assertDictEqual(expected.field_types, actual.field_types)
+    self.assertListEqual(list(expected.iter_rows()), list(actual.iter_rows()))
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_get_returns_stored_rows(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    cache.put('SELECT a FROM b', self.measurements)
+    self.assertColumnsEqual(self.measurements, cache.get('SELECT a FROM b'))
+
+  def test_get_uncached_query_returns_none(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    self.assertIsNone(cache.get('SELECT a FROM b'))
+
+  def test_empty_results_are_cached(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    cache.put('SELECT a FROM b', self.measurements.select(numpy.array([], dtype = numpy.int64)))
+    self.assertEqual(0, len(cache.get('SELECT a FROM b')))
+
+  def test_whitespace_does_not_change_key(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    cache.put('SELECT a\n  FROM b', self.measurements)
+    self.assertColumnsEqual(self.measurements, cache.get('  SELECT a FROM\tb  '))
+    self.assertIsNone(cache.get('SELECT a FROM c'))
+
+  def test_get_pages_returns_written_chunks(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    entry_writer = cache.writer('SELECT a FROM b')
+    entry_writer.write_columns(self.measurements)
+    entry_writer.write_columns(self.measurements.select(numpy.array([True, False])))
+    self.assertIsNone(cache.get('SELECT a FROM b'))
+    entry_writer.commit()
+
+    self.assertListEqual([2, 1], [len(page) for page in cache.get_pages('SELECT a FROM b')])
+
+  def test_unreadable_entry_is_discarded(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    cache.put('SELECT a FROM b', self.measurements)
+    entry_path = os.path.join(self.cache_dir, resultcache.query_hash('SELECT a FROM b') + '.qrc')
+    with open(entry_path, 'wb') as entry_file:
+      entry_file.write('corrupt')
+
+    self.assertIsNone(cache.get('SELECT a FROM b'))
+    self.assertFalse(os.path.exists(entry_path))
+
+  def test_least_recently_used_entry_is_evicted(self):
+    cache = resultcache.QueryResultCache(self.cache_dir, 1024 * 1024)
+    cache.put('SELECT 1', self.measurements)
+    cache.put('SELECT 2', self.measurements)
+    entry_size = os.path.getsize(os.path.join(self.cache_dir, resultcache.query_hash('SELECT 1') + '.qrc'))
+
+    # Mark the first entry as used more recently than the second.
+    os.utime(os.path.join(self.cache_dir, resultcache.query_hash('SELECT 1') + '.qrc'), (2000, 2000))
+    os.utime(os.path.join(self.cache_dir, resultcache.query_hash('SELECT 2') + '.qrc'), (1000, 1000))
+
+    cache.max_size_bytes = entry_size * 2
+    cache.put('SELECT 3', self.measurements)
+
+    self.assertIsNotNone(cache.get('SELECT 1'))
+    self.assertIsNone(cache.get('SELECT 2'))
+    self.assertIsNotNone(cache.get('SELECT 3'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sqlite3
+import threading
+import time
+
+import resultcache
+
+SUBMITTED = 'submitted'
+RETRIEVED = 'retrieved'
+FAILED = 'failed'
+
+
+class RunJournal(object):
+  """ Durable record of the BigQuery jobs submitted for each query.
+
+      Each query's job ID is committed to a SQLite database as soon as the job
+      is submitted, and its state is updated once its results are retrieved or
+      retrieval fails. A run that is interrupted or crashes can then be
+      restarted without losing track of its jobs: queries whose jobs were
+      submitted but not yet retrieved reattach to those jobs rather than
+      submitting, and paying for, the same query again.
+
+      Queries are keyed by the same normalized hash as cached query results.
+
+  """
+
+  def __init__(self, journal_path):
+    """ Opens a journal, creating it if it does not exist.
+
+        Args:
+          journal_path (str): Path of the SQLite database file.
+
+    """
+    self.journal_path = journal_path
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(journal_path, check_same_thread = False)
+    with self._lock, self._connection:
+      self._connection.execute(
+          'CREATE TABLE IF NOT EXISTS query_jobs ('
+          'query_hash TEXT PRIMARY KEY, '
+          'query_string TEXT NOT NULL, '
+          'job_id TEXT NOT NULL, '
+          'state TEXT NOT NULL, '
+          'description TEXT, '
+          'submitted_time REAL NOT NULL, '
+          'updated_time REAL NOT NULL)')
+
+  def find_submitted_job(self, query_string):
+    """ Looks up the job last submitted for a query, if its results have not
+        been retrieved and retrieving them has not failed.
+
+        Args:
+          query_string (str): BigQuery query string.
+
+        Returns:
+          tuple: The job's ID and the time at which it was submitted, in
+          seconds since the epoch, or None if there is no such job.
+
+    """
+    with self._lock:
+      journal_row = self._connection.execute(
+          'SELECT job_id, submitted_time FROM query_jobs WHERE query_hash = ? AND state = ?',
+          (resultcache.query_hash(query_string), SUBMITTED)).fetchone()
+    if journal_row is None:
+      return None
+    return str(journal_row[0]), journal_row[1]
+
+  def record_submission(self, query_string, job_id, description = None, submitted_time = None):
+    """ Records that a job was submitted for a query, replacing any job
+        previously recorded for it.
+
+        Args:
+          query_string (str): BigQuery query string.
+          job_id (str): ID of the submitted job.
+          description (str): Readable description of the selectors the query
+            serves.
+          submitted_time (float): Time of submission in seconds since the
+            epoch. Defaults to now.
+
+    """
+    submitted_time = submitted_time or time.time()
+    with self._lock, self._connection:
+      self._connection.execute(
+          'INSERT OR REPLACE INTO query_jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (resultcache.query_hash(query_string), query_string, job_id, SUBMITTED, description,
+           submitted_time, submitted_time))
+
+  def record_retrieval(self, query_string):
+    """ Records that the results of a query's job were retrieved. """
+    self._update_state(query_string, RETRIEVED)
+
+  def record_failure(self, query_string):
+    """ Records that retrieving the results of a query's job failed, so that
+        the query is submitted again when it is next run.
+    """
+    self._update_state(query_string, FAILED)
+
+  def job_states(self):
+    """ Returns a dict of the state of each recorded job, keyed by job ID. """
+    with self._lock:
+      return dict((str(job_id), str(state)) for job_id, state in
+                  self._connection.execute('SELECT job_id, state FROM query_jobs'))
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+  def _update_state(self, query_string, state):
+    with self._lock, self._connection:
+      self._connection.execute(
+          'UPDATE query_jobs SET state = ?, updated_time = ? WHERE query_hash = ?',
+          (state, time.time(), resultcache.query_hash(query_string)))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import runjournal
+
+
+class RunJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.journal_dir = tempfile.mkdtemp()
+    self.journal_path = os.path.join(self.journal_dir, 'run_journal.sqlite')
+    self.run_journal = runjournal.RunJournal(self.journal_path)
+
+  def tearDown(self):
+    self.run_journal.close()
+    shutil.rmtree(self.journal_dir)
+
+  def test_submitted_job_is_found_after_reopening(self):
+    self.run_journal.record_submission('SELECT 1', 'job_1', 'site, provider', submitted_time = 1000.0)
+    self.run_journal.close()
+
+    self.run_journal = runjournal.RunJournal(self.journal_path)
+    self.assertEqual(('job_1', 1000.0), self.run_journal.find_submitted_job('SELECT 1'))
+
+  def test_queries_are_matched_regardless_of_whitespace(self):
+    self.run_journal.record_submission('SELECT\n  1', 'job_1')
+    self.assertEqual('job_1', self.run_journal.find_submitted_job('SELECT 1')[0])
+    self.assertIsNone(self.run_journal.find_submitted_job('SELECT 2'))
+
+  def test_finished_jobs_are_not_found(self):
+    self.run_journal.record_submission('SELECT 1', 'job_1')
+    self.run_journal.record_submission('SELECT 2', 'job_2')
+    self.run_journal.record_retrieval('SELECT 1')
+    self.run_journal.record_failure('SELECT 2')
+
+    self.assertIsNone(self.run_journal.find_submitted_job('SELECT 1'))
+    self.assertIsNone(self.run_journal.find_submitted_job('SELECT 2'))
+    self.assertDictEqual({'job_1': runjournal.RETRIEVED, 'job_2': runjournal.FAILED},
+                         self.run_journal.job_states())
+
+  def test_resubmission_replaces_failed_job(self):
+    self.run_journal.record_submission('SELECT 1', 'job_1')
+    self.run_journal.record_failure('SELECT 1')
+    self.run_journal.record_submission('SELECT 1', 'job_2')
+    self.assertEqual('job_2', self.run_journal.find_submitted_job('SELECT 1')[0])
+    self.assertDictEqual({'job_2': runjournal.SUBMITTED}, self.run_journal.job_states())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import Queue
+
+# Longest time to block in a single wait, so that waiting threads still
+# respond to KeyboardInterrupt.
+_MAXIMUM_WAIT_SECONDS = 1.0
+
+# Jobs due to be polled within this many seconds of each other are polled
+# together, with a single request for all of their states.
+_POLL_COALESCE_SECONDS = 0.5
+
+
+class ScheduledJob(object):
+  """ A BigQuery job whose completion the scheduler is waiting on. """
+
+  def __init__(self, job_id, job_metadata, callback_function, is_batched, expected_duration = None,
+               submitted_time = None):
+    self.job_id = job_id
+    self.metadata = job_metadata
+    self.callback_function = callback_function
+    self.is_batched = is_batched
+    self.expected_duration = expected_duration
+    self.submitted_time = submitted_time or time.time()
+    self.poll_delay = None
+    self.result = False
+
+  @property
+  def duration_features(self):
+    """ Properties of the job that predict how long it takes: whether it is
+        batched, the number of tables it spans and the number of predicates
+        in its query.
+    """
+    return (self.is_batched, self.metadata.get('table_span'), self.metadata.get('predicate_count'))
+
+  @property
+  def notification_identifier(self):
+    return "{metric}, {site}, {client_provider}, {date}, {duration}".format(**self.metadata)
+
+
+class AdaptivePollSchedule(object):
+  """ Decides when to next poll the state of a job.
+
+      Jobs are first polled shortly after submission, then at geometrically
+      increasing intervals up to a maximum. If the job's duration can be
+      estimated, polling is deferred until the job is expected to be done,
+      and backs off from the minimum delay again after that.
+
+  """
+
+  def __init__(self, minimum_delay = 1, maximum_delay = 60, backoff_factor = 2):
+    """ Creates a schedule.
+
+        Args:
+          minimum_delay (float): Seconds before the first poll of a job.
+          maximum_delay (float): Longest time in seconds between polls.
+          backoff_factor (float): Factor by which the time between polls grows
+            after each poll.
+
+    """
+    self.minimum_delay = minimum_delay
+    self.maximum_delay = maximum_delay
+    self.backoff_factor = backoff_factor
+
+  def next_delay(self, scheduled_job, now):
+    """ Returns the number of seconds until the job should next be polled. """
+    time_waiting = now - scheduled_job.submitted_time
+    if scheduled_job.expected_duration is not None and time_waiting < scheduled_job.expected_duration:
+      return min(max(scheduled_job.expected_duration - time_waiting, self.minimum_delay), self.maximum_delay)
+
+    if scheduled_job.poll_delay is None:
+      scheduled_job.poll_delay = self.minimum_delay
+    else:
+      scheduled_job.poll_delay = min(scheduled_job.poll_delay * self.backoff_factor, self.maximum_delay)
+    return scheduled_job.poll_delay
+
+
+class JobDurationModel(object):
+  """ Record of how long past jobs took, stored locally, from which the
+      durations of similar jobs are estimated.
+
+      Jobs are considered similar if they have the same priority, span the
+      same number of tables and have a number of query predicates within the
+      same power of two. The estimate for a job is the median duration of the
+      most recent similar jobs.
+
+  """
+
+  _DURATIONS_PER_KEY = 25
+
+  def __init__(self, model_path = None):
+    """ Creates a model, loading past durations from model_path if it exists.
+
+        Args:
+          model_path (str): JSON file in which durations are stored, or None
+            to keep them only in memory.
+
+    """
+    self.logger = logging.getLogger('telescope')
+    self.model_path = model_path
+    self._lock = threading.Lock()
+    self._durations = {}
+    if model_path is not None and os.path.exists(model_path):
+      try:
+        with open(model_path, 'r') as model_file:
+          self._durations = json.load(model_file)
+      except (IOError, ValueError) as caught_error:
+        self.logger.warn('Ignoring unreadable job duration model {path}: {error}'.format(
+            path = model_path, error = caught_error))
+
+  def estimate(self, duration_features):
+    """ Estimates the duration in seconds of a job with the given features
+        (see ScheduledJob.duration_features), or returns None if no similar
+        job has been recorded.
+    """
+    with self._lock:
+      durations = self._durations.get(self._key(duration_features))
+      if not durations:
+        return None
+      sorted_durations = sorted(durations)
+      return sorted_durations[len(sorted_durations) // 2]
+
+  def record(self, duration_features, duration):
+    """ Records the duration in seconds of a completed job. """
+    with self._lock:
+      durations = self._durations.setdefault(self._key(duration_features), [])
+      durations.append(duration)
+      del durations[:-self._DURATIONS_PER_KEY]
+
+  def save(self):
+    """ Writes the recorded durations to the model file, if there is one. """
+    if self.model_path is None:
+      return
+    with self._lock:
+      model_directory = os.path.dirname(os.path.abspath(self.model_path))
+      model_fd, temp_path = tempfile.mkstemp(dir = model_directory, prefix = '.tmp-')
+      try:
+        with os.fdopen(model_fd, 'w') as model_file:
+          json.dump(self._durations, model_file)
+        os.rename(temp_path, self.model_path)
+      except (IOError, OSError) as caught_error:
+        self.logger.warn('Could not save job duration model: {error}'.format(error = caught_error))
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+
+  def _key(self, duration_features):
+    is_batched, table_span, predicate_count = duration_features
+    if predicate_count is None:
+      predicate_bucket = None
+    else:
+      predicate_bucket = int(math.log(predicate_count + 1, 2))
+    return '{priority}:{table_span}:{predicate_bucket}'.format(
+        priority = 'batch' if is_batched else 'interactive', table_span = table_span,
+        predicate_bucket = predicate_bucket)
+
+
+class JobScheduler(object):
+  """ Waits on many BigQuery jobs at once from a single polling loop.
+
+      Jobs hold one of a bounded number of slots from submission until their
+      results have been processed, and callers waiting for a slot or for jobs
+      to finish are woken as soon as a job completes. One thread polls the
+      status of every job in flight, each at its own next poll time, fetching
+      the states of all jobs that are due in a single request. A small pool of
+      threads retrieves and processes the results of completed jobs.
+
+      Poll times follow an AdaptivePollSchedule, informed by a
+      JobDurationModel of how long similar jobs took, to which the run time
+      BigQuery reports for each completed job is added. Run times are used
+      rather than the time at which completion was noticed, which depends on
+      the poll schedule itself.
+
+  """
+
+  def __init__(self, bigquery_call_factory, max_jobs_in_flight, max_interactive_jobs_in_flight,
+               retrieval_threads = 4, poll_schedule = None, job_duration_model = None):
+    """ Creates a scheduler and starts its threads.
+
+        Args:
+          bigquery_call_factory (callable): Returns a
+            telescope.external.BigQueryCall for the exclusive use of the
+            caller, such as BigQueryCallPool.acquire. Each scheduler thread
+            takes its own, since API connections are not thread-safe.
+          max_jobs_in_flight (int): Maximum number of jobs of either priority
+            in flight at once.
+          max_interactive_jobs_in_flight (int): Maximum number of interactive,
+            non-batched jobs in flight at once.
+          retrieval_threads (int): Number of threads that retrieve and process
+            results of completed jobs.
+          poll_schedule (AdaptivePollSchedule): Schedule of status checks of
+            each job. Defaults to the default AdaptivePollSchedule.
+          job_duration_model (JobDurationModel): Model of job durations that
+            informs the poll schedule. Defaults to a model kept in memory.
+
+    """
+    self.logger = logging.getLogger('telescope')
+    self._bigquery_call_factory = bigquery_call_factory
+    self._max_jobs_in_flight = max_jobs_in_flight
+    self._max_interactive_jobs_in_flight = max_interactive_jobs_in_flight
+    self._poll_schedule_policy = poll_schedule or AdaptivePollSchedule()
+    self._job_duration_model = job_duration_model or JobDurationModel()
+
+    self._condition = threading.Condition()
+    self._jobs_in_flight = 0
+    self._interactive_jobs_in_flight = 0
+    self._poll_schedule = []
+    self._poll_sequence = itertools.count()
+    self._retrieval_queue = Queue.Queue()
+    self._is_stopped = False
+
+    self._threads = [threading.Thread(target = self._run_poll_loop)]
+    for _ in range(retrieval_threads):
+      self._threads.append(threading.Thread(target = self._run_retrieval_loop))
+    for scheduler_thread in self._threads:
+      scheduler_thread.daemon = True
+      scheduler_thread.start()
+
+  def acquire_slot(self, is_batched):
+    """ Blocks until a job of the given priority may be submitted, then
+        reserves a slot for it. The slot is released once the job passed to
+        add_job completes, or by release_slot if the job is not submitted.
+    """
+    with self._condition:
+      while not self._has_free_slot(is_batched):
+        self.logger.debug(('Reached limit of {jobs_in_flight} jobs in flight, waiting for a job to '
+                           'complete.').format(jobs_in_flight = self._jobs_in_flight))
+        self._condition.wait(_MAXIMUM_WAIT_SECONDS)
+      self._jobs_in_flight += 1
+      if not is_batched:
+        self._interactive_jobs_in_flight += 1
+
+  def release_slot(self, is_batched):
+    """ Releases a slot reserved by acquire_slot. """
+    with self._condition:
+      self._jobs_in_flight -= 1
+      if not is_batched:
+        self._interactive_jobs_in_flight -= 1
+      self._condition.notify_all()
+
+  def add_job(self, job_id, job_metadata, callback_function, is_batched, submitted_time = None):
+    """ Starts waiting on a submitted job, for which a slot is held.
+
+        Args:
+          job_id (str): ID of the submitted BigQuery job.
+          job_metadata (dict): Metadata of the selectors the job serves.
+          callback_function (callable): Called with the job ID and a
+            query_object keyword argument once the job is done. Its return
+            value is kept as the job's result.
+          is_batched (bool): Whether the job was submitted in batch mode.
+          submitted_time (float): Time at which the job was submitted, in
+            seconds since the epoch, if it was submitted earlier than now,
+            such as by an interrupted run.
+
+        Returns:
+          ScheduledJob: The job being waited on.
+
+    """
+    scheduled_job = ScheduledJob(job_id, job_metadata, callback_function, is_batched,
+                                 submitted_time = submitted_time)
+    scheduled_job.expected_duration = self._job_duration_model.estimate(scheduled_job.duration_features)
+    self.logger.info('Queued request for {notification_identifier}, received job id: {job_id}'.format(
+        notification_identifier = scheduled_job.notification_identifier, job_id = job_id))
+    self._schedule_next_poll(scheduled_job)
+    return scheduled_job
+
+  def wait_until_idle(self):
+    """ Blocks until every submitted job has completed. """
+    with self._condition:
+      while self._jobs_in_flight > 0:
+        self._condition.wait(_MAXIMUM_WAIT_SECONDS)
+
+  def stop(self):
+    """ Stops the scheduler's threads once they finish their current work,
+        and saves the job duration model.
+    """
+    self._job_duration_model.save()
+    with self._condition:
+      self._is_stopped = True
+      self._condition.notify_all()
+    for _ in self._threads:
+      self._retrieval_queue.put(None)
+
+  def _has_free_slot(self, is_batched):
+    if self._jobs_in_flight >= self._max_jobs_in_flight:
+      return False
+    return is_batched or self._interactive_jobs_in_flight < self._max_interactive_jobs_in_flight
+
+  def _schedule_next_poll(self, scheduled_job):
+    self._schedule_poll(scheduled_job, self._poll_schedule_policy.next_delay(scheduled_job, time.time()))
+
+  def _schedule_poll(self, scheduled_job, delay_seconds):
+    with self._condition:
+      heapq.heappush(self._poll_schedule,
+                     (time.time() + delay_seconds, next(self._poll_sequence), scheduled_job))
+      self._condition.notify_all()
+
+  def _next_due_jobs(self):
+    """ Blocks until at least one job is due to be polled, then returns all
+        jobs that are due or nearly due, or None once the scheduler is stopped.
+    """
+    with self._condition:
+      while not self._is_stopped:
+        now = time.time()
+        if self._poll_schedule and self._poll_schedule[0][0] <= now:
+          due_jobs = []
+          while self._poll_schedule and self._poll_schedule[0][0] <= now + _POLL_COALESCE_SECONDS:
+            due_jobs.append(heapq.heappop(self._poll_schedule)[2])
+          return due_jobs
+        if self._poll_schedule:
+          wait_seconds = min(self._poll_schedule[0][0] - now, _MAXIMUM_WAIT_SECONDS)
+        else:
+          wait_seconds = _MAXIMUM_WAIT_SECONDS
+        self._condition.wait(wait_seconds)
+    return None
+
+  def _run_poll_loop(self):
+    bigquery_call = None
+    while True:
+      due_jobs = self._next_due_jobs()
+      if due_jobs is None:
+        return
+      try:
+        bigquery_call = bigquery_call or self._bigquery_call_factory()
+        job_summaries = bigquery_call.get_job_summaries([scheduled_job.job_id for scheduled_job in due_jobs])
+      except Exception as caught_error:
+        self.logger.warn(('Encountered error ({caught_error}) monitoring {job_count} jobs, could be ' +
+                          'temporary, not bailing out.').format(caught_error = caught_error,
+                                                                job_count = len(due_jobs)))
+        for scheduled_job in due_jobs:
+          self._schedule_next_poll(scheduled_job)
+        continue
+      for scheduled_job in due_jobs:
+        # Each job is handled on its own, so that no one job can stop the
+        # only thread that polls every job.
+        try:
+          job_summary = job_summaries.get(scheduled_job.job_id)
+          if job_summary is None:
+            self.logger.warn('No state returned for {notification_identifier}, polling it again.'.format(
+                notification_identifier = scheduled_job.notification_identifier))
+            self._schedule_next_poll(scheduled_job)
+            continue
+          self._handle_job_state(scheduled_job, job_summary)
+        except Exception as caught_error:
+          self.logger.error('Failed to handle state of {notification_identifier}: {error}'.format(
+              notification_identifier = scheduled_job.notification_identifier, error = caught_error))
+          self._finish_job(scheduled_job)
+
+  def _handle_job_state(self, scheduled_job, job_summary):
+    job_state = job_summary['state']
+    time_waiting = int(time.time() - scheduled_job.submitted_time)
+    if job_state == 'RUNNING':
+      self.logger.info(('Waiting for {notification_identifier} to complete, spent {time_waiting} '
+                        'seconds so far.').format(notification_identifier = scheduled_job.notification_identifier,
+                                                  time_waiting = time_waiting))
+      self._schedule_next_poll(scheduled_job)
+    elif job_state == 'PENDING':
+      self.logger.info(('Waiting for {notification_identifier} to submit, spent {time_waiting} '
+                        'seconds so far.').format(notification_identifier = scheduled_job.notification_identifier,
+                                                  time_waiting = time_waiting))
+      self._schedule_next_poll(scheduled_job)
+    elif job_state == 'DONE':
+      self.logger.info('Found completion status for {notification_identifier}.'.format(
+          notification_identifier = scheduled_job.notification_identifier))
+      if job_summary['runtime_seconds'] is not None:
+        self._job_duration_model.record(scheduled_job.duration_features, job_summary['runtime_seconds'])
+      self._retrieval_queue.put(scheduled_job)
+    else:
+      self.logger.error('Unknown BigQuery state {state} for {notification_identifier}.'.format(
+          state = job_state, notification_identifier = scheduled_job.notification_identifier))
+      self._finish_job(scheduled_job)
+
+  def _run_retrieval_loop(self):
+    bigquery_call = None
+    while True:
+      scheduled_job = self._retrieval_queue.get()
+      if scheduled_job is None:
+        return
+      try:
+        bigquery_call = bigquery_call or self._bigquery_call_factory()
+        scheduled_job.result = scheduled_job.callback_function(scheduled_job.job_id,
+                                                               query_object = bigquery_call)
+      except Exception as caught_error:
+        self.logger.error('Failed to process results of {notification_identifier}: {error}'.format(
+            notification_identifier = scheduled_job.notification_identifier, error = caught_error))
+      self._finish_job(scheduled_job)
+
+  def _finish_job(self, scheduled_job):
+    self.release_slot(scheduled_job.is_batched)
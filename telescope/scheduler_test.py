@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2014 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import external
+import external_test
+import scheduler
+
+
+class JobSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = external_test.FakeBigQueryService()
+    self.job_metadata = {'metric': 'minimum_rtt', 'site': 'lga01', 'client_provider': 'comcast',
+                         'date': '2014-01-01-000000', 'duration': '1d'}
+    self.completed_jobs = []
+    self.job_scheduler = self.create_scheduler(max_jobs_in_flight = 10, max_interactive_jobs_in_flight = 10)
+
+  def tearDown(self):
+    self.job_scheduler.stop()
+
+  def create_scheduler(self, max_jobs_in_flight, max_interactive_jobs_in_flight):
+    return scheduler.JobScheduler(
+        lambda: external.BigQueryCall(external_test.FakeGoogleAPIAuth(self.service)),
+        max_jobs_in_flight, max_interactive_jobs_in_flight,
+        retrieval_threads = 2,
+        poll_schedule = scheduler.AdaptivePollSchedule(minimum_delay = 0.01, maximum_delay = 0.01))
+
+  def add_job(self, job_id, state = 'DONE', is_batched = False, job_scheduler = None):
+    self.service.add_query_results(job_id, ['log_time'], [['1']])
+    self.service.jobs_store[job_id]['status']['state'] = state
+    job_scheduler = job_scheduler or self.job_scheduler
+    job_scheduler.acquire_slot(is_batched)
+    return job_scheduler.add_job(job_id, self.job_metadata, self.record_completion, is_batched)
+
+  def record_completion(self, job_id, query_object = None):
+    self.assertIsInstance(query_object, external.BigQueryCall)
+    self.completed_jobs.append(job_id)
+    return True
+
+  def test_completed_job_is_processed(self):
+    scheduled_job = self.add_job('job_done')
+    self.job_scheduler.wait_until_idle()
+    self.assertListEqual(['job_done'], self.completed_jobs)
+    self.assertTrue(scheduled_job.result)
+
+  def test_running_job_is_polled_until_done(self):
+    self.add_job('job_running', state = 'PENDING')
+    time.sleep(0.05)
+    self.assertListEqual([], self.completed_jobs)
+    self.assertGreater(self.service.calls.count('jobs.list'), 1)
+
+    self.service.jobs_store['job_running']['status']['state'] = 'DONE'
+    self.job_scheduler.wait_until_idle()
+    self.assertListEqual(['job_running'], self.completed_jobs)
+
+  def test_due_jobs_are_polled_together(self):
+    self.job_scheduler.stop()
+    self.job_scheduler = self.create_scheduler(max_jobs_in_flight = 50, max_interactive_jobs_in_flight = 50)
+    self.job_scheduler._condition.acquire()
+    try:
+      # Submit every job before the polling loop can see any of them.
+      for job_index in range(40):
+        self.service.add_query_results('job_%d' % job_index, ['log_time'], [['1']])
+        self.job_scheduler.acquire_slot(False)
+        self.job_scheduler.add_job('job_%d' % job_index, self.job_metadata, self.record_completion, False)
+    finally:
+      self.job_scheduler._condition.release()
+    self.job_scheduler.wait_until_idle()
+
+    self.assertEqual(40, len(self.completed_jobs))
+    self.assertEqual(1, self.service.calls.count('jobs.list'))
+    self.assertEqual(0, self.service.calls.count('jobs.get'))
+
+  def test_acquire_slot_waits_for_completion(self):
+    self.job_scheduler.stop()
+    self.job_scheduler = self.create_scheduler(max_jobs_in_flight = 1, max_interactive_jobs_in_flight = 1)
+    self.add_job('job_first', state = 'RUNNING')
+
+    slot_acquired = threading.Event()
+    def acquire_second_slot():
+      self.job_scheduler.acquire_slot(False)
+      slot_acquired.set()
+    waiting_thread = threading.Thread(target = acquire_second_slot)
+    waiting_thread.daemon = True
+    waiting_thread.start()
+    self.assertFalse(slot_acquired.wait(0.05))
+
+    self.service.jobs_store['job_first']['status']['state'] = 'DONE'
+    self.assertTrue(slot_acquired.wait(1))
+    self.job_scheduler.release_slot(False)
+
+  def test_batched_jobs_are_not_limited_by_interactive_limit(self):
+    self.job_scheduler.stop()
+    self.job_scheduler = self.create_scheduler(max_jobs_in_flight = 3, max_interactive_jobs_in_flight = 1)
+    self.add_job('job_interactive', state = 'RUNNING')
+    self.add_job('job_batched_first', state = 'RUNNING', is_batched = True)
+    self.add_job('job_batched_second', state = 'RUNNING', is_batched = True)
+    self.assertFalse(self.job_scheduler._has_free_slot(True))
+    self.assertFalse(self.job_scheduler._has_free_slot(False))
+
+  def test_failed_processing_releases_slot(self):
+    def fail_processing(job_id, query_object = None):
+      raise ValueError('Bad results')
+    self.service.add_query_results('job_failing', ['log_time'], [['1']])
+    self.job_scheduler.acquire_slot(False)
+    scheduled_job = self.job_scheduler.add_job('job_failing', self.job_metadata, fail_processing, False)
+    self.job_scheduler.wait_until_idle()
+    self.assertFalse(scheduled_job.result)
+
+  def test_unknown_state_finishes_job(self):
+    scheduled_job = self.add_job('job_unknown', state = 'UNKNOWN')
+    self.job_scheduler.wait_until_idle()
+    self.assertListEqual([], self.completed_jobs)
+    self.assertFalse(scheduled_job.result)
+
+  def test_job_missing_from_states_is_polled_again(self):
+    bigquery_call = external.BigQueryCall(external_test.FakeGoogleAPIAuth(self.service))
+    original_get_job_summaries = bigquery_call.get_job_summaries
+    missing_polls = []
+    def get_job_summaries_without_new_job(job_ids):
+      job_summaries = original_get_job_summaries(job_ids)
+      if 'job_new' in job_summaries and len(missing_polls) < 2:
+        missing_polls.append('job_new')
+        del job_summaries['job_new']
+      return job_summaries
+    bigquery_call.get_job_summaries = get_job_summaries_without_new_job
+    self.job_scheduler.stop()
+    self.job_scheduler = scheduler.JobScheduler(
+        lambda: bigquery_call, 10, 10, retrieval_threads = 1,
+        poll_schedule = scheduler.AdaptivePollSchedule(minimum_delay = 0.01, maximum_delay = 0.01))
+    self.add_job('job_new')
+    self.job_scheduler.wait_until_idle()
+    self.assertListEqual(['job_new', 'job_new'], missing_polls)
+    self.assertListEqual(['job_new'], self.completed_jobs)
+
+  def test_error_handling_job_state_finishes_job(self):
+    def fail_record(duration_features, duration):
+      raise ValueError('Unwritable model')
+    self.job_scheduler._job_duration_model.record = fail_record
+    scheduled_job = self.add_job('job_done')
+    # Without a run time, the other job is never recorded.
+    self.service.add_query_results('job_other', ['log_time'], [['1']])
+    self.service.jobs_store['job_other']['statistics'] = {}
+    self.job_scheduler.acquire_slot(False)
+    self.job_scheduler.add_job('job_other', self.job_metadata, self.record_completion, False)
+    self.job_scheduler.wait_until_idle()
+    self.assertFalse(scheduled_job.result)
+    self.assertListEqual(['job_other'], self.completed_jobs)
+
+  def test_completed_job_durations_are_recorded(self):
+    self.job_metadata['table_span'] = 2
+    self.job_metadata['predicate_count'] = 10
+    scheduled_job = self.add_job('job_done')
+    self.job_scheduler.wait_until_idle()
+    self.assertIsNotNone(self.job_scheduler._job_duration_model.estimate(scheduled_job.duration_features))
+
+  def test_recorded_durations_are_bigquery_run_times(self):
+    self.job_metadata['table_span'] = 2
+    self.job_metadata['predicate_count'] = 10
+    job_duration_model = self.job_scheduler._job_duration_model
+    duration_features = (False, 2, 10)
+    job_duration_model.record(duration_features, 30.0)
+    job_duration_model.record(duration_features, 60.0)
+    self.assertEqual(60.0, job_duration_model.estimate(duration_features))
+
+    # A job that BigQuery ran faster than the estimate lowers it, even though
+    # its completion is only noticed once the estimate has passed.
+    self.service.add_query_results('job_fast', ['log_time'], [['1']])
+    self.service.jobs_store['job_fast']['statistics'] = {'creationTime': '1400000000000',
+                                                         'endTime': '1400000005000'}
+    self.job_scheduler.acquire_slot(False)
+    self.job_scheduler.add_job('job_fast', self.job_metadata, self.record_completion, False,
+                               submitted_time = time.time() - 120)
+    self.job_scheduler.wait_until_idle()
+    self.assertEqual(30.0, job_duration_model.estimate(duration_features))
+
+
+class AdaptivePollScheduleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.poll_schedule = scheduler.AdaptivePollSchedule(minimum_delay = 1, maximum_delay = 10, backoff_factor = 2)
+    self.scheduled_job = scheduler.ScheduledJob('job_0', {}, None, False)
+
+  def test_backs_off_geometrically(self):
+    now = self.scheduled_job.submitted_time
+    delays = [self.poll_schedule.next_delay(self.scheduled_job, now) for _ in range(6)]
+    self.assertListEqual([1, 2, 4, 8, 10, 10], delays)
+
+  def test_waits_for_expected_duration(self):
+    self.scheduled_job.expected_duration = 7
+    now = self.scheduled_job.submitted_time
+    self.assertEqual(7, self.poll_schedule.next_delay(self.scheduled_job, now))
+    self.assertEqual(1, self.poll_schedule.next_delay(self.scheduled_job, now + 6.5))
+    self.assertListEqual([1, 2, 4], [self.poll_schedule.next_delay(self.scheduled_job, now + 7)
+                                     for _ in range(3)])
+
+  def test_long_expected_duration_is_capped(self):
+    self.scheduled_job.expected_duration = 300
+    self.assertEqual(10, self.poll_schedule.next_delay(self.scheduled_job, self.scheduled_job.submitted_time))
+
+
+class JobDurationModelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.model_directory = tempfile.mkdtemp()
+    self.model_path = os.path.join(self.model_directory, 'job_durations.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.model_directory)
+
+  def test_estimate_is_median_of_similar_jobs(self):
+    job_duration_model = scheduler.JobDurationModel()
+    for duration in (30, 10, 20):
+      job_duration_model.record((False, 2, 100), duration)
+    job_duration_model.record((True, 2, 100), 500)
+    self.assertEqual(20, job_duration_model.estimate((False, 2, 100)))
+    # Predicate counts within the same power of two are similar.
+    self.assertEqual(20, job_duration_model.estimate((False, 2, 120)))
+    self.assertIsNone(job_duration_model.estimate((False, 2, 1000)))
+    self.assertIsNone(job_duration_model.estimate((False, 3, 100)))
+
+  def test_saved_model_is_reloaded(self):
+    job_duration_model = scheduler.JobDurationModel(self.model_path)
+    job_duration_model.record((True, 1, 5), 42.0)
+    job_duration_model.save()
+    self.assertEqual(42.0, scheduler.JobDurationModel(self.model_path).estimate((True, 1, 5)))
+
+  def test_unreadable_model_is_ignored(self):
+    with open(self.model_path, 'w') as model_file:
+      model_file.write('{not json')
+    self.assertIsNone(scheduler.JobDurationModel(self.model_path).estimate((True, 1, 5)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -178,10 +178,8 @@ class SelectorFileParser(object):
 
     """
     try:
-      ip_translation_spec = iptranslation.IPTranslationStrategySpec
-      ip_translation_spec.strategy_name = ip_translation_dict['strategy']
-      ip_translation_spec.params = ip_translation_dict['params']
-      return ip_translation_spec
+      return iptranslation.IPTranslationStrategySpec(ip_translation_dict['strategy'],
+                                                     ip_translation_dict['params'])
     except KeyError as e:
       raise ValueError('Missing expected field in ip_translation dict: %s' % e.args[0])
 
@@ -17,7 +17,9 @@
 
 
 import datetime
+import json
 import os
+import tempfile
 
 
 class UTC(datetime.tzinfo):
@@ -37,19 +39,108 @@ def unix_timestamp_to_utc_datetime(unix_timestamp):
   return datetime.datetime.fromtimestamp(unix_timestamp, tz = UTC())
 
 
-def check_for_valid_cache(cache_path, manifest_path = None):
+def utc_datetime_to_unix_timestamp(utc_datetime):
+  return int((utc_datetime - unix_timestamp_to_utc_datetime(0)).total_seconds())
+
+
+def output_manifest_path(data_filepath):
+  """ Path of the manifest that records the completion of an output file. """
+  return data_filepath + '.manifest'
+
+
+def write_output_manifest(data_filepath, row_count, checksum, selector_keys = (), query_hashes = (),
+                          db_snapshots = ()):
+  """ Records that an output file was completely written.
+
+      The manifest is itself written to a temporary file and renamed into
+      place, so it either exists in full or not at all. It also records the
+      size and modification time of the output file, which lets
+      check_for_valid_cache detect output files that changed since.
+
+      Args:
+        data_filepath (str): Path of the output file, which must exist.
+        row_count (int): Number of rows of results in the file.
+        checksum (str): Checksum of the content of the file.
+        selector_keys (list): Cache keys of the selectors whose results the
+          file holds, against which check_for_valid_cache checks the current
+          selector.
+        query_hashes (list): Hashes of the queries that retrieved those
+          results.
+        db_snapshots (list): Dates of the MaxMind snapshots from which the
+          client network blocks of those queries were resolved.
+
+  """
+  data_stat = os.stat(data_filepath)
+  manifest = {'rows': row_count,
+              'checksum': checksum,
+              'size': data_stat.st_size,
+              'mtime': data_stat.st_mtime,
+              'selector_keys': sorted(set(selector_keys)),
+              'query_hashes': sorted(set(query_hashes)),
+              'db_snapshots': sorted(set(db_snapshots))}
+  manifest_path = output_manifest_path(data_filepath)
+  manifest_fd, manifest_temp_path = tempfile.mkstemp(dir = os.path.dirname(manifest_path) or '.',
+                                                     prefix = '.tmp-')
+  with os.fdopen(manifest_fd, 'w') as manifest_file:
+    json.dump(manifest, manifest_file)
+  os.rename(manifest_temp_path, manifest_path)
+
+
+def read_output_manifest(data_filepath, manifest_path = None):
+  """ Reads the manifest of an output file.
+
+      Returns:
+        dict: Contents of the manifest, or None if the file has no readable
+        manifest.
+
+  """
+  try:
+    with open(manifest_path or output_manifest_path(data_filepath), 'r') as manifest_file:
+      return json.load(manifest_file)
+  except (IOError, ValueError):
+    return None
+
+
+def remove_output_manifest(data_filepath):
+  """ Removes the manifest of an output file, if any, marking the file as
+      incomplete.
+  """
+  try:
+    os.remove(output_manifest_path(data_filepath))
+  except OSError:
+    pass
+
+
+def check_for_valid_cache(cache_path, manifest_path = None, selector_key = None):
   """ Checks for results file previously generated by this tool.
 
+      A results file is valid only if its manifest records that it was
+      completely written for the current selector and the file still has the size
+      and modification time recorded in the manifest. The check takes a single
+      stat of the results file and does not read its content.
+
       Args:
         cache_path (str): Built path to cache file that we are interested in.
-        manifest_path (str, optional): Built path to cache file that we are interested in. Defaults to None.
+        manifest_path (str, optional): Path of the manifest of the cache file.
+          Defaults to the path given by output_manifest_path.
+        selector_key (str, optional): Cache key of the selector that would
+          produce the file now. The file is not valid if its manifest does not
+          record it.
 
       Returns:
         bool: True if valid file, False otherwise.
 
   """
-  does_file_exist_at_cache_path = os.path.exists(cache_path)
-  return does_file_exist_at_cache_path
+  manifest = read_output_manifest(cache_path, manifest_path)
+  if manifest is None:
+    return False
+  if selector_key is not None and selector_key not in manifest.get('selector_keys', []):
+    return False
+  try:
+    cache_stat = os.stat(cache_path)
+  except OSError:
+    return False
+  return cache_stat.st_size == manifest.get('size') and cache_stat.st_mtime == manifest.get('mtime')
 
 
 def strip_special_chars(filename):
@@ -16,9 +16,13 @@
 # limitations under the License.
 
 
-import utils
+import os
+import shutil
+import tempfile
 import unittest
 
+import utils
+
 class UtilsTest(unittest.TestCase):
 
 
@@ -30,5 +34,58 @@ class UtilsTest(unittest.TestCase):
     self.assertEquals('namesplacesdates.csv', utils.strip_special_chars(r'names\places\dates.csv'))
     self.assertEquals('spaces are okay.csv', utils.strip_special_chars('spaces are okay.csv'))
 
+class OutputManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+    self.data_filepath = os.path.join(self.output_dir, 'lga01_comcast_minimum_rtt-raw.csv')
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def write_data_file(self, content):
+    with open(self.data_filepath, 'w') as data_file:
+      data_file.write(content)
+
+  def test_file_without_manifest_is_not_valid_cache(self):
+    self.write_data_file('1400000000,12.5\r\n')
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath))
+
+  def test_missing_file_is_not_valid_cache(self):
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath))
+
+  def test_manifest_records_completed_file(self):
+    self.write_data_file('1400000000,12.5\r\n')
+    utils.write_output_manifest(self.data_filepath, 1, 'sha1:abc', selector_keys = ['s1'],
+                                query_hashes = ['q1'], db_snapshots = ['2014-10-01', '2014-09-01'])
+    self.assertTrue(utils.check_for_valid_cache(self.data_filepath))
+    self.assertTrue(utils.check_for_valid_cache(self.data_filepath,
+                                                utils.output_manifest_path(self.data_filepath)))
+    manifest = utils.read_output_manifest(self.data_filepath)
+    self.assertEqual(1, manifest['rows'])
+    self.assertEqual('sha1:abc', manifest['checksum'])
+    self.assertListEqual(['s1'], manifest['selector_keys'])
+    self.assertListEqual(['q1'], manifest['query_hashes'])
+    self.assertListEqual(['2014-09-01', '2014-10-01'], manifest['db_snapshots'])
+
+  def test_file_of_other_selector_is_not_valid_cache(self):
+    self.write_data_file('1400000000,12.5\r\n')
+    utils.write_output_manifest(self.data_filepath, 1, 'sha1:abc', selector_keys = ['s1'], query_hashes = ['q1'])
+    self.assertTrue(utils.check_for_valid_cache(self.data_filepath, selector_key = 's1'))
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath, selector_key = 's2'))
+
+  def test_changed_file_is_not_valid_cache(self):
+    self.write_data_file('1400000000,12.5\r\n')
+    utils.write_output_manifest(self.data_filepath, 1, 'sha1:abc')
+    self.write_data_file('1400000000,12.5\r\n1400000010,13.5\r\n')
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath))
+
+  def test_removed_manifest_is_not_valid_cache(self):
+    self.write_data_file('1400000000,12.5\r\n')
+    utils.write_output_manifest(self.data_filepath, 1, 'sha1:abc')
+    utils.remove_output_manifest(self.data_filepath)
+    self.assertFalse(utils.check_for_valid_cache(self.data_filepath))
+
+
 if __name__ == '__main__':
   unittest.main()